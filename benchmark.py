@@ -0,0 +1,192 @@
+"""Throughput benchmark of the merge workflow against the local Alma stand-in.
+
+Each run merges a synthetic CSV with `merge.workflow` against `tests.fakealma.FakeAlma`
+in its own process, so the peak memory is measured per run. The selenium and http
+backends still start Chrome, which must be installed.
+
+Example:
+    python benchmark.py --rows 100 1000 --backends http selenium --zone-sessions 1 2
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from itertools import product
+from typing import Dict, List
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+RESTARTS_PATTERN = re.compile(r'(\d+) soft recoveries, (\d+) browser restarts')
+HEAVY_MODULES = ['pandas', 'selenium.webdriver', 'almapiwrapper', 'requests', 'lxml']
+
+
+def generate_input(alma, file_path: str, rows: int, zones: List[str], block_every: int = 50) -> None:
+    """Write a synthetic merge file and create its users in the stand-in.
+
+    args:
+        alma (FakeAlma): Stand-in receiving the users.
+        file_path (str): Path of the CSV file to write.
+        rows (int): Number of merges.
+        zones (List[str]): Zones of the merges, used in turn.
+        block_every (int): One 'from' user out of `block_every` has an internal block. Default is 50.
+    """
+    pairs = []
+    for i in range(rows):
+        zone = zones[i % len(zones)]
+        from_user, to_user = f'from_{i}@bench.ch', f'to_{i}@bench.ch'
+        alma.add_user(zone, from_user, internal_blocks=1 if i % block_every == 0 else 0)
+        alma.add_user(zone, to_user)
+        pairs.append((from_user, to_user, zone))
+    pd.DataFrame(pairs, columns=['from_user', 'to_user', 'zone']).to_csv(file_path, index=False)
+
+
+def run_benchmark(rows: int, backend: str = 'http', zone_workers: int = 1, zone_sessions: int = 1,
+                  batch_size: int = 0, zones: int = 2, latency: float = 0, error_rate: float = 0,
+                  api_rate_limit: float = 0) -> Dict:
+    """Run the merge workflow once against a new stand-in.
+
+    args:
+        rows (int): Number of merges.
+        backend (str): Merge backend. Default is 'http'.
+        zone_workers (int): Number of zones processed concurrently. Default is 1.
+        zone_sessions (int): Number of sessions per zone. Default is 1.
+        batch_size (int): Number of merges per merge job, 0 for one job per row. Default is 0.
+        zones (int): Number of zones of the merges. Default is 2.
+        latency (float): Delay added to each UI request in seconds. Default is 0.
+        error_rate (float): Probability of an HTTP 500 on a UI request. Default is 0.
+        api_rate_limit (float): API calls per second of a zone above which the stand-in answers
+            HTTP 429, 0 for no limit. Default is 0.
+
+    returns:
+        Dict: Settings and measures of the run.
+    """
+    import merge
+    from tests.fakealma import FakeAlma
+    from utils.staff import TempStaffUser
+
+    zone_names = list(TempStaffUser.iz_info['iz_codes'])[:zones]
+    result = {'rows': rows, 'backend': backend, 'zone_workers': zone_workers, 'zone_sessions': zone_sessions,
+              'batch_size': batch_size, 'zones': zones, 'latency': latency, 'error_rate': error_rate,
+              'api_rate_limit': api_rate_limit}
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeAlma(latency, error_rate, api_rate_limit=api_rate_limit) as alma, alma.install(zone_names):
+        # The workflow writes its logs and journal to the 'log' directory of the working directory
+        os.chdir(tmp_dir)
+        try:
+            os.mkdir('log')
+            file_path = os.path.join(tmp_dir, 'bench.csv')
+            generate_input(alma, file_path, rows, zone_names)
+
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                merge.workflow(file_path, zone_workers=zone_workers, zone_sessions=zone_sessions,
+                               backend=backend, batch_size=batch_size)
+            wall_time = time.perf_counter() - start
+
+            statuses = pd.read_csv(file_path, dtype=str)['Merge_status']
+            with open(os.path.join('log', 'log_bench.txt')) as f:
+                counts = [tuple(map(int, m.groups())) for m in RESTARTS_PATTERN.finditer(f.read())]
+        finally:
+            logging.getLogger().handlers.clear()
+            os.chdir(cwd)
+
+    merged = int((statuses == 'SUCCESS').sum())
+    result.update({'merged': merged,
+                   'failed': int((statuses == 'FAIL').sum()),
+                   'wall_time': round(wall_time, 2),
+                   'merges_per_sec': round(merged / wall_time, 2),
+                   'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                   'soft_recoveries': sum(soft for soft, _ in counts),
+                   'restarts': sum(restarts for _, restarts in counts),
+                   'ui_requests': sum(n for name, n in alma.request_counts.items() if ' /' in name),
+                   'api_requests': sum(n for name, n in alma.request_counts.items() if ' /' not in name),
+                   'api_throttled': alma.request_counts.get('throttled', 0)})
+    return result
+
+
+def measure_startup(runs: int = 5) -> Dict:
+    """Measure the startup time of the command line and the heavy modules loaded by `import merge`.
+
+    args:
+        runs (int): Number of runs of `python merge.py --help`, the fastest is kept. Default is 5.
+
+    returns:
+        Dict: Fastest startup time in seconds and heavy modules loaded at import.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'merge.py', '--help'], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    code = f'import sys, merge; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', code], cwd=directory, check=True, capture_output=True,
+                            text=True).stdout.strip()
+    return {'startup_time': round(min(times), 3), 'heavy_modules': [m for m in loaded.split(',') if len(m) > 0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the merge workflow against the local Alma stand-in.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000],
+                        help='numbers of merges of the synthetic files (default: 100 1000)')
+    parser.add_argument('--backends', nargs='+', default=['http'],
+                        help='merge backends to compare (default: http)')
+    parser.add_argument('--zone-workers', type=int, nargs='+', default=[1],
+                        help='numbers of zones processed concurrently (default: 1)')
+    parser.add_argument('--zone-sessions', type=int, nargs='+', default=[1],
+                        help='numbers of sessions per zone (default: 1)')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[0],
+                        help='numbers of merges per merge job, 0 for one job per row (default: 0)')
+    parser.add_argument('--zones', type=int, default=2, help='number of zones of the merges (default: 2)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay added to each UI request in seconds (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='probability of an HTTP 500 on a UI request (default: 0)')
+    parser.add_argument('--api-rate-limit', type=float, default=0,
+                        help='API calls per second of a zone above which the stand-in answers HTTP 429 '
+                             '(default: no limit)')
+    parser.add_argument('--output', help='JSON lines file receiving the results')
+    parser.add_argument('--startup', action='store_true',
+                        help='only measure the startup time of the command line')
+    args = parser.parse_args()
+
+    if args.startup:
+        r = measure_startup()
+        print(f'startup: {r["startup_time"]} s, heavy modules loaded at import: '
+              f'{", ".join(r["heavy_modules"]) or "none"}')
+        sys.exit(0)
+
+    from utils.session import check_backend
+
+    header = f'{"rows":>7} {"backend":>8} {"zw":>3} {"zs":>3} {"batch":>5} {"merged":>7} {"wall s":>8} ' \
+             f'{"merges/s":>9} {"peak MB":>8} {"soft":>5} {"restarts":>8}'
+    print(header)
+    for rows, backend, zone_workers, zone_sessions, batch_size in product(
+            args.rows, args.backends, args.zone_workers, args.zone_sessions, args.batch_size):
+        try:
+            check_backend(backend, batch_size)
+        except ValueError as e:
+            print(f'{rows:>7} {backend:>8} {zone_workers:>3} {zone_sessions:>3} {batch_size:>5} skipped: {e}')
+            continue
+        # One process per run, so the peak memory is the one of the run
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            r = executor.submit(run_benchmark, rows, backend, zone_workers, zone_sessions, batch_size,
+                                args.zones, args.latency, args.error_rate, args.api_rate_limit).result()
+        print(f'{r["rows"]:>7} {r["backend"]:>8} {r["zone_workers"]:>3} {r["zone_sessions"]:>3} '
+              f'{r["batch_size"]:>5} {r["merged"]:>7} {r["wall_time"]:>8} {r["merges_per_sec"]:>9} '
+              f'{r["peak_memory_mb"]:>8} {r["soft_recoveries"]:>5} {r["restarts"]:>8}')
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(r) + '\n')
@@ -0,0 +1,333 @@
+"""Service mode of the merge workflow: merge the CSV files dropped in a watched directory.
+
+The browsers, temporary staff accounts and API client are started once and kept
+warm between files, so the merges of a file start as soon as it is picked up.
+The files are merged one at a time, in the order they were dropped, with the
+zones of a file processed concurrently.
+
+Layout of the watched directory:
+    inbox/       CSV files to merge, with from_user, to_user and zone columns. Write them
+                 under another name, for example with a '.part' suffix, and rename them
+                 once complete.
+    processing/  File being merged, and its journal '<name>.jsonl' receiving the outcome
+                 of each merge as soon as it is known. The file is renamed with the time
+                 it was taken from the inbox, '<name>_<YYYYmmdd-HHMMSS>.csv', so a file
+                 dropped again under the same name does not overwrite an earlier one.
+    done/        Merged files with their 'Merge_status' column, and their journal.
+    failed/      Files that could not be read or parsed, or without the required columns.
+
+A file left in 'processing' by a stopped service is resumed first at restart.
+The outcomes are also recorded in the result store shared with `merge.py`, and the
+pairs merged by an earlier file or run are skipped. With `--metrics-port` or
+`--metrics-text-file`, the progress of the files merged since the start of the
+service is exposed live in the Prometheus text format.
+
+Example:
+    python daemon.py /srv/merges --zone-workers 2 --zone-sessions 2
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+import argparse
+import logging
+import os
+import signal
+import threading
+
+from dotenv import load_dotenv
+import pandas as pd
+
+from merge import WarmSessions, merge_zone, setup_logging
+from utils.journal import StatusJournal
+from utils.metrics import MetricsFile, StepTimings
+from utils.progress import MetricsExporter, RunProgress
+from utils.results import MergeResults
+from utils.scheduler import order_zones, parse_weights
+from utils.session import BACKENDS, SessionPool, check_backend
+from utils.staffpool import StaffPool
+from utils.store import ResultStore
+from utils.userapi import UserApiClient, set_client
+
+SUBDIRECTORIES = ['inbox', 'processing', 'done', 'failed']
+REQUIRED_COLUMNS = {'from_user', 'to_user', 'zone'}
+
+
+def pending_files(watch_dir: str) -> List[str]:
+    """Return the files to merge: the ones left in 'processing' first, then the inbox by drop time.
+
+    args:
+        watch_dir (str): Watched directory.
+
+    returns:
+        List[str]: Paths of the CSV files to merge.
+    """
+    files = []
+    for subdirectory in ['processing', 'inbox']:
+        directory = os.path.join(watch_dir, subdirectory)
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv')]
+        files += sorted(paths, key=os.path.getmtime)
+    return files
+
+
+def takeover_name(watch_dir: str, name: str) -> str:
+    """Return the name of a file taken from the inbox, unique among the files and journals of the directory.
+
+    args:
+        watch_dir (str): Watched directory.
+        name (str): Name of the file in the inbox.
+
+    returns:
+        str: Name with the current time, and a counter if a file already has this name.
+    """
+    stem, extension = os.path.splitext(name)
+    stem = f'{stem}_{datetime.now().strftime("%Y%m%d-%H%M%S")}'
+    candidate, counter = f'{stem}{extension}', 0
+    while any(os.path.exists(os.path.join(watch_dir, subdirectory, taken))
+              for subdirectory in SUBDIRECTORIES
+              for taken in [candidate, f'{os.path.splitext(candidate)[0]}.jsonl']):
+        counter += 1
+        candidate = f'{stem}_{counter}{extension}'
+    return candidate
+
+
+def read_file(file_path: str) -> pd.DataFrame:
+    """Read a whole merge file and check its columns, before any merge is started.
+
+    args:
+        file_path (str): Path of the CSV file.
+
+    returns:
+        pd.DataFrame: Rows of the file, with the 'Merge_status' and 'Merge_job_id' columns.
+
+    raises:
+        pd.errors.ParserError: If the file is not a valid CSV file.
+        pd.errors.EmptyDataError: If the file is empty.
+        UnicodeDecodeError: If the file is not UTF-8 text.
+        KeyError: If a column is missing.
+    """
+    df = pd.read_csv(file_path, dtype=str)
+    missing = REQUIRED_COLUMNS - set(df.columns)
+    if len(missing) > 0:
+        raise KeyError(f'missing columns {", ".join(sorted(missing))}')
+    if 'Merge_status' not in df.columns:
+        df['Merge_status'] = 'NOT PROCESSED'
+    if 'Merge_job_id' not in df.columns:
+        df['Merge_job_id'] = None
+    return df
+
+
+def merge_file(file_path: str, df: pd.DataFrame, executor: ThreadPoolExecutor, warm: WarmSessions,
+               timings: Dict[str, StepTimings],
+               metrics_file: Optional[MetricsFile] = None, api_workers: int = 4, batch_size: int = 0,
+               zone_weights: Optional[Dict[str, float]] = None,
+               store: Optional[ResultStore] = None, progress: Optional[RunProgress] = None) -> Dict[str, int]:
+    """Merge the rows of one file with the warm sessions of the zones.
+
+    The outcomes are appended to the journal next to the file, which is replayed
+    first, so a file interrupted by a stop is resumed where it was. The zones are
+    given to the zone workers in the order of `order_zones`.
+
+    args:
+        file_path (str): Path of the CSV file, in the 'processing' directory.
+        df (pd.DataFrame): Rows of the file, see `read_file`.
+        executor (ThreadPoolExecutor): Executor running the zone workers.
+        warm (WarmSessions): Sessions of the zones kept open between files.
+        timings (Dict[str, StepTimings]): Step durations by zone, completed with the new zones.
+        metrics_file (Optional[MetricsFile]): File receiving the step durations of the new zones. Default is None.
+        api_workers (int): Maximum number of concurrent API calls per zone. Default is 4.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+        zone_weights (Optional[Dict[str, float]]): Weight of the zones, 1 for the zones not listed.
+            Default is None.
+        store (Optional[ResultStore]): Store of the results of all the runs. Default is None.
+        progress (Optional[RunProgress]): Live metrics of the service. Default is None.
+
+    returns:
+        Dict[str, int]: Number of rows of each merge status.
+    """
+    journal = StatusJournal(f'{os.path.splitext(file_path)[0]}.jsonl')
+    results = MergeResults(df, file_path, journal, store, progress)
+    try:
+        restored = results.replay_journal()
+        if restored > 0:
+            logging.info(f'Restored the status of {restored} rows from journal {journal.path}')
+
+        accounts = {zone: data for zone, data in df.groupby('zone')}
+        futures = {}
+        for zone in order_zones(accounts, zone_weights):
+            data = accounts[zone]
+            if zone not in timings:
+                timings[zone] = StepTimings(zone, metrics_file, progress)
+            futures[executor.submit(merge_zone, zone, data, results, api_workers=api_workers,
+                                    timings=timings[zone], pool=warm.pool, batch_size=batch_size,
+                                    warm=warm, store=store)] = zone
+        for future, zone in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.critical(f'Unexpected error while processing zone {zone}: {type(e).__name__} - {e}')
+    finally:
+        results.write_csv()
+        journal.close()
+
+    return results.status_counts()
+
+
+def serve(watch_dir: str, zone_workers: int = 1, zone_sessions: int = 1, share_staff: bool = False,
+          api_workers: int = 4, backend: str = 'selenium', batch_size: int = 0, interval: float = 5,
+          staff_pool_path: Optional[str] = None, staff_rotation_days: float = 7,
+          zone_weights: Optional[Dict[str, float]] = None, max_zone_sessions: Optional[int] = None,
+          store_path: Optional[str] = 'log/results.db', metrics_port: Optional[int] = None,
+          metrics_text_file: Optional[str] = None, log_dir: str = 'log',
+          stop: Optional[threading.Event] = None) -> None:
+    """Merge the files dropped in the inbox of a directory until stopped.
+
+    args:
+        watch_dir (str): Watched directory, its subdirectories are created if needed.
+        zone_workers (int): Number of zones of a file processed concurrently. Default is 1.
+        zone_sessions (int): Number of browser sessions per zone. Default is 1.
+        share_staff (bool): Log in all sessions of a zone with the same temp staff account. Default is False.
+        api_workers (int): Maximum number of concurrent API calls per zone. Default is 4.
+        backend (str): Merge backend, 'selenium' or the experimental 'http'. Default is 'selenium'.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+        interval (float): Time between two scans of the inbox in seconds. Default is 5.
+        staff_pool_path (Optional[str]): JSON file of the pool of staff accounts kept between runs,
+            None to create the accounts at the first file of each zone and delete them at the end.
+            Default is None.
+        staff_rotation_days (float): Age in days after which the passwords of the pool are rotated.
+            Default is 7.
+        zone_weights (Optional[Dict[str, float]]): Weight of the zones, moving them forward and scaling
+            their number of sessions, 1 for the zones not listed. Default is None.
+        max_zone_sessions (Optional[int]): Maximum number of concurrent browser sessions of a zone,
+            None for no limit. Default is None.
+        store_path (Optional[str]): SQLite database of the results of all the runs, None to use none.
+            Default is 'log/results.db'.
+        metrics_port (Optional[int]): Port of the local HTTP endpoint of the live metrics, None for
+            no endpoint. Default is None.
+        metrics_text_file (Optional[str]): Text file rewritten with the live metrics every 15 seconds,
+            None for no file. Default is None.
+        log_dir (str): Directory of the log file 'log_daemon.txt' and of the step durations
+            'metrics_daemon.jsonl', created if needed. Default is 'log'.
+        stop (Optional[threading.Event]): Event stopping the service once the current file is merged.
+            Default is a new one, set by SIGTERM and SIGINT when run from the command line.
+
+    raises:
+        ValueError: If the backend has no batch mode while `batch_size` is set, see `check_backend`.
+    """
+    check_backend(backend, batch_size)
+    load_dotenv()
+    setup_logging('daemon', log_dir)
+    for subdirectory in SUBDIRECTORIES:
+        os.makedirs(os.path.join(watch_dir, subdirectory), exist_ok=True)
+    stop = stop if stop is not None else threading.Event()
+
+    api_client = UserApiClient(pool_size=max(16, zone_workers * api_workers))
+    set_client(api_client)
+    pool = SessionPool(headless=True, backend=backend)
+    staff_pool = StaffPool(staff_pool_path, staff_rotation_days * 24 * 3600) if staff_pool_path is not None else None
+    warm = WarmSessions(pool, zone_sessions, share_staff, staff_pool, zone_weights, max_zone_sessions)
+    metrics_file = MetricsFile(os.path.join(log_dir, 'metrics_daemon.jsonl'))
+    store = ResultStore(store_path) if store_path is not None else None
+    progress = RunProgress() if metrics_port is not None or metrics_text_file is not None else None
+    exporter = MetricsExporter(progress, metrics_text_file, metrics_port).start() if progress is not None else None
+    timings = {}
+
+    logging.info(f'Watching {os.path.join(watch_dir, "inbox")} with {zone_workers} zone worker(s)')
+    try:
+        with ThreadPoolExecutor(max_workers=zone_workers, thread_name_prefix='zone') as executor:
+            while not stop.is_set():
+                for path in pending_files(watch_dir):
+                    name = os.path.basename(path)
+                    if os.path.dirname(path) != os.path.join(watch_dir, 'processing'):
+                        name = takeover_name(watch_dir, name)
+                        os.replace(path, os.path.join(watch_dir, 'processing', name))
+                    processing_path = os.path.join(watch_dir, 'processing', name)
+
+                    logging.info(f'Merging {name}')
+                    try:
+                        df = read_file(processing_path)
+                    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError, KeyError) as e:
+                        logging.error(f'Failed to read {name}: {type(e).__name__} - {e}')
+                        os.replace(processing_path, os.path.join(watch_dir, 'failed', name))
+                        continue
+                    counts = merge_file(processing_path, df, executor, warm, timings, metrics_file, api_workers,
+                                        batch_size, zone_weights, store, progress)
+
+                    journal_name = f'{os.path.splitext(name)[0]}.jsonl'
+                    os.replace(os.path.join(watch_dir, 'processing', journal_name),
+                               os.path.join(watch_dir, 'done', journal_name))
+                    os.replace(processing_path, os.path.join(watch_dir, 'done', name))
+                    logging.info(f'{name} merged: ' + ', '.join(f'{status}: {count}'
+                                                                for status, count in counts.items()))
+                    logging.info(f'User API: {api_client.summary()}')
+                    if stop.is_set():
+                        break
+                stop.wait(interval)
+    finally:
+        warm.close()
+        pool.close()
+        metrics_file.close()
+        if store is not None:
+            store.close()
+        if exporter is not None:
+            exporter.close()
+        set_client(None)
+        api_client.close()
+        logging.info('Service stopped')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the Alma users of the CSV files dropped in a directory.')
+    parser.add_argument('watch_dir', help='directory whose inbox subdirectory is watched')
+    parser.add_argument('--zone-workers', type=int, default=1,
+                        help='number of zones of a file processed concurrently (default: 1)')
+    parser.add_argument('--zone-sessions', type=int, default=1,
+                        help='number of browser sessions merging the rows of a zone (default: 1)')
+    parser.add_argument('--share-staff', action='store_true',
+                        help='log in all sessions of a zone with the same temp staff account')
+    parser.add_argument('--api-workers', type=int, default=4,
+                        help='maximum number of concurrent API calls per zone (default: 4)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='selenium', metavar='BACKEND',
+                        help="merge backend: 'selenium' (default), or the EXPERIMENTAL 'http', replaying the form "
+                             "posts with fields not yet checked against the real Merge Users page")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='number of merges submitted per merge job as an uploaded file, '
+                             '0 for one job per row (default: 0)')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between two scans of the inbox (default: 5)')
+    parser.add_argument('--staff-pool', nargs='?', const='log/staff_pool.json',
+                        help='keep the temp staff accounts between runs in this pool file '
+                             '(default file: log/staff_pool.json)')
+    parser.add_argument('--staff-rotation-days', type=float, default=7,
+                        help='age in days after which the passwords of the staff pool are rotated (default: 7)')
+    parser.add_argument('--zone-weights', type=parse_weights,
+                        help='weights of the zones as ZONE=weight separated by commas, scaling their number of '
+                             'sessions and moving them forward (default: 1 for all zones)')
+    parser.add_argument('--max-zone-sessions', type=int,
+                        help='maximum number of concurrent browser sessions of a zone (default: no limit)')
+    parser.add_argument('--store', default='log/results.db',
+                        help='SQLite database recording the results of all the runs (default: log/results.db)')
+    parser.add_argument('--no-store', action='store_true',
+                        help='do not record the results in the store nor skip the pairs merged by earlier runs')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve the live progress metrics in the Prometheus text format on '
+                             'http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--metrics-text-file',
+                        help='rewrite this file with the live progress metrics every 15 seconds')
+    parser.add_argument('--log-dir', default='log',
+                        help='directory of the log file and of the step durations of the service (default: log)')
+    args = parser.parse_args()
+    try:
+        check_backend(args.backend, args.batch_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+    serve(args.watch_dir, zone_workers=args.zone_workers, zone_sessions=args.zone_sessions,
+          share_staff=args.share_staff, api_workers=args.api_workers, backend=args.backend,
+          batch_size=args.batch_size, interval=args.interval, staff_pool_path=args.staff_pool,
+          staff_rotation_days=args.staff_rotation_days, zone_weights=args.zone_weights,
+          max_zone_sessions=args.max_zone_sessions, store_path=None if args.no_store else args.store,
+          metrics_port=args.metrics_port, metrics_text_file=args.metrics_text_file, log_dir=args.log_dir,
+          stop=stop_event)
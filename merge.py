@@ -1,28 +1,714 @@
+from __future__ import annotations
+
 from dotenv import load_dotenv
-from utils.mergeprocess import AlmaMerger, MergeProcessError, UserNotFoundError
+from utils.lazy import LazyImport
+from utils.mergeprocess import MergeProcessError, UserNotFoundError, internal_blocks
+from utils.preflight import prefetch_users
+from utils.blocks import copy_blocks
+from utils.jobs import FINAL_JOB_STATES, JobPoller, MergeJobTracker
+from utils.journal import StatusJournal, journal_path, read_journal
+from utils.metrics import MetricsFile, StepTimings
+from utils.progress import MetricsExporter, RunProgress
+from utils.pairgraph import InvalidPairError, plan_merges
+from utils.planner import plan, plan_report
+from utils.results import DONE_STATUSES, IN_FLIGHT, RETRY, MergeResults, StreamResults
+from utils.scheduler import order_rows, order_zones, parse_weights, zone_session_count
+from utils.session import BACKENDS, MergeSession, SessionPool, check_backend
 from utils.staff import TempStaffUser
-import pandas as pd
+from utils.staffpool import StaffPool, get_staff_primary_id
+from utils.store import ResultStore
+from utils.streaming import read_zone, scan_zones
+from utils.userapi import ApiQuotaError, ApiThrottledError, UserApiClient, get_client, set_client
+from utils.workqueue import RowQueue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import argparse
+import csv
+import os
+import threading
+import time
 import sys
 import logging
 
-from almapiwrapper.configlog import config_log
-import time
+pd = LazyImport('pandas')
 
-def workflow(file_path: str):
-    """Main workflow to merge users based on an Excel file input.
+MAX_ROW_ATTEMPTS = 2
+
+
+def copy_row_blocks(indexes: List, data: pd.DataFrame, users: Dict, results: MergeResults,
+                    timings: Optional[StepTimings] = None, api_workers: int = 4) -> Dict:
+    """Copy the internal blocks of rows about to be merged, except the ones already copied.
+
+    The copy of each row is recorded in the journal, so a resumed run or a retry pass
+    does not copy its blocks again. The copy itself skips the blocks already on the
+    'to' users, see `copy_blocks`, so a copy interrupted by a crash before its record
+    does not duplicate them.
 
     args:
-        file_path (str): Path to the Excel file containing merge instructions.
+        indexes (List): Indexes of the rows about to be merged.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        users (Dict): Prefetched User objects by primary ID.
+        results (MergeResults): Shared store of the merge statuses.
+        timings (Optional[StepTimings]): Collection receiving the duration of the copies. Default is None.
+        api_workers (int): Maximum number of concurrent API calls. Default is 4.
+
+    returns:
+        Dict: Error of the rows whose blocks could not be copied, by row index. These rows must not be merged.
     """
-    import os
-    load_dotenv()
+    rows = {i: (data.at[i, 'from_user'], data.at[i, 'to_user']) for i in indexes if not results.blocks_copied(i)}
+    rows = {i: pair for i, pair in rows.items() if len(internal_blocks(users[pair[0]])) > 0}
+    if len(rows) == 0:
+        return {}
+
+    errors = copy_blocks(rows, users, data.at[next(iter(rows)), 'zone'], api_workers, timings)
+    for i in rows:
+        if i not in errors:
+            results.set_blocks_copied(i)
+    return errors
+
+
+def run_session(session: MergeSession, rows: RowQueue, data: pd.DataFrame, users: Dict,
+                results: MergeResults, attempts: Dict, poller: Optional[JobPoller] = None,
+                max_attempts: int = 3):
+    """Merge rows taken from the zone queue until it is drained.
+
+    When a merge fails, the session is recovered and the row is marked as failed.
+    A merge failed with a transient error, like a timeout, is marked RETRY instead,
+    for a retry pass of the zone, until it reaches `max_attempts`. A merge stopped
+    by the API throttling is left NOT PROCESSED for the next run, without recovering
+    the session, as the browser is not at fault. Once the API quota is reached, the row
+    and the rows still in the queue are left NOT PROCESSED for the next run and the
+    sessions of the zone stop. If the session cannot be recovered, it stops and its
+    in-flight row, if failed with a transient error, is put back in the queue for the
+    other sessions of the zone. With a job poller, a started merge is SUBMITTED and the
+    poller sets its final status later.
+
+    args:
+        session (MergeSession): Started session used for the merges.
+        rows (RowQueue): Queue of the rows of the zone.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        users (Dict): Prefetched User objects by primary ID.
+        results (MergeResults): Shared store of the merge statuses.
+        attempts (Dict): Number of attempts per row, shared by the sessions of the zone.
+        poller (Optional[JobPoller]): Poller following the merge jobs. Default is None.
+        max_attempts (int): Maximum number of attempts of a row failing with transient errors. Default is 3.
+    """
+    while (i := rows.get()) is not None:
+        row = data.loc[i]
+        from_user = row['from_user']
+        to_user = row['to_user']
+        attempts[i] = attempts.get(i, 0) + 1
+
+        logging.info(f'Processing {row["zone"]} ({len(data) - len(rows)}/{len(data)} - row {i}): '
+                     f'from {from_user} to {to_user}')
+
+        try:
+            # Checkpoint: if the run dies before the outcome is recorded, the next run checks the row
+            results.set_status(i, IN_FLIGHT)
+            # The internal blocks are already copied by `merge_rows`
+            job_id = session.merger.merge_users(from_user, to_user, users[from_user], users[to_user], False)
+            if poller is not None:
+                poller.track(i, row['zone'], from_user, job_id)
+            else:
+                results.set_status(i, 'SUCCESS', job_id=job_id)
+            rows.done(i)
+        except UserNotFoundError as e:
+            logging.warning(f'Merge skipped due to user not found: merge {from_user} into {to_user}')
+            results.set_status(i, 'FAIL', error=e)
+            rows.done(i)
+        except ApiQuotaError as e:
+            results.set_status(i, 'NOT PROCESSED', error=e)
+            rows.done(i)
+            left = rows.close()
+            logging.critical(f'Merges of {row["zone"]} stopped: {e}. {len(left) + 1} rows left for the next run')
+            return
+        except ApiThrottledError as e:
+            logging.warning(f'Merge postponed due to API throttling: merge {from_user} into {to_user}')
+            results.set_status(i, 'NOT PROCESSED', error=e)
+            rows.done(i)
+        except MergeProcessError as e:
+            logging.error(f'Failed to merge {from_user} into {to_user}: '
+                          f'{"transient" if e.transient else "permanent"} error at {e.step} ({e.cause})')
+            status = RETRY if e.transient and attempts[i] < max_attempts else 'FAIL'
+            try:
+                session.recover()
+            except MergeProcessError:
+                logging.critical(f'Failed to re-initialize AlmaMerger after error for zone {row["zone"]}: '
+                                 f'session stopped')
+                # A row failed with a permanent error may have a merge job running: it is never sent again
+                if status == RETRY and attempts[i] < MAX_ROW_ATTEMPTS:
+                    rows.requeue(i)
+                else:
+                    results.set_status(i, status, error=e)
+                    rows.done(i)
+                return
+            if status == RETRY:
+                logging.warning(f'Merge deferred to the retry pass: merge {from_user} into {to_user}')
+            else:
+                logging.error(f'Merge skipped due to error: merge {from_user} into {to_user}')
+            results.set_status(i, status, error=e)
+            rows.done(i)
+
+
+def run_batch_session(session: MergeSession, batches: List[List], queue: RowQueue, data: pd.DataFrame,
+                      users: Dict, results: MergeResults, tracker: MergeJobTracker, api_workers: int = 4,
+                      poller: Optional[JobPoller] = None, attempts: Optional[Dict] = None, max_attempts: int = 3):
+    """Submit batches of merges taken from the zone queue, each as one merge job.
+
+    Once the job is finished, each row gets its own status according
+    to whether its 'from' user was merged. A row whose 'from' user could not be
+    looked up is left SUBMITTED, to be followed by a later run with `track_jobs`.
+    With a job poller, the rows of the batch
+    are SUBMITTED and the session goes on with the next batch without waiting. The
+    rows of a batch whose submission failed with a transient error are marked RETRY,
+    until they reach `max_attempts`.
+
+    args:
+        session (MergeSession): Started session used for the submissions.
+        batches (List[List]): Indexes of the rows of each batch.
+        queue (RowQueue): Queue of the batch numbers of the zone.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        users (Dict): Prefetched User objects by primary ID.
+        results (MergeResults): Shared store of the merge statuses.
+        tracker (MergeJobTracker): Tracker of the merge jobs of the zone.
+        api_workers (int): Maximum number of concurrent API calls. Default is 4.
+        poller (Optional[JobPoller]): Poller following the merge jobs. Default is None.
+        attempts (Optional[Dict]): Number of attempts per row, shared by the sessions of the zone.
+            Default is a new one.
+        max_attempts (int): Maximum number of attempts of a row failing with transient errors. Default is 3.
+    """
+    attempts = attempts if attempts is not None else {}
+    while (batch_nb := queue.get()) is not None:
+        batch = batches[batch_nb]
+        logging.info(f'Submitting batch {batch_nb + 1}/{len(batches)}: {len(batch)} merges')
+        for i in batch:
+            attempts[i] = attempts.get(i, 0) + 1
+            results.set_status(i, IN_FLIGHT)
+        pairs = [(data.at[i, 'from_user'], data.at[i, 'to_user']) for i in batch]
+        try:
+            job_id = session.merger.merge_users_batch(pairs)
+        except MergeProcessError as e:
+            logging.error(f'Failed to submit batch {batch_nb + 1}/{len(batches)}: '
+                          f'{"transient" if e.transient else "permanent"} error at {e.step} ({e.cause})')
+            for i in batch:
+                results.set_status(i, RETRY if e.transient and attempts[i] < max_attempts else 'FAIL', error=e)
+            queue.done(batch_nb)
+            try:
+                session.recover()
+            except MergeProcessError:
+                logging.critical(f'Failed to re-initialize AlmaMerger after error: session stopped')
+                return
+            continue
+
+        # The merge changes the users in Alma
+        for from_user, to_user in pairs:
+            get_client().invalidate(from_user, tracker.zone, tracker.env)
+            get_client().invalidate(to_user, tracker.zone, tracker.env)
+
+        if poller is not None:
+            for i in batch:
+                poller.track(i, data.at[i, 'zone'], data.at[i, 'from_user'], job_id)
+            logging.info(f'Batch {batch_nb + 1}/{len(batches)} submitted as merge job {job_id}')
+            queue.done(batch_nb)
+            continue
+
+        merged = tracker.wait_for_merges(job_id, [from_user for from_user, _ in pairs], api_workers)
+        for i in batch:
+            done = merged[data.at[i, 'from_user']]
+            if done is None:
+                # The 'from' user could not be looked up, the merge is checked again by a later run
+                logging.warning(f'Outcome of the merge of {data.at[i, "from_user"]} by job {job_id} unknown: '
+                                f'row left SUBMITTED')
+                results.set_status(i, 'SUBMITTED', job_id=job_id)
+            else:
+                results.set_status(i, 'SUCCESS' if done else 'FAIL', job_id=job_id)
+        logging.info(f'Batch {batch_nb + 1}/{len(batches)} done: {sum(done is True for done in merged.values())}/'
+                     f'{len(pairs)} merged')
+        queue.done(batch_nb)
+
+
+def skip_merged(zone: str, data: pd.DataFrame, results: MergeResults, store: ResultStore) -> int:
+    """Mark the rows whose pair was merged by an earlier run, without any API call.
+
+    The rows get the status and job ID recorded by the run that merged their pair.
+
+    args:
+        zone (str): Zone of the users to merge.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        results (MergeResults): Shared store of the merge statuses.
+        store (ResultStore): Store of the results of all the runs.
+
+    returns:
+        int: Number of rows marked as merged.
+    """
+    pending = data.loc[~results.get_statuses(data.index).isin(DONE_STATUSES).values]
+    merged = store.merged_pairs(zone, pending['from_user'])
+    skipped = 0
+    for i, from_user, to_user in zip(pending.index, pending['from_user'], pending['to_user']):
+        if (from_user, to_user) in merged:
+            status, job_id = merged[(from_user, to_user)]
+            results.set_status(i, status, job_id=job_id)
+            skipped += 1
+
+    if skipped > 0:
+        logging.info(f'{skipped} merges of {zone} skipped: already merged by an earlier run')
+    return skipped
+
+
+def check_pairs(zone: str, data: pd.DataFrame, results: MergeResults) -> pd.DataFrame:
+    """Resolve the merge graph of the rows of a zone, before any API call or browser work.
+
+    Self-merges, duplicates, conflicting merges and cycles are rejected with their own
+    status. Chains of merges are collapsed: the returned rows have their final target
+    as 'to' user, which is also recorded in the 'Merge_target' column of the results.
+
+    args:
+        zone (str): Zone of the users to merge.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        results (MergeResults): Shared store of the merge statuses.
+
+    returns:
+        pd.DataFrame: Rows already merged and rows to merge, with their final target.
+    """
+    done = results.get_statuses(data.index).isin(DONE_STATUSES).values
+    pending = data.loc[~done]
+    targets, rejected = plan_merges(
+        dict(zip(pending.index, zip(pending['from_user'], pending['to_user']))),
+        zip(data.loc[done, 'from_user'], data.loc[done, 'to_user']))
+
+    for i, (status, reason) in rejected.items():
+        logging.warning(f'Merge rejected ({status}): merge {data.at[i, "from_user"]} into {data.at[i, "to_user"]} '
+                        f'- {reason}')
+        results.set_status(i, status, error=InvalidPairError(reason))
+
+    data = data.loc[~data.index.isin(list(rejected))].copy()
+    targets = pd.Series(targets, index=list(targets), dtype=object)
+    collapsed = targets.loc[targets.values != data.loc[targets.index, 'to_user'].values]
+    for i, to_user in collapsed.items():
+        results.set_target(i, to_user)
+    data.loc[collapsed.index, 'to_user'] = collapsed
+
+    if len(rejected) > 0 or len(collapsed) > 0:
+        logging.info(f'Merge graph of {zone}: {len(rejected)} rows rejected, {len(collapsed)} chained merges '
+                     f'redirected to their final target.')
+
+    return data
+
+
+def check_users(zone: str, data: pd.DataFrame, results: MergeResults, api_workers: int = 4,
+                timings: Optional[StepTimings] = None) -> Tuple[List, Dict]:
+    """Check with the Alma API that the users of the rows still to merge exist.
+
+    Rows with a missing user are marked as failed before any browser is started. Rows whose
+    users cannot be fetched as the API is still throttling or its quota is reached are left
+    NOT PROCESSED.
+
+    Rows left IN_FLIGHT by a run that died during their submission are reconciled
+    with the same API calls: if the 'from' user does not exist anymore, the merge
+    was done and the row is marked as SUCCESS. Otherwise the merge jobs of the zone
+    are looked up: the ID of the job submitted by the dead run was never recorded,
+    so while any merge job of the zone is still running, the row is left IN_FLIGHT
+    for the next run instead of being merged twice. Without the job states (no
+    ALMA_MERGE_JOB_ID), the row is merged again.
+
+    args:
+        zone (str): Zone of the users to merge.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        results (MergeResults): Shared store of the merge statuses.
+        api_workers (int): Maximum number of concurrent API calls. Default is 4.
+        timings (Optional[StepTimings]): Collection receiving the duration of the API calls. Default is None.
+
+    returns:
+        Tuple[List, Dict]: Indexes of the rows to merge and prefetched User objects by primary ID.
+    """
+    # Skip already merged rows
+    pending_data = data.loc[~results.get_statuses(data.index).isin(DONE_STATUSES).values]
+    pending = pending_data.index
+    users = prefetch_users(list(pending_data['from_user']) + list(pending_data['to_user']),
+                           zone, os.getenv('ALMA_ENV', 'P'), max_workers=api_workers, timings=timings)
+
+    open_jobs = None
+    valid = []
+    throttled = 0
+    reconciled = 0
+    running = 0
+    for i, row in pending_data.iterrows():
+        if results.get_status(i) == IN_FLIGHT and isinstance(users[row['from_user']], UserNotFoundError):
+            logging.info(f'Merge of row {i} found done after an interrupted run: '
+                         f'{row["from_user"]} does not exist anymore')
+            results.set_status(i, 'SUCCESS')
+            reconciled += 1
+            continue
+        if any(isinstance(users[primary_id], (ApiThrottledError, ApiQuotaError))
+               for primary_id in (row['from_user'], row['to_user'])):
+            # Left with its status for the next run
+            throttled += 1
+            continue
+        errors = [users[primary_id] for primary_id in (row['from_user'], row['to_user'])
+                  if isinstance(users[primary_id], UserNotFoundError)]
+        if len(errors) > 0:
+            logging.warning(f'Merge skipped due to user not found: merge {row["from_user"]} into {row["to_user"]}')
+            results.set_status(i, 'FAIL', error=errors[0])
+            continue
+        if results.get_status(i) == IN_FLIGHT:
+            if open_jobs is None:
+                states = MergeJobTracker(zone, os.getenv('ALMA_ENV', 'P')).get_states()
+                open_jobs = [job_id for job_id, state in states.items() if state not in FINAL_JOB_STATES]
+            if len(open_jobs) > 0:
+                logging.warning(f'Merge of row {i} left IN_FLIGHT: {row["from_user"]} still exists, but merge '
+                                f'jobs {", ".join(open_jobs)} of the interrupted run may still be running')
+                running += 1
+                continue
+        valid.append(i)
+
+    logging.info(f'Pre-validation of {zone}: {len(valid)} valid pairs, '
+                 f'{len(pending) - len(valid) - throttled - reconciled - running} with missing users, '
+                 f'{throttled} postponed due to API throttling or quota, {len(data) - len(pending)} already merged, '
+                 f'{reconciled} found merged and {running} left pending after an interrupted run.')
+
+    return valid, users
+
+
+def open_sessions(zone: str, zone_sessions: int = 1, share_staff: bool = False,
+                  timings: Optional[StepTimings] = None, pool: Optional[SessionPool] = None,
+                  staff_pool: Optional[StaffPool] = None) -> Tuple[List[TempStaffUser], List[MergeSession]]:
+    """Create or lease the temporary staff accounts of a zone and take their sessions from the pool.
+
+    Once the API quota is reached, or while the API is throttling, no more account is
+    created and the zone is merged with the sessions of the accounts created so far.
+
+    args:
+        zone (str): Zone of the users to merge.
+        zone_sessions (int): Number of browser sessions of the zone. Default is 1.
+        share_staff (bool): Log in all sessions with the same temp staff account. Default is False.
+        timings (Optional[StepTimings]): Collection receiving the step durations. Default is None.
+        pool (Optional[SessionPool]): Pool of browser sessions shared by the zones.
+        staff_pool (Optional[StaffPool]): Pool of staff accounts kept between runs, None to create
+            the accounts for this run. Default is None.
+
+    returns:
+        Tuple[List[TempStaffUser], List[MergeSession]]: Staff accounts and started sessions.
+    """
+    start = time.perf_counter()
+    staff_accounts = []
+    for session_nb in range(1 if share_staff else zone_sessions):
+        if staff_pool is not None:
+            temp_staff = staff_pool.lease(zone)
+            if temp_staff is not None:
+                staff_accounts.append(temp_staff)
+            continue
+        try:
+            temp_staff = TempStaffUser(get_staff_primary_id(zone, session_nb), zone).create_staff_account()
+        except (ApiQuotaError, ApiThrottledError) as e:
+            logging.error(f'Failed to create temp staff account for {zone}: {e}')
+            break
+        if temp_staff.temp_user.error is True:
+            logging.error(f'Failed to create temp staff account {temp_staff.primary_id} for {zone}')
+            continue
+        staff_accounts.append(temp_staff)
+
+    sessions = []
+    for session_nb in range(zone_sessions if len(staff_accounts) > 0 else 0):
+        try:
+            sessions.append(pool.acquire(staff_accounts[session_nb % len(staff_accounts)], timings))
+        except MergeProcessError:
+            logging.error(f'Failed to initialize AlmaMerger session {session_nb} for zone {zone}')
+
+    if timings is not None:
+        timings.record('open_sessions', time.perf_counter() - start, ok=len(sessions) > 0)
+    return staff_accounts, sessions
 
-    file_name = os.path.splitext(os.path.basename(file_path))[0]
 
+def close_sessions(staff_accounts: List[TempStaffUser], sessions: List[MergeSession], pool: SessionPool,
+                   staff_pool: Optional[StaffPool] = None):
+    """Give the sessions of a zone back to the pool and delete or release its temporary staff accounts.
+
+    A failed deletion is logged and the next accounts are still deleted.
+
+    args:
+        staff_accounts (List[TempStaffUser]): Staff accounts of the zone.
+        sessions (List[MergeSession]): Sessions of the zone.
+        pool (SessionPool): Pool of browser sessions shared by the zones.
+        staff_pool (Optional[StaffPool]): Pool the staff accounts were leased from, None to delete
+            them. Default is None.
+    """
+    for session in sessions:
+        logging.info(f'Session {session.temp_staff.primary_id}: {session.soft_recoveries} soft recoveries, '
+                     f'{session.restarts} browser restarts')
+        pool.release(session)
+    for temp_staff in staff_accounts:
+        if staff_pool is not None:
+            staff_pool.release(temp_staff)
+            continue
+        try:
+            temp_staff.delete()
+        except Exception as e:
+            logging.error(f'Failed to delete temp staff account {temp_staff.primary_id}: {type(e).__name__} - {e}')
+
+
+class WarmSessions:
+    """Staff accounts and browser sessions of the zones, kept open from one input file to the next.
+
+    Used by the service mode: the first file of a zone opens its sessions, the next
+    files reuse them after a quick check on the Merge Users page, so their merges
+    start without staff account creation, browser start or login. Stopped sessions
+    are replaced when their zone is processed again.
+    """
+    def __init__(self, pool: SessionPool, zone_sessions: int = 1, share_staff: bool = False,
+                 staff_pool: Optional[StaffPool] = None, weights: Optional[Dict[str, float]] = None,
+                 max_zone_sessions: Optional[int] = None):
+        """
+        Initialize the collection, without any session.
+
+        args:
+            pool (SessionPool): Pool of browser sessions.
+            zone_sessions (int): Number of browser sessions per zone. Default is 1.
+            share_staff (bool): Log in all sessions of a zone with the same temp staff account. Default is False.
+            staff_pool (Optional[StaffPool]): Pool of staff accounts kept between runs, None to create
+                the accounts and delete them on `close`. Default is None.
+            weights (Optional[Dict[str, float]]): Weight of the zones scaling their number of sessions,
+                1 for the zones not listed. Default is None.
+            max_zone_sessions (Optional[int]): Maximum number of sessions of a zone. Default is no limit.
+        """
+        self.pool = pool
+        self.zone_sessions = zone_sessions
+        self.weights = weights
+        self.max_zone_sessions = max_zone_sessions
+        self.share_staff = share_staff
+        self.staff_pool = staff_pool
+        self._zones: Dict[str, Tuple[List[TempStaffUser], List[MergeSession]]] = {}
+        self._zone_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, zone: str, timings: Optional[StepTimings] = None) -> List[MergeSession]:
+        """Return the started sessions of a zone, opening them on first use.
+
+        Args:
+            zone (str): Zone of the sessions.
+            timings (Optional[StepTimings]): Collection receiving the step durations of new sessions.
+                Default is None.
+
+        Returns:
+            List[MergeSession]: Sessions of the zone ready on the Merge Users page, empty if none could be started.
+        """
+        with self._lock:
+            zone_lock = self._zone_locks.setdefault(zone, threading.Lock())
+
+        zone_sessions = zone_session_count(zone, self.zone_sessions, self.weights, self.max_zone_sessions)
+        with zone_lock:
+            staff_accounts, sessions = self._zones.get(zone, ([], []))
+            if len(staff_accounts) == 0:
+                staff_accounts, sessions = open_sessions(zone, zone_sessions, self.share_staff, timings,
+                                                         self.pool, self.staff_pool)
+            else:
+                ready = []
+                for session in sessions:
+                    try:
+                        # The Alma session of the staff user may have expired since the last file
+                        session.merger.reset_page()
+                        ready.append(session)
+                    except Exception as e:
+                        logging.warning(f'Warm session of {zone} not usable anymore: {type(e).__name__}')
+                        try:
+                            ready.append(session.restart())
+                        except MergeProcessError:
+                            logging.error(f'Failed to restart a session of zone {zone}')
+                for session_nb in range(len(ready), zone_sessions):
+                    try:
+                        ready.append(self.pool.acquire(staff_accounts[session_nb % len(staff_accounts)], timings))
+                    except MergeProcessError:
+                        logging.error(f'Failed to initialize AlmaMerger session {session_nb} for zone {zone}')
+                sessions = ready
+
+            self._zones[zone] = (staff_accounts, sessions)
+            return sessions
+
+    def close(self) -> None:
+        """Close the sessions of all zones and delete or release their staff accounts."""
+        with self._lock:
+            zones, self._zones = self._zones, {}
+        for staff_accounts, sessions in zones.values():
+            close_sessions(staff_accounts, sessions, self.pool, self.staff_pool)
+
+
+def merge_rows(zone: str, data: pd.DataFrame, valid: List, users: Dict, sessions: List[MergeSession],
+               results: MergeResults, api_workers: int = 4, batch_size: int = 0,
+               poller: Optional[JobPoller] = None, attempts: Optional[Dict] = None, max_attempts: int = 3,
+               timings: Optional[StepTimings] = None):
+    """Merge rows of a zone with its sessions, each session in its own thread.
+
+    The internal blocks of the 'from' users are first copied to their 'to' users with
+    the API, see `copy_row_blocks`, so the sessions only do the UI work. The blocks of
+    a row are copied once, even across a crash or the retry passes. A row whose blocks
+    could not be copied is not merged: it fails, or is left NOT PROCESSED if the API is
+    throttling. Once the API quota is reached, no row of the zone is merged.
+
+    args:
+        zone (str): Zone of the users to merge.
+        data (pd.DataFrame): Rows of the input file belonging to the zone.
+        valid (List): Indexes of the rows to merge.
+        users (Dict): Prefetched User objects by primary ID.
+        sessions (List[MergeSession]): Started sessions of the zone.
+        results (MergeResults): Shared store of the merge statuses.
+        api_workers (int): Maximum number of concurrent API calls. Default is 4.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+        poller (Optional[JobPoller]): Poller following the merge jobs. Default is None.
+        attempts (Optional[Dict]): Number of attempts per row, kept between the retry passes. Default is a new one.
+        max_attempts (int): Maximum number of attempts of a row failing with transient errors. Default is 3.
+        timings (Optional[StepTimings]): Collection receiving the duration of the block copies. Default is None.
+    """
+    attempts = attempts if attempts is not None else {}
+    errors = copy_row_blocks(valid, data, users, results, timings, api_workers)
+    quota = [e for e in errors.values() if isinstance(e, ApiQuotaError)]
+    if len(quota) > 0:
+        for i, e in errors.items():
+            results.set_status(i, 'NOT PROCESSED', error=e)
+        logging.critical(f'Merges of {zone} stopped: {quota[0]}. {len(valid)} rows left for the next run')
+        return
+    for i, e in errors.items():
+        if isinstance(e, ApiThrottledError):
+            logging.warning(f'Merge postponed due to API throttling: merge {data.at[i, "from_user"]} '
+                            f'into {data.at[i, "to_user"]}')
+            results.set_status(i, 'NOT PROCESSED', error=e)
+        else:
+            logging.error(f'Merge skipped due to error while copying the internal blocks: '
+                          f'merge {data.at[i, "from_user"]} into {data.at[i, "to_user"]}')
+            results.set_status(i, 'FAIL', error=e)
+    valid = [i for i in valid if i not in errors]
+
+    if batch_size > 0:
+        batches = [valid[start:start + batch_size] for start in range(0, len(valid), batch_size)]
+        queue = RowQueue(range(len(batches)))
+        tracker = MergeJobTracker(zone, os.getenv('ALMA_ENV', 'P'))
+        threads = [threading.Thread(target=run_batch_session,
+                                    args=(session, batches, queue, data, users, results, tracker, api_workers,
+                                          poller, attempts, max_attempts),
+                                    name=f'{zone}-{session_nb}')
+                   for session_nb, session in enumerate(sessions)]
+    else:
+        rows = RowQueue(valid)
+        threads = [threading.Thread(target=run_session,
+                                    args=(session, rows, data, users, results, attempts, poller, max_attempts),
+                                    name=f'{zone}-{session_nb}')
+                   for session_nb, session in enumerate(sessions)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def merge_zone(zone: str, data: Union[pd.DataFrame, Iterable[pd.DataFrame]], results: MergeResults,
+               zone_sessions: int = 1, share_staff: bool = False, api_workers: int = 4,
+               timings: Optional[StepTimings] = None, pool: Optional[SessionPool] = None, batch_size: int = 0,
+               poller: Optional[JobPoller] = None, staff_pool: Optional[StaffPool] = None,
+               warm: Optional[WarmSessions] = None, max_attempts: int = 3, store: Optional[ResultStore] = None):
+    """Merge all the users of one zone.
+
+    The rows whose pair was merged by an earlier run are first skipped, see
+    `skip_merged`, then the merge graph of the zone is resolved, see `check_pairs`,
+    and the users are checked with the Alma API. The worker then owns
+    its temporary staff accounts and takes browser sessions from the pool, so several
+    zones can be processed at the same time. The rows of the zone are shared by
+    `zone_sessions` browser sessions draining a common queue. With `batch_size`,
+    the queue holds batches of rows, each submitted as one merge job. Log messages
+    are tagged with the zone and session through the name of the worker threads.
+
+    The rows can also be given as chunks, read lazily from a large file: each chunk
+    is checked and merged in turn with the same sessions, which are only opened
+    once a chunk has rows to merge. The merge graph is then resolved per chunk.
+
+    The rows are merged by decreasing `priority` and increasing `deadline`, when the
+    input file has these columns, see `order_rows`.
+
+    The merges failed with a transient error are retried once the other rows are
+    merged, in up to `max_attempts - 1` retry passes with the same sessions. The
+    users of a retried row are checked again with the API before its merge.
+
+    args:
+        zone (str): Zone of the users to merge.
+        data (Union[pd.DataFrame, Iterable[pd.DataFrame]]): Rows of the input file belonging to the zone,
+            or chunks of these rows.
+        results (MergeResults): Shared store of the merge statuses.
+        zone_sessions (int): Number of browser sessions of the zone. Default is 1.
+        share_staff (bool): Log in all sessions with the same temp staff account. Default is False.
+        api_workers (int): Maximum number of concurrent API calls of the pre-validation. Default is 4.
+        timings (Optional[StepTimings]): Collection receiving the step durations. Default is a new one.
+        pool (Optional[SessionPool]): Pool of browser sessions shared by the zones. Default is a new one.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+        poller (Optional[JobPoller]): Poller following the merge jobs, None to mark the rows
+            as SUCCESS once their job is started. Default is None.
+        staff_pool (Optional[StaffPool]): Pool of staff accounts kept between runs, None to create
+            and delete the accounts of the zone. Default is None.
+        warm (Optional[WarmSessions]): Sessions kept open between input files, used instead of
+            opening and closing the sessions of the zone. Default is None.
+        max_attempts (int): Maximum number of attempts of a row failing with transient errors. Default is 3.
+        store (Optional[ResultStore]): Store of the results of all the runs, used to skip the pairs already
+            merged. Default is None.
+    """
+    threading.current_thread().name = zone
+
+    if timings is None:
+        timings = StepTimings(zone)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = SessionPool(headless=True)
+
+    staff_accounts, sessions = None, None
+    try:
+        for chunk in ([data] if isinstance(data, pd.DataFrame) else data):
+            logging.info(f'Processing {zone}: {len(chunk)} merges to perform.')
+            if results.progress is not None:
+                results.progress.add_rows(zone, results.get_statuses(chunk.index))
+            if store is not None:
+                skip_merged(zone, chunk, results, store)
+            chunk = check_pairs(zone, chunk, results)
+            valid, users = check_users(zone, chunk, results, api_workers, timings)
+            if len(valid) == 0:
+                continue
+            valid = order_rows(chunk, valid)
+
+            if sessions is None and warm is not None:
+                sessions = warm.get(zone, timings)
+            elif sessions is None:
+                staff_accounts, sessions = open_sessions(zone, zone_sessions, share_staff, timings, pool,
+                                                         staff_pool)
+            if len(sessions) == 0:
+                logging.error(f'No session available for zone {zone}: users of the zone will not be merged')
+                break
+
+            attempts = {}
+            merge_rows(zone, chunk, valid, users, sessions, results, api_workers, batch_size, poller, attempts,
+                       max_attempts, timings)
+            for retry_pass in range(1, max_attempts):
+                retry = chunk.loc[results.get_statuses(chunk.index).values == RETRY]
+                sessions = [session for session in sessions if session.merger is not None]
+                if len(retry) == 0 or len(sessions) == 0:
+                    break
+                logging.info(f'Retry pass {retry_pass} of {zone}: {len(retry)} merges failed with a transient error')
+                valid, users = check_users(zone, retry, results, api_workers, timings)
+                merge_rows(zone, chunk, valid, users, sessions, results, api_workers, batch_size, poller, attempts,
+                           max_attempts, timings)
+    finally:
+        if staff_accounts is not None:
+            close_sessions(staff_accounts, sessions, pool, staff_pool)
+        if own_pool:
+            pool.close()
+
+
+def setup_logging(file_name: str, log_dir: str = 'log') -> None:
+    """Send the logs to `<log_dir>/log_<file_name>.txt` and to the standard output.
+
+    args:
+        file_name (str): Name of the input file without extension.
+        log_dir (str): Directory of the log file, created if needed. Default is 'log'.
+    """
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    message_format = "%(asctime)s - %(levelname)s - %(message)s"
-    log_file_name = f'log/log{"" if len(file_name) == 0 else "_"}{file_name}.txt'
+    message_format = "%(asctime)s - %(levelname)s - %(threadName)s - %(message)s"
+    os.makedirs(log_dir, exist_ok=True)
+    log_file_name = os.path.join(log_dir, f'log{"" if len(file_name) == 0 else "_"}{file_name}.txt')
     file_handler = logging.FileHandler(log_file_name)
     file_handler.setFormatter(logging.Formatter(message_format))
     stream_handler = logging.StreamHandler(sys.stdout)
@@ -33,72 +719,317 @@ def workflow(file_path: str):
     logger.addHandler(file_handler)
     logger.addHandler(stream_handler)
 
-    df = pd.read_csv(file_path, dtype=str)
-    if 'Merge_status' not in df.columns:
-        df['Merge_status'] = 'NOT PROCESSED'
-    accounts = {zone: data for zone, data in df.groupby('zone')}
-    logging.info(f'Starting user merge process: {len(df)} accounts to process.')
 
-    nb_zones = len(accounts)
-    zone_nb = 0
-    for zone, data in accounts.items():
-        zone_nb += 1
-        logging.info(f'Processing {zone} ({zone_nb} / {nb_zones} zones): {len(data)} merges to perform.')
-        temp_staff = TempStaffUser(f'automation_{zone.lower()}@slsp.ch', zone).create_staff_account()
+def file_status(file_path: str) -> Dict[str, Dict[str, int]]:
+    """Count the merge statuses of the rows of an input file, by zone.
 
-        if temp_staff.temp_user.error is True:
-            logging.error(f'Failed to create temp staff account for {zone}')
-            continue
+    The statuses recorded in the journal of the file override the ones of the
+    file, like at the start of a run. The file is read row by row with the csv
+    module and the journal is not opened for writing, so the status of a file
+    being merged can be queried quickly, without loading pandas.
 
-        try:
-            merger = AlmaMerger(temp_staff, headless=True)
-            merger.login()
-            merger.open_merge_users_page()
-        except MergeProcessError:
-            logging.error(f'Failed to initialize AlmaMerger for zone {zone}: users of the zone will not be merged')
-            temp_staff.delete()
-            continue
+    args:
+        file_path (str): Path of the input file.
 
-        account_nb = 0
-        for i, row in data.iterrows():
-            from_user = row['from_user']
-            to_user = row['to_user']
-            account_nb += 1
+    returns:
+        Dict[str, Dict[str, int]]: Number of rows of each status, by zone.
+    """
+    entries = read_journal(journal_path(file_path))
+    counts: Dict[str, Dict[str, int]] = {}
+    with open(file_path, newline='', encoding='utf-8') as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            status = row.get('Merge_status') or 'NOT PROCESSED'
+            entry = entries.get(i)
+            if entry is not None and (entry['from_user'], entry['to_user']) == (row['from_user'], row['to_user']):
+                status = entry['status']
+            zone_counts = counts.setdefault(row['zone'], {})
+            zone_counts[status] = zone_counts.get(status, 0) + 1
+    return counts
 
-            # Skip already merged rows
-            if df.at[i, 'Merge_status'] == 'SUCCESS':
-                logging.info(f'Skipping already merged row {i} for {row["zone"]}: from {row["from_user"]} to {row["to_user"]}')
-                continue
 
-            logging.info(f'Processing {row["zone"]} ({account_nb}/{len(data)} - row {i}): from {from_user} to {to_user}')
+def workflow(file_path: str, zone_workers: int = 1, zone_sessions: int = 1, share_staff: bool = False,
+             api_workers: int = 4, backend: str = 'selenium', batch_size: int = 0, sync_only: bool = False,
+             track_jobs: bool = False, poll_interval: float = 30, job_timeout: float = 3600,
+             stream: bool = False, chunk_size: int = 10000, sorted_input: bool = False,
+             user_cache_ttl: float = 600, api_quota: Optional[int] = None, staff_pool_path: Optional[str] = None,
+             staff_rotation_days: float = 7, zone_weights: Optional[Dict[str, float]] = None,
+             max_zone_sessions: Optional[int] = None, max_attempts: int = 3,
+             store_path: Optional[str] = 'log/results.db', metrics_port: Optional[int] = None,
+             metrics_text_file: Optional[str] = None):
+    """Main workflow to merge users based on an Excel file input.
 
-            try:
-                merger.merge_users(from_user, to_user)
-                df.at[i, 'Merge_status'] = 'SUCCESS'
-                df.to_csv(file_path, index=False)
-            except UserNotFoundError:
-                logging.warning(f'Merge skipped due to user not found: merge {from_user} into {to_user}')
-                df.at[i, 'Merge_status'] = 'FAIL'
-                df.to_csv(file_path, index=False)
-                continue
-            except MergeProcessError:
-                logging.error(f'Failed to merge {from_user} into {to_user}')
-                df.at[i, 'Merge_status'] = 'FAIL'
-                df.to_csv(file_path, index=False)
-                merger.driver.quit()
+    The outcome of each merge is appended to the status journal `log/journal_<file>.jsonl`.
+    At start, the journal is replayed over the input file to skip the rows already
+    processed, and the input file is written back once at the end of the run.
+    The duration of each step of the merges is written to `log/metrics_<file>.jsonl`
+    and summarized per zone at the end of the run.
+
+    With `track_jobs`, the merges are SUBMITTED when their job is started and a
+    background poller sets them COMPLETED or FAILED according to the job outcome.
+    The rows left SUBMITTED by a previous run are followed again. The input file is
+    written back once the poller is done, or after `job_timeout` seconds.
+
+    With `stream`, the input file is never loaded at once: each zone worker reads
+    the rows of its zone in chunks of `chunk_size` rows, and the zones are started
+    while the file is scanned, so the first merges start after the first chunk.
+
+    The User API calls of all the workers share one pool of connections and a cache
+    of the user records, see `UserApiClient`, and their number is logged at the end.
+
+    With `staff_pool_path`, the temporary staff accounts are leased from a pool kept
+    between runs, see `StaffPool`, instead of being created and deleted by each run.
+
+    The zones are given to the zone workers by urgency, the zones holding rows of
+    high priority or close deadline first, then by size divided by their weight,
+    see `order_zones`. The weight of a zone also scales its number of sessions,
+    up to `max_zone_sessions`. In stream mode, the zones are started in the order
+    of the file.
+
+    A merge failed with a transient error, like a timeout of the UI, is retried at
+    the end of its zone, up to `max_attempts` attempts. The rows left RETRY when
+    the run stops are merged again by the next run.
+
+    The outcome of each merge is also recorded in the result store `store_path`,
+    shared by all the runs, see `ResultStore`. The rows whose pair was merged by an
+    earlier run, of any input file, are skipped without any API call.
+
+    With `metrics_port` or `metrics_text_file`, the progress of the run is exposed
+    live in the Prometheus text format: done, failed and remaining rows by zone,
+    merge rate and ETA over the last minutes, browser restarts, API call rate and
+    step duration histograms, see `RunProgress`.
+
+    args:
+        file_path (str): Path to the Excel file containing merge instructions.
+        zone_workers (int): Number of zones processed concurrently. Default is 1.
+        zone_sessions (int): Number of browser sessions per zone. Default is 1.
+        share_staff (bool): Log in all sessions of a zone with the same temp staff account. Default is False.
+        api_workers (int): Maximum number of concurrent API calls per zone. Default is 4.
+        backend (str): Merge backend, 'selenium' to drive the UI in a browser or the experimental 'http'
+            to replay the UI form posts over HTTP after a browser login. Default is 'selenium'.
+        batch_size (int): Number of merges submitted per merge job as an uploaded file, 0 to
+            submit one job per row. Default is 0.
+        sync_only (bool): Only write the statuses of the journal back to the input file. Default is False.
+        track_jobs (bool): Follow the merge jobs until they are finished. Default is False.
+        poll_interval (float): Time between two checks of the merge jobs in seconds. Default is 30.
+        job_timeout (float): Maximum time to wait for the merge jobs at the end of the run
+            in seconds. Default is 3600.
+        stream (bool): Read the input file in chunks instead of loading it. Default is False.
+        chunk_size (int): Number of rows of a zone read at once in stream mode. Default is 10000.
+        sorted_input (bool): The rows of each zone are contiguous in the input file, so each zone
+            worker only reads its block in stream mode. Default is False.
+        user_cache_ttl (float): Time to live of the cached user records in seconds. Default is 600.
+        api_quota (Optional[int]): Maximum number of User API calls of the run, None for no limit.
+            Default is None.
+        staff_pool_path (Optional[str]): JSON file of the pool of staff accounts kept between runs,
+            None to create and delete the accounts in each run. Default is None.
+        staff_rotation_days (float): Age in days after which the passwords of the pool are rotated.
+            Default is 7.
+        zone_weights (Optional[Dict[str, float]]): Weight of the zones, 1 for the zones not listed.
+            Default is None.
+        max_zone_sessions (Optional[int]): Maximum number of concurrent browser sessions of a zone,
+            None for no limit. Default is None.
+        max_attempts (int): Maximum number of attempts of a merge failing with transient errors. Default is 3.
+        store_path (Optional[str]): SQLite database of the results of all the runs, None to use none.
+            Default is 'log/results.db'.
+        metrics_port (Optional[int]): Port of the local HTTP endpoint of the live metrics, None for
+            no endpoint. Default is None.
+        metrics_text_file (Optional[str]): Text file rewritten with the live metrics every 15 seconds,
+            None for no file. Default is None.
+
+    raises:
+        ValueError: If the backend has no batch mode while `batch_size` is set, see `check_backend`.
+    """
+    check_backend(backend, batch_size)
+    load_dotenv()
+
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    setup_logging(file_name)
+
+    journal = StatusJournal(journal_path(file_path))
+    store = ResultStore(store_path) if store_path is not None and not sync_only else None
+    exporting = (metrics_port is not None or metrics_text_file is not None) and not sync_only
+    progress = RunProgress() if exporting else None
+    if stream:
+        results = StreamResults(file_path, journal, chunk_size, store, progress)
+    else:
+        df = pd.read_csv(file_path, dtype=str)
+        if 'Merge_status' not in df.columns:
+            df['Merge_status'] = 'NOT PROCESSED'
+        if 'Merge_job_id' not in df.columns:
+            df['Merge_job_id'] = None
+        results = MergeResults(df, file_path, journal, store, progress)
+    restored = results.replay_journal()
+    if restored > 0:
+        logging.info(f'Restored the status of {restored} rows from journal {journal.path}')
+
+    if sync_only:
+        results.write_csv()
+        journal.close()
+        return
+
+    if stream:
+        # Zones are yielded while the file is scanned, each worker reads the rows of its zone
+        accounts = ((zone, results.chunks(read_zone(file_path, zone, chunk_size,
+                                                    first_row if sorted_input else 0, sorted_input)))
+                    for zone, first_row in scan_zones(file_path))
+        logging.info(f'Starting user merge process in stream mode with {zone_workers} zone worker(s).')
+    else:
+        accounts = {zone: data for zone, data in df.groupby('zone')}
+        logging.info(f'Starting user merge process: {len(df)} accounts to process '
+                     f'in {len(accounts)} zones with {zone_workers} zone worker(s).')
+        accounts = [(zone, accounts[zone]) for zone in order_zones(accounts, zone_weights)]
+
+    api_client = UserApiClient(ttl=user_cache_ttl, pool_size=max(16, zone_workers * api_workers),
+                               max_calls=api_quota)
+    set_client(api_client)
+    pool = SessionPool(headless=True, backend=backend)
+    staff_pool = StaffPool(staff_pool_path, staff_rotation_days * 24 * 3600) if staff_pool_path is not None else None
+    metrics_file = MetricsFile(f'log/metrics{"" if len(file_name) == 0 else "_"}{file_name}.jsonl')
+    timings = {}
+    exporter = MetricsExporter(progress, metrics_text_file, metrics_port).start() if exporting else None
+
+    poller = None
+    if track_jobs:
+        poller = JobPoller(results, os.getenv('ALMA_ENV', 'P'), poll_interval, api_workers)
+        for i, zone, from_user, job_id in results.submitted_rows():
+            poller.watch(i, zone, from_user, job_id)
+        if len(poller) > 0:
+            logging.info(f'Following {len(poller)} merge jobs submitted by a previous run')
+        poller.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=zone_workers, thread_name_prefix='zone') as executor:
+            futures = {}
+            for zone, data in accounts:
+                timings[zone] = StepTimings(zone, metrics_file, progress)
+                sessions = zone_session_count(zone, zone_sessions, zone_weights, max_zone_sessions)
+                futures[executor.submit(merge_zone, zone, data, results, sessions, share_staff, api_workers,
+                                        timings[zone], pool, batch_size, poller, staff_pool,
+                                        max_attempts=max_attempts, store=store)] = zone
+            for future, zone in futures.items():
                 try:
-                    merger = AlmaMerger(temp_staff, headless=True)
-                    merger.login()
-                    merger.open_merge_users_page()
-                    logging.error(f'Merge skipped due to error: merge {from_user} into {to_user}')
-                    continue
-                except MergeProcessError:
-                    logging.critical(f'Failed to re-initialize AlmaMerger after error for zone {zone}')
-                    break
+                    future.result()
+                except Exception as e:
+                    logging.critical(f'Unexpected error while processing zone {zone}: {type(e).__name__} - {e}')
+        pool.close()
+        if poller is not None:
+            logging.info(f'Waiting for {len(poller)} merge jobs to finish')
+            poller.close(job_timeout)
+    finally:
+        pool.close()
+        if poller is not None:
+            poller.close(timeout=0)
+        results.write_csv()
+        journal.close()
+        if store is not None:
+            store.close()
+        metrics_file.close()
+        if exporter is not None:
+            exporter.close()
+        set_client(None)
+        api_client.close()
+
+    logging.info(f'User API: {api_client.summary()}')
+    for zone, zone_timings in timings.items():
+        for line in zone_timings.report():
+            logging.info(f'Timing {zone} - {line}')
+
+    counts = results.status_counts()
+    logging.info('Merge statuses: ' + ', '.join(f'{status}: {count}' for status, count in counts.items()))
 
-        merger.driver.quit()
-        temp_staff.delete()
 
 if __name__ == '__main__':
-    file_path = sys.argv[1]
-    workflow(file_path)
+    parser = argparse.ArgumentParser(description='Merge Alma users listed in a CSV file.')
+    parser.add_argument('file_path', help='CSV file with from_user, to_user and zone columns')
+    parser.add_argument('--zone-workers', type=int, default=1,
+                        help='number of zones processed concurrently (default: 1)')
+    parser.add_argument('--zone-sessions', type=int, default=1,
+                        help='number of browser sessions merging the rows of a zone (default: 1)')
+    parser.add_argument('--share-staff', action='store_true',
+                        help='log in all sessions of a zone with the same temp staff account')
+    parser.add_argument('--api-workers', type=int, default=4,
+                        help='maximum number of concurrent API calls per zone (default: 4)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='selenium', metavar='BACKEND',
+                        help="merge backend: 'selenium' (default), or the EXPERIMENTAL 'http', replaying the form "
+                             "posts with fields not yet checked against the real Merge Users page")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='number of merges submitted per merge job as an uploaded file, '
+                             '0 for one job per row (default: 0)')
+    parser.add_argument('--sync', action='store_true',
+                        help='only write the statuses recorded in the journal back to the input file')
+    parser.add_argument('--track-jobs', action='store_true',
+                        help='follow the merge jobs and mark the rows COMPLETED or FAILED once they are finished')
+    parser.add_argument('--poll-interval', type=float, default=30,
+                        help='seconds between two checks of the merge jobs (default: 30)')
+    parser.add_argument('--job-timeout', type=float, default=3600,
+                        help='maximum seconds to wait for the merge jobs at the end of the run (default: 3600)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the input file in chunks instead of loading it, for very large files')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='number of rows of a zone read at once in stream mode (default: 10000)')
+    parser.add_argument('--sorted-input', action='store_true',
+                        help='the rows of each zone are contiguous in the input file (stream mode)')
+    parser.add_argument('--user-cache-ttl', type=float, default=600,
+                        help='seconds during which a fetched user record is reused (default: 600)')
+    parser.add_argument('--api-quota', type=int,
+                        help='maximum number of User API calls of the run (default: no limit)')
+    parser.add_argument('--staff-pool', nargs='?', const='log/staff_pool.json',
+                        help='keep the temp staff accounts between runs in this pool file '
+                             '(default file: log/staff_pool.json), see utils/staffpool.py to delete them')
+    parser.add_argument('--staff-rotation-days', type=float, default=7,
+                        help='age in days after which the passwords of the staff pool are rotated (default: 7)')
+    parser.add_argument('--zone-weights', type=parse_weights,
+                        help='weights of the zones as ZONE=weight separated by commas, scaling their number of '
+                             'sessions and moving them forward (default: 1 for all zones)')
+    parser.add_argument('--max-zone-sessions', type=int,
+                        help='maximum number of concurrent browser sessions of a zone (default: no limit)')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='maximum number of attempts of a merge failing with a transient error, '
+                             'like a timeout (default: 3)')
+    parser.add_argument('--store', default='log/results.db',
+                        help='SQLite database recording the results of all the runs, see utils/store.py '
+                             '(default: log/results.db)')
+    parser.add_argument('--no-store', action='store_true',
+                        help='do not record the results in the store nor skip the pairs merged by earlier runs')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve the live progress metrics of the run in the Prometheus text format on '
+                             'http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--metrics-text-file',
+                        help='rewrite this file with the live progress metrics of the run every 15 seconds, '
+                             'for example for the textfile collector of the node exporter')
+    parser.add_argument('--status', action='store_true',
+                        help='only print the number of rows of each status by zone, from the file and its journal')
+    parser.add_argument('--plan', action='store_true',
+                        help='only estimate the duration and API calls of the merges, from the timings of the '
+                             'previous runs in log/metrics*.jsonl')
+    parser.add_argument('--plan-sample', type=int, default=0,
+                        help='number of users per zone fetched by --plan to count the users with internal blocks '
+                             '(default: 0)')
+    args = parser.parse_args()
+    try:
+        check_backend(args.backend, args.batch_size)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.plan:
+        load_dotenv()
+        estimate = plan(args.file_path, zone_workers=args.zone_workers, zone_sessions=args.zone_sessions,
+                        share_staff=args.share_staff, api_workers=args.api_workers, batch_size=args.batch_size,
+                        track_jobs=args.track_jobs, staff_pool=args.staff_pool is not None,
+                        zone_weights=args.zone_weights, max_zone_sessions=args.max_zone_sessions,
+                        sample_size=args.plan_sample)
+        print('\n'.join(plan_report(estimate)))
+        sys.exit(0)
+    if args.status:
+        for zone, counts in sorted(file_status(args.file_path).items()):
+            print(f'{zone}: ' + ', '.join(f'{status}: {count}' for status, count in sorted(counts.items())))
+        sys.exit(0)
+    workflow(args.file_path, zone_workers=args.zone_workers, zone_sessions=args.zone_sessions,
+             share_staff=args.share_staff, api_workers=args.api_workers,
+             backend=args.backend, batch_size=args.batch_size, sync_only=args.sync,
+             track_jobs=args.track_jobs, poll_interval=args.poll_interval, job_timeout=args.job_timeout,
+             stream=args.stream, chunk_size=args.chunk_size, sorted_input=args.sorted_input,
+             user_cache_ttl=args.user_cache_ttl, api_quota=args.api_quota, staff_pool_path=args.staff_pool,
+             staff_rotation_days=args.staff_rotation_days, zone_weights=args.zone_weights,
+             max_zone_sessions=args.max_zone_sessions, max_attempts=args.max_attempts,
+             store_path=None if args.no_store else args.store, metrics_port=args.metrics_port,
+             metrics_text_file=args.metrics_text_file)
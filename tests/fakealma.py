@@ -0,0 +1,564 @@
+"""Local stand-in of Alma for offline tests and benchmarks.
+
+`FakeAlma` serves, from an in-memory store, the parts of Alma used by the merge:
+
+* the UI pages of the merge flow (login, Admin menu, Merge Users job list, Add Job
+  form, user pickup popup, confirmation), with the element IDs used by `AlmaMerger`
+  and `HttpMerger`;
+* the users API (get, create, update, delete) used by `User` and `NewUser`;
+* the job instances API used by `MergeJobTracker`.
+
+`FakeAlma.install` points almapiwrapper and the temporary staff accounts to the
+stand-in, so `merge.workflow` runs unchanged against it.
+"""
+from contextlib import contextmanager
+from copy import deepcopy
+from email.parser import BytesParser
+from email.policy import HTTP
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+from urllib.parse import parse_qsl, unquote, urlsplit
+import collections
+import csv
+import io
+import itertools
+import json
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+
+from almapiwrapper.record import Record
+from almapiwrapper.users import User
+
+from utils.staff import TempStaffUser
+
+MERGE_JOB_ID = '60000000000001'
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title></head>
+<body>{body}</body></html>"""
+
+LOGIN_BODY = """
+<form method="post" action="/login">
+  <input type="hidden" name="zone" value="{zone}">
+  <input type="text" id="username" name="username">
+  <input type="password" id="password" name="password">
+  <input type="submit" value="Log in">
+</form>"""
+
+COOKIE_BANNER = """
+<div id="onetrust-banner"><button id="onetrust-accept-btn-handler"
+  onclick="document.getElementById('onetrust-banner').style.display='none'">Accept</button></div>"""
+
+MENU = """
+<button aria-label="Admin" onclick="document.getElementById('adminMenu').style.display='block'">Admin</button>
+<div id="adminMenu" style="display:none">
+  <a id="MENU_LINK_ID_comexlibrisdpsadmgeneralmenuadvancedgeneralgeneralHeaderMergeUsers" href="/merge">Merge Users</a>
+</div>"""
+
+JOB_LIST_BODY = """
+<h1>Merge Users</h1>
+<a href="/merge/add">Add Job</a>
+<table id="jobList"><tbody>{rows}</tbody></table>"""
+
+ADD_JOB_BODY = """
+<form method="post" action="/merge/confirm" enctype="multipart/form-data">
+  <input type="radio" name="mode" id="modeSingle" value="SINGLE" checked onchange="setMode()">
+  <label for="modeSingle">Merge two users</label>
+  <input type="radio" name="mode" id="modeFile" value="FILE" onchange="setMode()">
+  <label for="modeFile">Merge users from file</label>
+  <div id="singleFields">
+    <input type="text" name="fromUser" id="fromUser">
+    <button type="button" id="PICKUP_ID_pageBeandisplayNameOfFromUserOrUserIdendifier"
+      onclick="pickup('fromUser')">Pick</button>
+    <input type="text" name="toUser" id="toUser">
+    <button type="button" id="PICKUP_ID_pageBeandisplayNameOfToUserOrUserIdendifier"
+      onclick="pickup('toUser')">Pick</button>
+  </div>
+  <div id="fileFields" style="display:none"><input type="file" name="pairsFile"></div>
+  {checkboxes}
+  <input type="submit" id="PAGE_BUTTONS_cbuttonmerge" name="merge" value="Merge">
+</form>
+<div id="popup" style="display:none"><iframe id="iframePopupIframe" src="about:blank"></iframe></div>
+<script>
+function setMode() {{
+  var file = document.getElementById('modeFile').checked;
+  document.getElementById('fileFields').style.display = file ? 'block' : 'none';
+  document.getElementById('singleFields').style.display = file ? 'none' : 'block';
+}}
+function pickup(field) {{
+  document.getElementById('iframePopupIframe').src = '/search?field=' + field;
+  document.getElementById('popup').style.display = 'block';
+}}
+function closePopup() {{
+  document.getElementById('popup').style.display = 'none';
+  document.getElementById('iframePopupIframe').src = 'about:blank';
+}}
+function selectUser(field, primaryId) {{
+  document.getElementById(field).value = primaryId;
+  closePopup();
+}}
+document.addEventListener('keydown', function (e) {{ if (e.key === 'Escape') closePopup(); }});
+</script>"""
+
+CHECKBOX = """<input type="checkbox" name="copyParams" id="{param}" value="{param}"><label for="{param}">{param}</label>"""
+
+SEARCH_BODY = """
+<button type="button" id="simpleSearchIndexButton"
+  onclick="document.getElementById('searchIndexes').style.display='block'">Search by</button>
+<div id="searchIndexes" style="display:none">
+  <a id="TOP_NAV_Search_index_HFrUser.user_name" href="#"
+    onclick="document.getElementById('searchIndexes').style.display='none'; return false;">Primary identifier</a>
+</div>
+<input type="text" id="ALMA_MENU_TOP_NAV_Search_Text">
+<button type="button" id="simpleSearchBtn" onclick="search()">Search</button>
+<div id="results"></div>
+<script>
+var field = {field};
+function search() {{
+  var q = document.getElementById('ALMA_MENU_TOP_NAV_Search_Text').value;
+  fetch('/search/users?q=' + encodeURIComponent(q)).then(function (r) {{ return r.json(); }}).then(function (ids) {{
+    var table = document.createElement('table');
+    var body = document.createElement('tbody');
+    table.id = 'TABLE_DATA_userList';
+    table.appendChild(body);
+    ids.forEach(function (id) {{
+      var row = body.insertRow();
+      row.insertCell().textContent = id;
+      row.onclick = function () {{ parent.selectUser(field, id); }};
+    }});
+    document.getElementById('results').appendChild(table);
+  }});
+}}
+</script>"""
+
+CONFIRM_BODY = """
+<form method="post" action="/merge/start">
+  <p>{count} users will be merged.</p>
+  {hidden}
+  <input type="submit" id="PAGE_BUTTONS_cbuttonconfirmationconfirm" name="confirm" value="Confirm">
+</form>"""
+
+COPY_PARAMS = ['PARAM_COPY_ATTACHMENTS', 'PARAM_COPY_NOTES', 'PARAM_COPY_DEMERITS', 'PARAM_COPY_PROXY_OF']
+
+
+class FakeAlma:
+    """In-memory Alma served over HTTP on localhost.
+
+    Each zone has its own users and merge jobs, the zone of an API call is given by
+    its API key and the zone of a UI session by the staff user logged in.
+    """
+    def __init__(self, latency: float = 0, error_rate: float = 0, job_duration: float = 0, seed: int = 0,
+                 api_rate_limit: float = 0):
+        """
+        Initialize the stand-in. The server is only started by `start`.
+
+        args:
+            latency (float): Delay added to each UI request in seconds. Default is 0.
+            error_rate (float): Probability of an HTTP 500 on a UI request after the login. Default is 0.
+            job_duration (float): Time during which a merge job is RUNNING in seconds. Default is 0.
+            seed (int): Seed of the random errors. Default is 0.
+            api_rate_limit (float): Number of API calls per second of a zone above which the
+                calls get an HTTP 429, 0 for no limit. Default is 0.
+        """
+        self.latency = latency
+        self.api_rate_limit = api_rate_limit
+        self._api_calls: Dict[str, collections.deque] = {}
+        self.error_rate = error_rate
+        self.job_duration = job_duration
+        self.users: Dict[str, Dict[str, Dict]] = {}
+        self.jobs: Dict[str, List[Dict]] = {}
+        self.sessions: Dict[str, Tuple[str, str]] = {}
+        self.request_counts: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._job_ids = itertools.count(1)
+        self._block_dates = itertools.count(1)
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the running server."""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeAlma':
+        """Start the server in a background thread on a free port.
+
+        Returns:
+            FakeAlma: The started stand-in.
+        """
+        fake = self
+
+        class Handler(FakeAlmaHandler):
+            alma = fake
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-alma', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'FakeAlma':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    @contextmanager
+    def install(self, zones: Optional[List[str]] = None) -> Iterator['FakeAlma']:
+        """Point almapiwrapper and the temporary staff accounts to the stand-in.
+
+        An API keys file is written for the zones and the merge job ID is set, so
+        the merge jobs can be tracked.
+
+        Args:
+            zones (Optional[List[str]]): Zones needing API keys. Default is all the zones of `iz_info.json`.
+        """
+        zones = zones if zones is not None else list(TempStaffUser.iz_info['iz_codes'])
+        keys = {zone: [{'API_Key': f'fake-{zone}',
+                        'Supported_APIs': [{'Area': area, 'Permissions': permissions, 'Env': env}
+                                           for area in ('Users', 'Conf')
+                                           for permissions in ('R', 'RW')
+                                           for env in ('P', 'S')]}]
+                for zone in zones}
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(keys, f)
+            keys_path = f.name
+
+        try:
+            with mock.patch.object(Record, 'api_base_url', f'{self.url}/almaws/v1'), \
+                    mock.patch.object(User, 'api_base_url', f'{self.url}/almaws/v1/users'), \
+                    mock.patch.object(TempStaffUser, 'get_alma_url',
+                                      lambda staff, zone: f'{self.url}/login?zone={zone}'), \
+                    mock.patch.dict(os.environ, {'alma_api_keys': keys_path, 'ALMA_MERGE_JOB_ID': MERGE_JOB_ID}):
+                yield self
+        finally:
+            os.remove(keys_path)
+
+    def add_user(self, zone: str, primary_id: str, internal_blocks: int = 0) -> Dict:
+        """Add a user to a zone.
+
+        Args:
+            zone (str): Zone of the user.
+            primary_id (str): The primary ID of the user.
+            internal_blocks (int): Number of internal blocks of the user. Default is 0.
+
+        Returns:
+            Dict: Data of the user.
+        """
+        data = {'primary_id': primary_id,
+                'record_type': {'value': 'PUBLIC'},
+                'user_identifier': [{'id_type': {'value': 'BARCODE'}, 'value': f'B-{primary_id}'}],
+                'user_block': [{'block_type': {'value': 'GENERAL'}, 'block_description': {'value': '01'},
+                                'segment_type': 'Internal',
+                                'created_date': f'2024-01-01T00:00:{next(self._block_dates):02d}Z'}
+                               for _ in range(internal_blocks)]}
+        with self._lock:
+            self.users.setdefault(zone, {})[primary_id] = data
+        return data
+
+    def get_user(self, zone: str, primary_id: str) -> Optional[Dict]:
+        """Return the data of a user, None if it does not exist."""
+        with self._lock:
+            return deepcopy(self.users.get(zone, {}).get(primary_id))
+
+    def start_merge_job(self, zone: str, staff: str, pairs: List[Tuple[str, str]]) -> str:
+        """Run a merge job: the 'from' users are removed, their internal blocks are lost.
+
+        Args:
+            zone (str): Zone of the users.
+            staff (str): The primary ID of the staff user starting the job.
+            pairs (List[Tuple[str, str]]): Primary IDs of the users to merge from and to.
+
+        Returns:
+            str: The ID of the job instance.
+        """
+        with self._lock:
+            users = self.users.setdefault(zone, {})
+            merged = 0
+            for from_user, to_user in pairs:
+                if from_user in users and to_user in users and from_user != to_user:
+                    del users[from_user]
+                    merged += 1
+            if merged == len(pairs):
+                state = 'COMPLETED_SUCCESS'
+            else:
+                state = 'COMPLETED_WARNING' if merged > 0 else 'COMPLETED_FAILED'
+            job_id = str(7000000000 + next(self._job_ids))
+            self.jobs.setdefault(zone, []).insert(0, {'id': job_id, 'staff': staff, 'pairs': pairs,
+                                                      'state': state, 'start': time.monotonic()})
+        return job_id
+
+    def job_state(self, job: Dict) -> str:
+        """Return the state of a job instance, RUNNING during `job_duration`."""
+        return job['state'] if time.monotonic() - job['start'] >= self.job_duration else 'RUNNING'
+
+    def throttle(self, zone: str) -> bool:
+        """Return True if an API call of the zone exceeds the limit of calls of the last second."""
+        if self.api_rate_limit <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            calls = self._api_calls.setdefault(zone, collections.deque())
+            while len(calls) > 0 and calls[0] <= now - 1:
+                calls.popleft()
+            if len(calls) >= self.api_rate_limit:
+                self.request_counts['throttled'] = self.request_counts.get('throttled', 0) + 1
+                return True
+            calls.append(now)
+            return False
+
+    def count_request(self, name: str) -> None:
+        """Count a request by kind, like 'GET user' or 'POST /merge/start'."""
+        with self._lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+
+class FakeAlmaHandler(BaseHTTPRequestHandler):
+    """Request handler of `FakeAlma`, bound to its instance by `FakeAlma.start`."""
+    alma: FakeAlma = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Keep the test and benchmark output quiet."""
+
+    def send(self, status: int, body: bytes = b'', content_type: str = 'text/html; charset=utf-8',
+             headers: Optional[Dict[str, str]] = None) -> None:
+        """Send a complete response."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, title: str, body: str, status: int = 200, menu: bool = False) -> None:
+        """Send an HTML page, with the Admin menu of the logged-in pages if `menu` is set."""
+        self.send(status, PAGE.format(title=title, body=(MENU if menu else '') + body).encode())
+
+    def send_json(self, status: int, data) -> None:
+        """Send a JSON response."""
+        self.send(status, json.dumps(data).encode(), 'application/json')
+
+    def send_api_error(self, status: int, message: str) -> None:
+        """Send an error in the format of the Alma API."""
+        self.send_json(status, {'errorsExist': True,
+                                'errorList': {'error': [{'errorCode': str(status), 'errorMessage': message}]}})
+
+    def read_body(self) -> bytes:
+        """Read the body of the request."""
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def read_form(self) -> Tuple[List[Tuple[str, str]], Dict[str, bytes]]:
+        """Read the fields and files of a url-encoded or multipart form.
+
+        Returns:
+            Tuple[List[Tuple[str, str]], Dict[str, bytes]]: Field values and content of the files by field name.
+        """
+        body = self.read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return parse_qsl(body.decode(), keep_blank_values=True), {}
+
+        message = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        fields, files = [], {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is not None:
+                files[name] = part.get_payload(decode=True)
+            else:
+                fields.append((name, part.get_payload(decode=True).decode()))
+        return fields, files
+
+    def api_zone(self) -> Optional[str]:
+        """Return the zone of the API key of the request."""
+        key = self.headers.get('Authorization', '')
+        return key[len('apikey fake-'):] if key.startswith('apikey fake-') else None
+
+    def session(self) -> Optional[Tuple[str, str]]:
+        """Return the zone and staff user of the UI session of the request."""
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'JSESSIONID':
+                with self.alma._lock:
+                    return self.alma.sessions.get(value)
+        return None
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method: str) -> None:
+        """Route a request to the API or to the UI."""
+        url = urlsplit(self.path)
+        if url.path.startswith('/almaws/v1/'):
+            self.handle_api(method, url.path[len('/almaws/v1/'):].split('/'))
+        else:
+            self.handle_ui(method, url.path, dict(parse_qsl(url.query)))
+
+    def handle_api(self, method: str, path: List[str]) -> None:
+        """Serve the users and job instances API."""
+        zone = self.api_zone()
+        if zone is None:
+            self.send_api_error(401, 'Invalid API Key')
+            return
+        if self.alma.throttle(zone):
+            self.read_body()
+            self.send_api_error(429, 'PER_SECOND_THRESHOLD')
+            return
+
+        path = [unquote(part) for part in path]
+        if path[0] == 'users' and len(path) == 1 and method == 'POST':
+            self.alma.count_request('POST user')
+            data = json.loads(self.read_body())
+            data.pop('password', None)
+            with self.alma._lock:
+                users = self.alma.users.setdefault(zone, {})
+                exists = data['primary_id'] in users
+                if not exists:
+                    users[data['primary_id']] = data
+            if exists:
+                self.send_api_error(400, f"User with identifier {data['primary_id']} already exists")
+            else:
+                self.send_json(200, data)
+        elif path[0] == 'users' and len(path) == 2:
+            self.alma.count_request(f'{method} user')
+            primary_id = path[1]
+            body = self.read_body()
+            with self.alma._lock:
+                users = self.alma.users.setdefault(zone, {})
+                data = users.get(primary_id)
+                if data is not None and method == 'PUT':
+                    data = users[primary_id] = json.loads(body)
+                elif data is not None and method == 'DELETE':
+                    del users[primary_id]
+            if data is None:
+                self.send_api_error(400, f'User with identifier {primary_id} was not found.')
+            elif method == 'DELETE':
+                self.send(204)
+            else:
+                self.send_json(200, data)
+        elif path[:2] == ['conf', 'jobs'] and len(path) == 3:
+            self.alma.count_request('GET job')
+            self.send(200, f'<job><id>{escape(path[2][1:])}</id><name>Users Merge</name></job>'.encode(),
+                      'application/xml')
+        elif path[:2] == ['conf', 'jobs'] and len(path) == 4 and path[3] == 'instances':
+            self.alma.count_request('GET job instances')
+            with self.alma._lock:
+                jobs = [{'id': job['id'], 'status': {'value': self.alma.job_state(job)}}
+                        for job in self.alma.jobs.get(zone, [])]
+            self.send_json(200, {'job_instance': jobs, 'total_record_count': len(jobs)})
+        else:
+            self.send_api_error(404, f"Unknown API {'/'.join(path)}")
+
+    def handle_ui(self, method: str, path: str, query: Dict[str, str]) -> None:
+        """Serve the pages of the merge flow."""
+        self.alma.count_request(f'{method} {path}')
+        if self.alma.latency > 0:
+            time.sleep(self.alma.latency)
+
+        if path == '/login':
+            self.handle_login(method, query)
+            return
+
+        session = self.session()
+        if session is None:
+            self.read_body()
+            self.send_page('Login', LOGIN_BODY.format(zone=''))
+            return
+
+        with self.alma._lock:
+            failed = self.alma._random.random() < self.alma.error_rate
+        if failed:
+            self.read_body()
+            self.send_page('Error', '<p>Internal error</p>', status=500)
+            return
+
+        zone, staff = session
+        if path == '/home':
+            self.send_page('Alma', COOKIE_BANNER, menu=True)
+        elif path == '/merge':
+            with self.alma._lock:
+                jobs = [job for job in self.alma.jobs.get(zone, []) if job['staff'] == staff]
+                rows = ''.join(f'<tr id="recordContainerjobList{n}"><td>Merge users</td><td>{job["id"]}</td>'
+                               f'<td>{self.alma.job_state(job)}</td></tr>' for n, job in enumerate(jobs, 1))
+            self.send_page('Merge Users', JOB_LIST_BODY.format(rows=rows), menu=True)
+        elif path == '/merge/add':
+            self.send_page('Add Job', ADD_JOB_BODY.format(
+                checkboxes='\n  '.join(CHECKBOX.format(param=param) for param in COPY_PARAMS)), menu=True)
+        elif path == '/search':
+            self.send_page('Users', SEARCH_BODY.format(field=escape(json.dumps(query.get('field', '')), quote=False)))
+        elif path == '/search/users':
+            user = self.alma.get_user(zone, query.get('q', '').strip())
+            self.send_json(200, [] if user is None else [user['primary_id']])
+        elif path == '/merge/confirm' and method == 'POST':
+            self.handle_confirm()
+        elif path == '/merge/start' and method == 'POST':
+            fields, _ = self.read_form()
+            pairs = [tuple(value.split('\t', 1)) for name, value in fields if name == 'pair']
+            self.alma.start_merge_job(zone, staff, pairs)
+            self.send(303, headers={'Location': '/merge'})
+        else:
+            self.read_body()
+            self.send_page('Not found', '<p>Not found</p>', status=404)
+
+    def handle_login(self, method: str, query: Dict[str, str]) -> None:
+        """Show the login form, or open a session for an existing staff user."""
+        if method == 'GET':
+            self.send_page('Login', LOGIN_BODY.format(zone=escape(query.get('zone', ''))))
+            return
+
+        fields = dict(self.read_form()[0])
+        zone, username = fields.get('zone', ''), fields.get('username', '')
+        if self.alma.get_user(zone, username) is None:
+            self.send_page('Login', LOGIN_BODY.format(zone=escape(zone)))
+            return
+
+        token = secrets.token_hex(16)
+        with self.alma._lock:
+            self.alma.sessions[token] = (zone, username)
+        self.send(303, headers={'Location': '/home', 'Set-Cookie': f'JSESSIONID={token}; Path=/'})
+
+    def handle_confirm(self) -> None:
+        """Show the confirmation of the merge job with the pairs to merge."""
+        fields, files = self.read_form()
+        values = dict(fields)
+        if values.get('mode') == 'FILE':
+            content = files.get('pairsFile', b'').decode('utf-8-sig')
+            pairs = [(row[0], row[1]) for row in csv.reader(io.StringIO(content)) if len(row) >= 2]
+        else:
+            pairs = [(values.get('fromUser', ''), values.get('toUser', ''))]
+        pairs = [(from_user.strip(), to_user.strip()) for from_user, to_user in pairs
+                 if from_user.strip() and to_user.strip()]
+
+        if len(pairs) == 0:
+            self.send_page('Add Job', '<p>Both users are required</p>', menu=True)
+            return
+
+        hidden = '\n  '.join(f'<input type="hidden" name="pair" value="{escape(from_user + chr(9) + to_user)}">'
+                             for from_user, to_user in pairs)
+        self.send_page('Confirmation', CONFIRM_BODY.format(count=len(pairs), hidden=hidden), menu=True)
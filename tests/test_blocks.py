@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+
+from tests.fakealma import FakeAlma
+from utils.blocks import copy_blocks
+from utils.mergeprocess import MergeProcessError
+from utils.preflight import prefetch_users
+from utils.userapi import ApiThrottledError, UserApiClient, set_client
+
+
+class TestCopyBlocks(unittest.TestCase):
+    def setUp(self):
+        self.alma = FakeAlma().start()
+        self.installed = self.alma.install(['UBS'])
+        self.installed.__enter__()
+        self.client = UserApiClient(ttl=60)
+        self.previous = set_client(self.client)
+
+    def tearDown(self):
+        set_client(self.previous)
+        self.client.close()
+        self.installed.__exit__(None, None, None)
+        self.alma.stop()
+
+    def test_copy_blocks(self):
+        self.alma.add_user('UBS', 'f1@test.ch', internal_blocks=1)
+        self.alma.add_user('UBS', 'f2@test.ch', internal_blocks=2)
+        self.alma.add_user('UBS', 'f3@test.ch')
+        self.alma.add_user('UBS', 'f4@test.ch', internal_blocks=1)
+        for to_user in ['t1@test.ch', 't2@test.ch']:
+            self.alma.add_user('UBS', to_user)
+        rows = {0: ('f1@test.ch', 't1@test.ch'), 1: ('f2@test.ch', 't1@test.ch'),
+                2: ('f3@test.ch', 't2@test.ch'), 3: ('f4@test.ch', 't2@test.ch')}
+        users = prefetch_users([user for pair in rows.values() for user in pair], 'UBS', 'S')
+
+        errors = copy_blocks(rows, users, 'UBS', max_workers=2)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(len(self.alma.get_user('UBS', 't1@test.ch')['user_block']), 3)
+        self.assertEqual(len(self.alma.get_user('UBS', 't2@test.ch')['user_block']), 1)
+        self.assertEqual(self.alma.get_user('UBS', 'f1@test.ch')['user_identifier'], [])
+        self.assertNotEqual(self.alma.get_user('UBS', 'f3@test.ch')['user_identifier'], [])
+        # One update per 'from' user with blocks and one per 'to' user
+        self.assertEqual(self.alma.request_counts['PUT user'], 5)
+
+    def test_copy_blocks_again(self):
+        self.alma.add_user('UBS', 'f1@test.ch', internal_blocks=2)
+        self.alma.add_user('UBS', 't1@test.ch')
+        rows = {0: ('f1@test.ch', 't1@test.ch')}
+        users = prefetch_users(['f1@test.ch', 't1@test.ch'], 'UBS', 'S')
+        self.assertEqual(copy_blocks(rows, users, 'UBS'), {})
+
+        # A rerun, for example after a crash, neither repeats the updates nor duplicates the blocks
+        for primary_id in ['f1@test.ch', 't1@test.ch']:
+            self.client.invalidate(primary_id, 'UBS', 'S')
+        users = prefetch_users(['f1@test.ch', 't1@test.ch'], 'UBS', 'S')
+        self.assertEqual(copy_blocks(rows, users, 'UBS'), {})
+        self.assertEqual(len(self.alma.get_user('UBS', 't1@test.ch')['user_block']), 2)
+        self.assertEqual(self.alma.request_counts['PUT user'], 2)
+
+    def test_copy_blocks_errors(self):
+        self.alma.add_user('UBS', 'f1@test.ch', internal_blocks=1)
+        self.alma.add_user('UBS', 'f2@test.ch', internal_blocks=1)
+        self.alma.add_user('UBS', 't1@test.ch')
+        self.alma.add_user('UBS', 't2@test.ch')
+        rows = {0: ('f1@test.ch', 't1@test.ch'), 1: ('f2@test.ch', 't2@test.ch')}
+        users = prefetch_users([user for pair in rows.values() for user in pair], 'UBS', 'S')
+
+        update_user = self.client.update_user
+
+        def fail_updates(u):
+            if u.primary_id == 't1@test.ch':
+                u.error = True
+                u.error_msg = 'invalid record'
+                return u
+            if u.primary_id == 'f2@test.ch':
+                raise ApiThrottledError('PUT call of UBS still throttled')
+            return update_user(u)
+
+        with mock.patch.object(self.client, 'update_user', side_effect=fail_updates):
+            errors = copy_blocks(rows, users, 'UBS')
+
+        self.assertIsInstance(errors[0], MergeProcessError)
+        self.assertEqual(errors[0].step, 'copy_internal_blocks')
+        self.assertIsInstance(errors[1], ApiThrottledError)
+        # Only f1 reached Alma: t2 is not updated as the update of its 'from' user failed
+        self.assertEqual(self.alma.request_counts['PUT user'], 1)
+        self.assertEqual(self.alma.get_user('UBS', 't2@test.ch')['user_block'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
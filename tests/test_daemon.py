@@ -0,0 +1,161 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+import daemon
+from tests.fakealma import FakeAlma
+from tests.test_fakealma import FakeBrowser
+from utils.journal import StatusJournal
+from utils.store import ResultStore
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.alma = FakeAlma().start()
+        self.installed = self.alma.install(['UBS', 'HPH'])
+        self.installed.__enter__()
+        self.browser = mock.patch('utils.httpmerger.AlmaMerger', FakeBrowser)
+        self.browser.start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.watch_dir = self.tmp_dir.name
+        self.log_dir = os.path.join(self.watch_dir, 'log')
+        for subdirectory in daemon.SUBDIRECTORIES:
+            os.makedirs(os.path.join(self.watch_dir, subdirectory))
+
+    def tearDown(self):
+        self.browser.stop()
+        logging.getLogger().handlers.clear()
+        self.tmp_dir.cleanup()
+        self.installed.__exit__(None, None, None)
+        self.alma.stop()
+
+    def drop(self, name, rows):
+        for from_user, to_user, zone in rows:
+            self.alma.add_user(zone, from_user)
+            self.alma.add_user(zone, to_user)
+        path = os.path.join(self.watch_dir, 'inbox', name)
+        pd.DataFrame(rows, columns=['from_user', 'to_user', 'zone']).to_csv(f'{path}.part', index=False)
+        os.replace(f'{path}.part', path)
+
+    def taken(self, directory, name):
+        """Return the paths of the files of a directory taken over from the inbox under a given name."""
+        stem, extension = os.path.splitext(name)
+        return sorted(os.path.join(self.watch_dir, directory, taken)
+                      for taken in os.listdir(os.path.join(self.watch_dir, directory))
+                      if taken == name or taken.startswith(f'{stem}_') and taken.endswith(extension))
+
+    def serve_until(self, names):
+        stop = threading.Event()
+        thread = threading.Thread(target=daemon.serve, args=(self.watch_dir,),
+                                  kwargs={'zone_workers': 2, 'backend': 'http', 'interval': 0.05,
+                                          'store_path': os.path.join(self.watch_dir, 'results.db'),
+                                          'metrics_text_file': os.path.join(self.watch_dir, 'merge.prom'),
+                                          'log_dir': self.log_dir, 'stop': stop})
+        thread.start()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline and not all(
+                len(self.taken(directory, name)) >= count for directory, name, count in
+                [(directory, name, names.count((directory, name))) for directory, name in names]):
+            time.sleep(0.05)
+        stop.set()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+
+    def test_serve(self):
+        self.drop('first.csv', [('f1@test.ch', 't1@test.ch', 'UBS'), ('f2@test.ch', 't2@test.ch', 'HPH')])
+        self.drop('second.csv', [('f3@test.ch', 't3@test.ch', 'UBS')])
+        with open(os.path.join(self.watch_dir, 'inbox', 'broken.csv'), 'w') as f:
+            f.write('primary_id\nx@test.ch\n')
+        # The header is valid, the error is only found by reading the whole file
+        with open(os.path.join(self.watch_dir, 'inbox', 'malformed.csv'), 'w') as f:
+            f.write('from_user,to_user,zone\nf4@test.ch,t4@test.ch,UBS\nf5@test.ch,t5@test.ch,UBS,x,y\n')
+
+        self.serve_until([('done', 'first.csv'), ('done', 'second.csv'), ('failed', 'broken.csv'),
+                          ('failed', 'malformed.csv')])
+
+        for name in ['first', 'second']:
+            path, = self.taken('done', f'{name}.csv')
+            df = pd.read_csv(path, dtype=str)
+            self.assertEqual(set(df['Merge_status']), {'SUCCESS'})
+            self.assertTrue(os.path.exists(f'{os.path.splitext(path)[0]}.jsonl'))
+        self.assertEqual(os.listdir(os.path.join(self.watch_dir, 'inbox')), [])
+        self.assertEqual(os.listdir(os.path.join(self.watch_dir, 'processing')), [])
+        self.assertIsNone(self.alma.get_user('UBS', 'f3@test.ch'))
+
+        # The sessions of UBS are kept warm from the first file to the second one
+        self.assertEqual(self.alma.request_counts['POST user'], 2)
+
+        store = ResultStore(os.path.join(self.watch_dir, 'results.db'))
+        self.assertEqual(store.status_counts(), {'UBS': {'SUCCESS': 2}, 'HPH': {'SUCCESS': 1}})
+        store.close()
+
+        # The metrics file keeps the progress of the files merged since the start of the service
+        with open(os.path.join(self.watch_dir, 'merge.prom')) as f:
+            metrics = f.read().splitlines()
+        self.assertIn('alma_merge_rows_done{zone="UBS"} 2', metrics)
+        self.assertIn('alma_merge_rows_remaining{zone="HPH"} 0', metrics)
+        self.assertIn('alma_merge_outcomes_total{zone="UBS",status="SUCCESS"} 2', metrics)
+        self.assertIn('alma_merge_eta_seconds 0', metrics)
+
+        # The logs and the step durations are written to the log directory of the service
+        self.assertEqual(sorted(os.listdir(self.log_dir)), ['log_daemon.txt', 'metrics_daemon.jsonl'])
+
+    def test_skip_merged(self):
+        self.drop('first.csv', [('f1@test.ch', 't1@test.ch', 'UBS')])
+        self.serve_until([('done', 'first.csv')])
+        request_counts = dict(self.alma.request_counts)
+
+        # The same pair dropped again is skipped without any call to Alma
+        with open(os.path.join(self.watch_dir, 'inbox', 'again.csv'), 'w') as f:
+            f.write('from_user,to_user,zone\nf1@test.ch,t1@test.ch,UBS\n')
+        self.serve_until([('done', 'again.csv')])
+
+        df = pd.read_csv(self.taken('done', 'again.csv')[0], dtype=str)
+        self.assertEqual(list(df['Merge_status']), ['SUCCESS'])
+        self.assertEqual(self.alma.request_counts, request_counts)
+
+    def test_same_name(self):
+        # A file dropped again under the same name, even in the same second, does not overwrite
+        # the merged one or reuse its journal
+        with mock.patch('daemon.datetime') as now:
+            now.now.return_value = datetime(2026, 1, 5, 8, 0, 0)
+            self.drop('merge.csv', [('f1@test.ch', 't1@test.ch', 'UBS')])
+            self.serve_until([('done', 'merge.csv')])
+            self.drop('merge.csv', [('f2@test.ch', 't2@test.ch', 'UBS')])
+            self.serve_until([('done', 'merge.csv'), ('done', 'merge.csv')])
+
+        first, second = self.taken('done', 'merge.csv')
+        self.assertEqual([os.path.basename(first), os.path.basename(second)],
+                         ['merge_20260105-080000.csv', 'merge_20260105-080000_1.csv'])
+        self.assertEqual(list(pd.read_csv(first, dtype=str)['from_user']), ['f1@test.ch'])
+        self.assertEqual(list(pd.read_csv(second, dtype=str)['from_user']), ['f2@test.ch'])
+        self.assertEqual(list(pd.read_csv(second, dtype=str)['Merge_status']), ['SUCCESS'])
+        self.assertEqual(len(self.taken('done', 'merge.jsonl')), 2)
+        self.assertIsNone(self.alma.get_user('UBS', 'f2@test.ch'))
+
+    def test_resume_processing(self):
+        self.drop('left.csv', [('f1@test.ch', 't1@test.ch', 'UBS'), ('f2@test.ch', 't2@test.ch', 'UBS')])
+        path = os.path.join(self.watch_dir, 'processing', 'left.csv')
+        os.replace(os.path.join(self.watch_dir, 'inbox', 'left.csv'), path)
+        journal = StatusJournal(os.path.join(self.watch_dir, 'processing', 'left.jsonl'))
+        journal.record(0, 'f1@test.ch', 't1@test.ch', 'UBS', 'SUCCESS')
+        journal.close()
+
+        self.serve_until([('done', 'left.csv')])
+
+        df = pd.read_csv(os.path.join(self.watch_dir, 'done', 'left.csv'), dtype=str)
+        self.assertEqual(list(df['Merge_status']), ['SUCCESS', 'SUCCESS'])
+        # The row restored from the journal is not merged again
+        self.assertIsNotNone(self.alma.get_user('UBS', 'f1@test.ch'))
+        self.assertIsNone(self.alma.get_user('UBS', 'f2@test.ch'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+from unittest import mock
+
+import requests
+from almapiwrapper.users import NewUser, User
+
+import benchmark
+from tests.fakealma import FakeAlma, MERGE_JOB_ID
+from utils.httpmerger import HttpMerger
+from utils.jobs import MergeJobTracker
+from utils.mergeprocess import MergeProcessError, UserNotFoundError, get_user_data
+from utils.staff import TempStaffUser
+from utils.userapi import ApiQuotaError, UserApiClient, set_client
+
+
+class FakeBrowser:
+    """Login browser of HttpMerger, replaced by a form post to the stand-in."""
+    def __init__(self, temp_staff, headless=True, timings=None):
+        self.temp_staff = temp_staff
+        self.timings = timings
+        self.driver = mock.Mock()
+        self.driver.execute_script.return_value = 'FakeBrowser'
+        self.http = requests.Session()
+
+    def login(self):
+        zone = self.temp_staff.zone
+        r = self.http.post(self.temp_staff.alma_url.split('?')[0],
+                           data={'zone': zone, 'username': self.temp_staff.primary_id, 'password': 'x'})
+        self.driver.current_url = r.url
+        self.driver.get_cookies.return_value = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path}
+                                                for c in self.http.cookies]
+
+    def open_merge_users_page(self):
+        self.driver.current_url = self.driver.current_url.replace('/home', '/merge')
+
+    def wait_ready(self, step, condition):
+        pass
+
+    @staticmethod
+    def page_loaded(driver):
+        return True
+
+    def logout(self):
+        self.http.cookies.clear()
+
+    def quit(self):
+        self.http.close()
+
+
+class TestFakeAlma(unittest.TestCase):
+    def setUp(self):
+        self.alma = FakeAlma().start()
+        self.installed = self.alma.install(['UBS', 'HPH'])
+        self.installed.__enter__()
+        self.alma.add_user('UBS', 'from@test.ch', internal_blocks=1)
+        self.alma.add_user('UBS', 'to@test.ch')
+
+    def tearDown(self):
+        self.installed.__exit__(None, None, None)
+        self.alma.stop()
+
+    def test_users_api(self):
+        u = get_user_data('from@test.ch', 'UBS', 'S')
+        self.assertEqual(len(u.data['user_block']), 1)
+        u.data['user_identifier'] = []
+        u.update()
+        self.assertFalse(u.error)
+        self.assertEqual(self.alma.get_user('UBS', 'from@test.ch')['user_identifier'], [])
+        with self.assertRaises(UserNotFoundError):
+            get_user_data('from@test.ch', 'HPH', 'S')
+
+        User('from@test.ch', 'UBS', 'S').delete()
+        self.assertIsNone(self.alma.get_user('UBS', 'from@test.ch'))
+
+    def test_staff_account(self):
+        temp_staff = TempStaffUser('automation_ubs@slsp.ch', 'UBS').create_staff_account()
+        self.assertFalse(temp_staff.temp_user.error)
+        self.assertIsNotNone(self.alma.get_user('UBS', 'automation_ubs@slsp.ch'))
+        self.assertTrue(temp_staff.alma_url.startswith(self.alma.url))
+        temp_staff.delete()
+        self.assertIsNone(self.alma.get_user('UBS', 'automation_ubs@slsp.ch'))
+
+    def test_staff_account_over_quota(self):
+        client = UserApiClient()
+        previous = set_client(client)
+        try:
+            temp_staff = TempStaffUser('automation_ubs@slsp.ch', 'UBS').create_staff_account()
+            client.max_calls = client.calls
+            with self.assertRaises(ApiQuotaError):
+                get_user_data('to@test.ch', 'UBS', 'S')
+            # The temp staff account is deleted anyway
+            temp_staff.delete()
+        finally:
+            set_client(previous)
+            client.close()
+        self.assertIsNone(self.alma.get_user('UBS', 'automation_ubs@slsp.ch'))
+
+    def test_new_user_already_exists(self):
+        u = NewUser(data=User('to@test.ch', 'UBS', 'S').data, zone='UBS', env='S').create(password='x')
+        self.assertTrue(u.error)
+
+    def test_http_merger(self):
+        temp_staff = TempStaffUser('automation_ubs@slsp.ch', 'UBS').create_staff_account()
+        with mock.patch('utils.httpmerger.AlmaMerger', FakeBrowser):
+            merger = HttpMerger(temp_staff)
+            merger.login()
+            merger.open_merge_users_page()
+            merger.reset_page()
+            job_id = merger.merge_users('from@test.ch', 'to@test.ch')
+            merger.quit()
+
+        self.assertIsNone(self.alma.get_user('UBS', 'from@test.ch'))
+        self.assertEqual(self.alma.get_user('UBS', 'to@test.ch')['user_block'][0]['segment_type'], 'Internal')
+        self.assertEqual(MergeJobTracker('UBS', 'S').get_states(), {job_id: 'COMPLETED_SUCCESS'})
+        self.assertEqual(MergeJobTracker('UBS', 'S').job_definition_id, MERGE_JOB_ID)
+
+    def test_http_merger_logged_out(self):
+        temp_staff = TempStaffUser('automation_ubs@slsp.ch', 'UBS').create_staff_account()
+        with mock.patch('utils.httpmerger.AlmaMerger', FakeBrowser):
+            merger = HttpMerger(temp_staff)
+            merger.login()
+            merger.open_merge_users_page()
+            merger.http.cookies.clear()
+            with self.assertRaises(MergeProcessError):
+                merger.reset_page()
+
+    def test_ui_errors(self):
+        self.alma.error_rate = 1
+        temp_staff = TempStaffUser('automation_ubs@slsp.ch', 'UBS').create_staff_account()
+        with mock.patch('utils.httpmerger.AlmaMerger', FakeBrowser):
+            merger = HttpMerger(temp_staff)
+            merger.login()
+            merger.open_merge_users_page()
+            with self.assertRaises(MergeProcessError):
+                merger.merge_users('from@test.ch', 'to@test.ch')
+        self.assertIsNotNone(self.alma.get_user('UBS', 'from@test.ch'))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmark(self):
+        with mock.patch('utils.httpmerger.AlmaMerger', FakeBrowser):
+            r = benchmark.run_benchmark(10, backend='http', zone_workers=2, zones=2)
+        self.assertEqual(r['merged'], 10)
+        self.assertEqual(r['restarts'], 0)
+        self.assertGreater(r['merges_per_sec'], 0)
+        self.assertGreater(r['peak_memory_mb'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from utils.httpmerger import HttpMerger
+from utils.mergeprocess import MergeProcessError
+
+MERGE_FORM = b"""<html><body>
+<form action="/mng/action/merge.do" method="post">
+  <input type="hidden" name="pageBean.token" value="abc"/>
+  <input type="text" name="pageBean.fromUser" value=""/>
+  <button id="PICKUP_ID_pageBeandisplayNameOfFromUserOrUserIdendifier">pick</button>
+  <input type="text" name="pageBean.toUser" value=""/>
+  <button id="PICKUP_ID_pageBeandisplayNameOfToUserOrUserIdendifier">pick</button>
+  <input type="checkbox" name="pageBean.params" value="PARAM_COPY_ATTACHMENTS" checked="checked"/>
+  <input type="checkbox" name="pageBean.params" value="PARAM_COPY_NOTES"/>
+  <input type="checkbox" name="pageBean.params" value="PARAM_COPY_DEMERITS"/>
+  <input type="checkbox" name="pageBean.params" value="PARAM_COPY_PROXY_OF"/>
+  <input type="submit" id="PAGE_BUTTONS_cbuttonmerge" name="pageBean.button" value="merge"/>
+</form></body></html>"""
+
+
+def make_response(content: bytes, url: str = 'https://alma.example.org/mng/action/home.do') -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r._content = content
+    r.url = url
+    return r
+
+
+class TestHttpMerger(unittest.TestCase):
+    def setUp(self):
+        # The form handling does not need the login browser
+        self.merger = HttpMerger.__new__(HttpMerger)
+        self.merger.http = mock.Mock()
+        self.merger.http.post.return_value = make_response(b'<html></html>')
+        self.merger.timeout = 10
+
+    def test_submit(self):
+        form = make_response(MERGE_FORM)
+        values = self.merger.user_fields(form, HttpMerger.FROM_USER_ID, 'from@test.ch')
+        values += self.merger.user_fields(form, HttpMerger.TO_USER_ID, 'to@test.ch')
+        checked = [('pageBean.params', param) for param in HttpMerger.COPY_PARAMS]
+        self.merger.submit(form, HttpMerger.MERGE_BUTTON_ID, values, checked)
+
+        args, kwargs = self.merger.http.post.call_args
+        self.assertEqual(args[0], 'https://alma.example.org/mng/action/merge.do')
+        fields = kwargs['data']
+        self.assertIn(('pageBean.token', 'abc'), fields)
+        self.assertIn(('pageBean.fromUser', 'from@test.ch'), fields)
+        self.assertIn(('pageBean.toUser', 'to@test.ch'), fields)
+        self.assertEqual(fields.count(('pageBean.params', 'PARAM_COPY_ATTACHMENTS')), 1)
+        self.assertIn(('pageBean.params', 'PARAM_COPY_PROXY_OF'), fields)
+        self.assertIn(('pageBean.button', 'merge'), fields)
+
+    def test_missing_element(self):
+        with self.assertRaises(MergeProcessError):
+            self.merger.submit(make_response(MERGE_FORM), 'PAGE_BUTTONS_unknown')
+
+    def test_logged_out(self):
+        login_page = make_response(b'<input id="username"/><input id="password"/>')
+        with self.assertRaises(MergeProcessError) as cm:
+            self.merger.check_response(login_page)
+        self.assertTrue(cm.exception.transient)
+
+    def test_http_errors(self):
+        r = make_response(b'')
+        r.status_code = 503
+        with self.assertRaises(MergeProcessError) as cm:
+            self.merger.check_response(r)
+        self.assertTrue(cm.exception.transient)
+        r.status_code = 400
+        with self.assertRaises(MergeProcessError) as cm:
+            self.merger.check_response(r)
+        self.assertFalse(cm.exception.transient)
+
+
+if __name__ == '__main__':
+    unittest.main()
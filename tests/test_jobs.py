@@ -0,0 +1,130 @@
+import unittest
+from unittest import mock
+
+import pandas as pd
+from almapiwrapper.record import JsonData
+
+from utils.jobs import JobPoller, MergeJobTracker, check_merged_users
+from utils.mergeprocess import UserNotFoundError
+from utils.results import MergeResults
+from utils.userapi import ApiQuotaError, ApiThrottledError
+
+
+class TestMergeJobTracker(unittest.TestCase):
+    def test_get_states(self):
+        instances = JsonData({'job_instance': [{'id': '111', 'status': {'value': 'COMPLETED_SUCCESS'}},
+                                               {'id': '222', 'status': {'value': 'RUNNING'}}]})
+        with mock.patch('utils.jobs.Job') as job:
+            job.return_value.error = False
+            job.return_value.get_instances.return_value = instances
+            tracker = MergeJobTracker('UBS', 'S', job_definition_id='M42')
+            self.assertEqual(tracker.get_states(), {'111': 'COMPLETED_SUCCESS', '222': 'RUNNING'})
+            self.assertEqual(tracker.wait('111', interval=0), 'COMPLETED_SUCCESS')
+        job.assert_called_with('M42', 'UBS', 'S')
+
+    def test_get_states_throttled(self):
+        with mock.patch('utils.jobs.Job') as job, mock.patch('utils.jobs.get_client') as client:
+            client.return_value.bind.side_effect = lambda record: record
+            job.return_value.get_instances.side_effect = ApiThrottledError('throttled')
+            tracker = MergeJobTracker('UBS', 'S', job_definition_id='M42')
+            self.assertEqual(tracker.get_states(), {})
+        # The call goes through the shared API client
+        client.return_value.bind.assert_called_once_with(job.return_value)
+
+    def test_get_states_without_job_id(self):
+        tracker = MergeJobTracker('UBS', 'S', job_definition_id=None)
+        tracker.job_definition_id = None
+        self.assertEqual(tracker.get_states(), {})
+
+    def test_wait_for_merges_without_job_id(self):
+        tracker = MergeJobTracker('UBS', 'S')
+        tracker.job_definition_id = None
+        checks = [{'a': True, 'b': False}, {'b': True}]
+        with mock.patch('utils.jobs.check_merged_users', side_effect=checks) as check:
+            merged = tracker.wait_for_merges('111', ['a', 'b'], interval=0)
+        self.assertEqual(merged, {'a': True, 'b': True})
+        self.assertEqual(check.call_args_list[1].args[0], ['b'])
+
+    def test_wait_for_merges_unknown(self):
+        tracker = MergeJobTracker('UBS', 'S', job_definition_id='M42')
+        checks = [{'a': True, 'b': False, 'c': None}, {'c': True}]
+        with mock.patch.object(MergeJobTracker, 'wait', return_value='COMPLETED_SUCCESS'), \
+                mock.patch('utils.jobs.check_merged_users', side_effect=checks) as check:
+            merged = tracker.wait_for_merges('111', ['a', 'b', 'c'], interval=0)
+        # Once the job is finished, only the user whose lookup failed is checked again
+        self.assertEqual(merged, {'a': True, 'b': False, 'c': True})
+        self.assertEqual(check.call_args_list[1].args[0], ['c'])
+
+    def test_check_merged_users(self):
+        users = {'a': UserNotFoundError('User a does not exist.'), 'b': object(), 'c': ApiThrottledError('429'),
+                 'd': ApiQuotaError('quota')}
+        with mock.patch('utils.jobs.prefetch_users', return_value=users):
+            self.assertEqual(check_merged_users(['a', 'b', 'c', 'd'], 'UBS', 'S'),
+                             {'a': True, 'b': False, 'c': None, 'd': None})
+
+
+class TestJobPoller(unittest.TestCase):
+    def setUp(self):
+        df = pd.DataFrame({'from_user': ['a', 'b', 'c'], 'to_user': ['x', 'y', 'z'], 'zone': ['UBS'] * 3,
+                           'Merge_status': ['NOT PROCESSED'] * 3})
+        self.results = MergeResults(df, 'unused.csv')
+        self.poller = JobPoller(self.results, 'S', interval=0)
+
+    def test_poll_with_job_states(self):
+        with mock.patch.dict('os.environ', {'ALMA_MERGE_JOB_ID': 'M42'}):
+            for i, from_user in enumerate(['a', 'b', 'c']):
+                self.poller.track(i, 'UBS', from_user, str(100 + i))
+        self.assertEqual(self.results.get_status(0), 'SUBMITTED')
+        self.assertEqual(self.results.get_job_id(0), '100')
+
+        states = {'100': 'COMPLETED_SUCCESS', '101': 'COMPLETED_FAILED', '102': 'RUNNING'}
+        with mock.patch.object(MergeJobTracker, 'get_states', return_value=states), \
+                mock.patch('utils.jobs.check_merged_users', return_value={'a': True, 'b': False}) as check:
+            self.poller.poll()
+        self.assertEqual(check.call_args.args[0], ['a', 'b'])
+        self.assertEqual([self.results.get_status(i) for i in range(3)], ['COMPLETED', 'FAILED', 'SUBMITTED'])
+        self.assertEqual(len(self.poller), 1)
+
+    def test_poll_unknown(self):
+        with mock.patch.dict('os.environ', {'ALMA_MERGE_JOB_ID': 'M42'}):
+            self.poller.track(0, 'UBS', 'a', '100')
+        with mock.patch.object(MergeJobTracker, 'get_states', return_value={'100': 'COMPLETED_SUCCESS'}):
+            with mock.patch('utils.jobs.check_merged_users', return_value={'a': None}):
+                self.poller.poll()
+            # A failed lookup is not a failed merge, the row is checked again at the next cycle
+            self.assertEqual(self.results.get_status(0), 'SUBMITTED')
+            with mock.patch('utils.jobs.check_merged_users', return_value={'a': True}):
+                self.poller.poll()
+        self.assertEqual(self.results.get_status(0), 'COMPLETED')
+        self.assertEqual(len(self.poller), 0)
+
+    def test_poll_without_job_states(self):
+        with mock.patch.dict('os.environ', {}, clear=True):
+            self.poller.track(0, 'UBS', 'a', '100')
+            self.poller.track(1, 'UBS', 'b', '100')
+        with mock.patch('utils.jobs.check_merged_users', return_value={'a': True, 'b': False}):
+            self.poller.poll()
+        self.assertEqual(self.results.get_status(0), 'COMPLETED')
+        self.assertEqual(self.results.get_status(1), 'SUBMITTED')
+
+    def test_poll_system_exit(self):
+        with mock.patch.dict('os.environ', {}, clear=True):
+            self.poller.track(0, 'UBS', 'a', '100')
+        with mock.patch('utils.jobs.check_merged_users', side_effect=[SystemExit(1), {'a': True}]):
+            self.poller.start()
+            self.poller.close(timeout=5)
+        # The poller thread survives the error and finishes the row at the next cycle
+        self.assertEqual(self.results.get_status(0), 'COMPLETED')
+
+    def test_close_drains_pending_jobs(self):
+        with mock.patch.dict('os.environ', {}, clear=True):
+            self.poller.track(0, 'UBS', 'a', '100')
+        with mock.patch('utils.jobs.check_merged_users', return_value={'a': True}):
+            self.poller.start()
+            self.poller.close(timeout=5)
+        self.assertEqual(self.results.get_status(0), 'COMPLETED')
+        self.assertEqual(len(self.poller), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
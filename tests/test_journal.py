@@ -0,0 +1,53 @@
+import unittest
+import os
+import tempfile
+
+from utils.journal import StatusJournal
+
+
+class TestStatusJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'journal.jsonl')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_last_entry_wins(self):
+        journal = StatusJournal(self.path)
+        journal.record(0, 'a', 'b', 'UBS', 'FAIL', error_class='MergeProcessError', error='Add Job button')
+        journal.record(0, 'a', 'b', 'UBS', 'SUCCESS', job_id='42')
+        journal.close()
+        entries = StatusJournal(self.path).replay()
+        self.assertEqual(entries[0]['status'], 'SUCCESS')
+        self.assertEqual(entries[0]['job_id'], '42')
+
+    def test_truncated_line(self):
+        journal = StatusJournal(self.path)
+        journal.record(0, 'a', 'b', 'UBS', 'SUCCESS')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"row": 1, "stat')
+
+        journal = StatusJournal(self.path)
+        journal.record(2, 'c', 'd', 'UBS', 'SUCCESS')
+        entries = journal.replay()
+        journal.close()
+        self.assertEqual(sorted(entries), [0, 2])
+
+    def test_blocks_copied(self):
+        journal = StatusJournal(self.path)
+        journal.record(0, 'a', 'b', 'UBS', 'IN_FLIGHT')
+        journal.record(0, 'a', 'b', 'UBS', 'IN_FLIGHT', blocks_copied=True)
+        journal.record(0, 'a', 'b', 'UBS', 'RETRY')
+        journal.record(1, 'c', 'd', 'UBS', 'IN_FLIGHT', blocks_copied=True)
+        journal.record(1, 'e', 'd', 'UBS', 'IN_FLIGHT')
+        entries = journal.replay()
+        journal.close()
+        self.assertTrue(entries[0]['blocks_copied'])
+        # The flag of another pair of users is not kept, the input file was edited
+        self.assertNotIn('blocks_copied', entries[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
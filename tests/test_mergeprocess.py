@@ -1,11 +1,14 @@
 import unittest
 from typing import FrozenSet
+from unittest import mock
 
 from utils.mergeprocess import AlmaMerger, MergeProcessError
+from utils.metrics import StepTimings
 from utils.staff import TempStaffUser
 from dotenv import load_dotenv
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from almapiwrapper.users import User, NewUser
 from almapiwrapper.configlog import config_log
 import logging
@@ -46,5 +49,65 @@ class TestMergeProcess(unittest.TestCase):
             self.fail("MergeProcessError raised during merge_users")
         merger.driver.quit()
 
+class TestMergeStep(unittest.TestCase):
+    def setUp(self):
+        # The steps do not need a browser
+        self.merger = AlmaMerger.__new__(AlmaMerger)
+        self.merger.timings = StepTimings('UBS')
+
+    def test_step_success(self):
+        with self.merger.step('Add Job button'):
+            pass
+        self.assertEqual(self.merger.timings.summary()['Add Job button']['count'], 1)
+
+    def test_step_error(self):
+        with self.assertRaises(MergeProcessError) as cm:
+            with self.merger.step('Add Job button'):
+                raise TimeoutError()
+        self.assertEqual(str(cm.exception), 'Add Job button: TimeoutError')
+        self.assertIsInstance(cm.exception.__cause__, TimeoutError)
+        self.assertEqual(self.merger.timings.summary()['Add Job button']['count'], 1)
+
+    def test_step_classification(self):
+        with self.assertRaises(MergeProcessError) as cm:
+            with self.merger.step('search_user_in_iframe (from_user)'):
+                with self.merger.step('user table', 'search_user_in_iframe'):
+                    raise TimeoutException()
+        self.assertEqual(str(cm.exception), 'search_user_in_iframe (from_user): user table: TimeoutException')
+        self.assertEqual((cm.exception.step, cm.exception.cause, cm.exception.transient),
+                         ('user table', 'TimeoutException', True))
+
+        with self.assertRaises(MergeProcessError) as cm:
+            with self.merger.step('Add Job button'):
+                raise NoSuchElementException()
+        self.assertFalse(cm.exception.transient)
+
+        # The merge job may be running, the merge is not submitted again
+        with self.assertRaises(MergeProcessError) as cm:
+            with self.merger.step('start button'):
+                raise TimeoutException()
+        self.assertFalse(cm.exception.transient)
+
+    def test_checkbox_retry(self):
+        self.merger.driver = None
+        self.merger.settle_delay = 0
+        self.merger.wait = mock.Mock()
+        checkbox = mock.Mock(**{'is_selected.return_value': True})
+        # The first checkbox is missing twice, and never becomes clickable in between
+        self.merger.wait.until.side_effect = [True, TimeoutException(), TimeoutException()] + [checkbox] * 4
+        with mock.patch('utils.mergeprocess.WebDriverWait') as wait:
+            wait.return_value.until.side_effect = TimeoutException()
+            self.merger.select_merge_options()
+        self.assertEqual(self.merger.wait.until.call_count, 7)
+        self.assertEqual(wait.return_value.until.call_count, 2)
+
+        self.merger.wait.until.side_effect = [True] + [TimeoutException()] * 3
+        with mock.patch('utils.mergeprocess.WebDriverWait') as wait:
+            wait.return_value.until.side_effect = TimeoutException()
+            with self.assertRaises(MergeProcessError) as cm:
+                self.merger.select_merge_options()
+        self.assertEqual(cm.exception.cause, 'TimeoutException')
+
+
 if __name__ == '__main__':
     unittest.main()
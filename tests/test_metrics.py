@@ -0,0 +1,58 @@
+import unittest
+import json
+import os
+import tempfile
+
+from utils.metrics import MetricsFile, StepTimings, percentile
+
+
+class TestStepTimings(unittest.TestCase):
+    def test_summary(self):
+        timings = StepTimings()
+        timings.record('wait iframe', 1.0)
+        timings.record('wait iframe', 3.0)
+        with timings.measure('merge_users'):
+            pass
+        summary = timings.summary()
+        self.assertEqual(summary['wait iframe'], {'count': 2, 'mean': 2.0, 'p50': 1.0, 'p95': 3.0, 'max': 3.0})
+        self.assertEqual(summary['merge_users']['count'], 1)
+        self.assertEqual(len(timings.report()), 2)
+
+    def test_bounded_memory(self):
+        timings = StepTimings(sample_size=100)
+        timings._random.seed(0)
+        for i in range(10000):
+            timings.record('merge_users', i / 10000)
+        summary = timings.summary()['merge_users']
+        self.assertEqual(summary['count'], 10000)
+        self.assertAlmostEqual(summary['mean'], 0.49995)
+        self.assertEqual(summary['max'], 0.9999)
+        # The percentiles are estimated on a sample of the durations
+        self.assertEqual(len(timings._steps['merge_users']['sample']), 100)
+        self.assertAlmostEqual(summary['p50'], 0.5, delta=0.15)
+        self.assertAlmostEqual(summary['p95'], 0.95, delta=0.1)
+
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile([4.0], 0.95), 4.0)
+
+    def test_metrics_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics_file = MetricsFile(os.path.join(tmp_dir, 'metrics.jsonl'))
+            timings = StepTimings('UBS', metrics_file)
+            with self.assertRaises(ValueError):
+                with timings.measure('Add Job button'):
+                    raise ValueError()
+            metrics_file.close()
+            with open(metrics_file.path) as f:
+                entries = [json.loads(line) for line in f]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['zone'], 'UBS')
+        self.assertEqual(entries[0]['step'], 'Add Job button')
+        self.assertFalse(entries[0]['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import pandas as pd
+
+from merge import check_pairs
+from utils.pairgraph import CONFLICT, CYCLE, DUPLICATE, SELF_MERGE, plan_merges
+from utils.results import MergeResults
+
+
+class TestPlanMerges(unittest.TestCase):
+    def test_chains(self):
+        targets, rejected = plan_merges({0: ('a', 'b'), 1: ('b', 'c'), 2: ('c', 'd'), 3: ('x', 'b')})
+        self.assertEqual(targets, {0: 'd', 1: 'd', 2: 'd', 3: 'd'})
+        self.assertEqual(rejected, {})
+
+    def test_rejected_rows(self):
+        targets, rejected = plan_merges({0: ('a', 'a'), 1: ('a', 'b'), 2: ('a', 'b'), 3: ('a', 'c'),
+                                         4: ('p', 'q'), 5: ('q', 'r'), 6: ('r', 'p'), 7: ('s', 'p')})
+        self.assertEqual(targets, {1: 'b'})
+        self.assertEqual({i: status for i, (status, _) in rejected.items()},
+                         {0: SELF_MERGE, 2: DUPLICATE, 3: CONFLICT, 4: CYCLE, 5: CYCLE, 6: CYCLE, 7: CYCLE})
+
+    def test_done_pairs(self):
+        targets, rejected = plan_merges({0: ('x', 'a'), 1: ('a', 'b'), 2: ('a', 'c')}, [('a', 'b')])
+        self.assertEqual(targets, {0: 'b'})
+        self.assertEqual(rejected[1][0], DUPLICATE)
+        self.assertEqual(rejected[2][0], CONFLICT)
+
+    def test_long_chain(self):
+        pairs = {i: (f'u{i}', f'u{i + 1}') for i in range(100000)}
+        targets, rejected = plan_merges(pairs)
+        self.assertEqual(set(targets.values()), {'u100000'})
+
+
+class TestCheckPairs(unittest.TestCase):
+    def test_check_pairs(self):
+        df = pd.DataFrame({'from_user': ['a', 'b', 'c', 'd'], 'to_user': ['b', 'c', 'c', 'e'], 'zone': ['UBS'] * 4,
+                           'Merge_status': ['NOT PROCESSED', 'NOT PROCESSED', 'NOT PROCESSED', 'SUCCESS']})
+        results = MergeResults(df, 'unused.csv')
+        data = check_pairs('UBS', df, results)
+        self.assertEqual(list(data.index), [0, 1, 3])
+        self.assertEqual(list(data['to_user']), ['c', 'c', 'e'])
+        self.assertEqual(results.get_status(2), SELF_MERGE)
+        self.assertEqual(df.at[0, 'Merge_target'], 'c')
+        self.assertEqual(df.at[0, 'to_user'], 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
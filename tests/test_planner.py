@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+
+from utils.journal import StatusJournal
+from utils.mergeprocess import UserNotFoundError
+from utils.planner import (DEFAULT_STEP_SECONDS, estimate_zone, format_duration, load_step_timings, plan,
+                           plan_report, total_wall_time)
+
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        os.mkdir('log')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def write_metrics(self, entries):
+        with open('log/metrics_previous.jsonl', 'w') as f:
+            for zone, step, seconds, ok in entries:
+                f.write(json.dumps({'zone': zone, 'step': step, 'seconds': seconds, 'ok': ok}) + '\n')
+            f.write('{"truncated\n')
+
+    def test_load_step_timings(self):
+        self.write_metrics([('UBS', 'merge_users', 10, True), ('UBS', 'merge_users', 20, True),
+                            ('UBS', 'merge_users', 100, False), ('HPH', 'merge_users', 6, True)])
+        timings = load_step_timings(['log/metrics_previous.jsonl', 'log/missing.jsonl'])
+        self.assertEqual(timings['UBS'], {'merge_users': 15})
+        self.assertEqual(timings[None], {'merge_users': 12})
+
+    def test_estimate_zone(self):
+        steps = {'open_sessions': 10, 'get_user_data': 1, 'merge_users': 5, 'merge_users_batch': 20,
+                 'copy_internal_blocks': 0.5}
+        e = estimate_zone(10, 16, steps, sessions=2, api_workers=4)
+        self.assertEqual(e['wall_time'], 10 + 4 * 1 + 3 * 0.5 + 5 * 5)
+        self.assertEqual((e['submissions'], e['get_calls'], e['put_calls'], e['put_calls_max'], e['staff_calls']),
+                         (10, 16, None, 20, 4))
+
+        e = estimate_zone(10, 16, steps, sessions=2, api_workers=4, batch_size=4, block_rate=0.2,
+                          verify_merges=True, share_staff=True)
+        self.assertEqual(e['wall_time'], 10 + 4 * 1 + 1 * 0.5 + 2 * 20 + 3 * 1)
+        self.assertEqual((e['submissions'], e['get_calls'], e['put_calls'], e['staff_calls']), (3, 26, 4, 2))
+
+        self.assertEqual(estimate_zone(10, 16, steps, staff_pool=True)['staff_calls'], 0)
+
+        # The 'to' user of several rows receives their blocks with one update
+        e = estimate_zone(4, 5, steps, batch_size=4, block_rate=0.5, targets=[3, 1])
+        self.assertEqual((e['put_calls'], e['put_calls_max']), (3, 6))
+        self.assertEqual(e['wall_time'], 10 + 2 * 1 + 1 * 0.5 + 1 * 20)
+
+    def test_total_wall_time(self):
+        self.assertEqual(total_wall_time([5, 3, 2], zone_workers=1), 10)
+        self.assertEqual(total_wall_time([5, 3, 2], zone_workers=2), 5)
+        self.assertEqual(total_wall_time([1, 1, 4], zone_workers=2), 5)
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(42.4), '42s')
+        self.assertEqual(format_duration(270), '4m30s')
+        self.assertEqual(format_duration(3900), '1h05m')
+
+    def test_plan(self):
+        pd.DataFrame({'from_user': ['a', 'b', 'c', 'c', 'd', 'e', 'f'],
+                      'to_user': ['x', 'x', 'x', 'x', 'd', 'y', 'z'],
+                      'zone': ['UBS', 'UBS', 'UBS', 'UBS', 'UBS', 'HPH', 'HPH']}).to_csv('plan.csv', index=False)
+        journal = StatusJournal('log/journal_plan.jsonl')
+        journal.record(0, 'a', 'x', 'UBS', 'SUCCESS')
+        journal.close()
+        self.write_metrics([('UBS', 'merge_users', 8, True), ('HPH', 'merge_users', 4, True)])
+
+        def prefetch_users(primary_ids, zone, env, max_workers=4):
+            blocks = {'b': [{'segment_type': 'Internal'}], 'c': [{'segment_type': 'External'}]}
+            return {primary_id: SimpleNamespace(data={'user_block': blocks.get(primary_id, [])})
+                    if primary_id != 'f' else UserNotFoundError(primary_id) for primary_id in primary_ids}
+
+        with mock.patch('utils.planner.prefetch_users', side_effect=prefetch_users):
+            estimate = plan('plan.csv', zone_sessions=2, sample_size=10)
+
+        # Row 0 is done, row 3 is a duplicate and row 4 a self merge
+        ubs, hph = estimate['zones']['UBS'], estimate['zones']['HPH']
+        self.assertEqual((ubs['rows'], ubs['users'], ubs['put_calls']), (2, 3, 2))
+        self.assertEqual((hph['rows'], hph['users'], hph['put_calls']), (2, 4, 0))
+        self.assertEqual(list(estimate['zones']), ['HPH', 'UBS'])
+        self.assertEqual(ubs['wall_time'], DEFAULT_STEP_SECONDS['open_sessions'] + DEFAULT_STEP_SECONDS['get_user_data']
+                         + DEFAULT_STEP_SECONDS['copy_internal_blocks'] + 8)
+        self.assertEqual(list(ubs['levels']), [1, 2, 4, 8])
+        self.assertEqual(ubs['levels'][1], ubs['wall_time'] + 8)
+        self.assertEqual(estimate['total']['wall_time'], ubs['wall_time'] + hph['wall_time'])
+        self.assertEqual(estimate['total']['sample_calls'], 4)
+
+        lines = plan_report(estimate)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[2].startswith('Total: 4 merges in 2 zones'))
+        self.assertIn('2 PUT', lines[2])
+
+    def test_plan_without_sample(self):
+        pd.DataFrame({'from_user': ['a'], 'to_user': ['x'], 'zone': ['UBS']}).to_csv('plan.csv', index=False)
+        estimate = plan('plan.csv')
+        self.assertIsNone(estimate['total']['put_calls'])
+        self.assertIn('up to 2 PUT', plan_report(estimate)[-2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+
+from merge import check_users, close_sessions, merge_rows, merge_zone, run_batch_session, run_session
+from utils.mergeprocess import MergeProcessError, UserNotFoundError
+from utils.preflight import prefetch_users
+from utils.results import IN_FLIGHT, RETRY, MergeResults
+from utils.userapi import ApiQuotaError, ApiThrottledError
+from utils.workqueue import RowQueue
+
+
+def user(primary_id, internal_blocks=0):
+    return SimpleNamespace(primary_id=primary_id, data={'user_block': [{'segment_type': 'Internal'}] * internal_blocks})
+
+
+class TestPrefetchUsers(unittest.TestCase):
+    def test_prefetch_users(self):
+        def get_user_data(primary_id, zone, env):
+            if primary_id == 'missing':
+                raise UserNotFoundError(f'User {primary_id} does not exist.')
+            return f'{primary_id}_{zone}_{env}'
+
+        with mock.patch('utils.preflight.get_user_data', side_effect=get_user_data) as m:
+            users = prefetch_users(['a', 'b', 'a', 'missing'], 'UBS', 'S', max_workers=2)
+
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(users['a'], 'a_UBS_S')
+        self.assertIsInstance(users['missing'], UserNotFoundError)
+
+
+class TestInFlight(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'from_user': ['a', 'b', 'c', 'd'], 'to_user': ['x', 'x', 'x', 'x'],
+                                'zone': ['UBS'] * 4,
+                                'Merge_status': [IN_FLIGHT, IN_FLIGHT, 'SUCCESS', 'NOT PROCESSED']})
+        self.results = MergeResults(self.df, 'unused.csv')
+
+    def test_check_users_reconciles(self):
+        users = {'a': UserNotFoundError('a'), 'b': 'b', 'd': 'd', 'x': 'x'}
+        with mock.patch('merge.prefetch_users', return_value=users) as m:
+            valid, _ = check_users('UBS', self.df, self.results)
+
+        # Only the 'from' users of the rows not done are fetched, the crashed merge of 'a' is done
+        self.assertEqual(set(m.call_args[0][0]), {'a', 'b', 'd', 'x'})
+        self.assertEqual(valid, [1, 3])
+        self.assertEqual(list(self.df['Merge_status']), ['SUCCESS', IN_FLIGHT, 'SUCCESS', 'NOT PROCESSED'])
+
+    def test_check_users_job_running(self):
+        users = {'a': 'a', 'b': 'b', 'd': 'd', 'x': 'x'}
+        with mock.patch('merge.prefetch_users', return_value=users), \
+                mock.patch('merge.MergeJobTracker.get_states', return_value={'5': 'COMPLETED_SUCCESS', '6': 'RUNNING'}):
+            valid, _ = check_users('UBS', self.df, self.results)
+
+        # The interrupted submissions may be the running job: they are not merged again
+        self.assertEqual(valid, [3])
+        self.assertEqual(list(self.df['Merge_status']), [IN_FLIGHT, IN_FLIGHT, 'SUCCESS', 'NOT PROCESSED'])
+
+        with mock.patch('merge.prefetch_users', return_value=users), \
+                mock.patch('merge.MergeJobTracker.get_states', return_value={'5': 'COMPLETED_SUCCESS'}) as states:
+            valid, _ = check_users('UBS', self.df, self.results)
+        self.assertEqual(valid, [0, 1, 3])
+        self.assertEqual(states.call_count, 1)
+
+    def test_checkpoint_before_submission(self):
+        statuses = []
+        session = mock.Mock()
+        session.merger.merge_users.side_effect = lambda *args: statuses.append(self.results.get_status(3)) or '42'
+        run_session(session, RowQueue([3]), self.df, {'d': user('d'), 'x': user('x')}, self.results, {})
+        self.assertEqual(statuses, [IN_FLIGHT])
+        self.assertEqual(self.results.get_status(3), 'SUCCESS')
+
+        session.merger.merge_users.side_effect = MergeProcessError('start button')
+        run_session(session, RowQueue([1]), self.df, {'b': user('b'), 'x': user('x')}, self.results, {})
+        self.assertEqual(self.results.get_status(1), 'FAIL')
+
+
+class TestQuota(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'from_user': ['a', 'b', 'c'], 'to_user': ['x', 'x', 'x'], 'zone': ['UBS'] * 3,
+                                'Merge_status': ['NOT PROCESSED'] * 3})
+        self.results = MergeResults(self.df, 'unused.csv')
+
+    def test_check_users(self):
+        users = {'a': user('a'), 'b': ApiQuotaError('quota'), 'c': user('c'), 'x': user('x')}
+        with mock.patch('merge.prefetch_users', return_value=users):
+            valid, _ = check_users('UBS', self.df, self.results)
+        self.assertEqual(valid, [0, 2])
+        self.assertEqual(self.results.get_status(1), 'NOT PROCESSED')
+
+    def test_run_session(self):
+        users = {'a': user('a'), 'b': user('b'), 'c': user('c'), 'x': user('x')}
+        session = mock.Mock()
+        session.merger.merge_users.side_effect = ['42', ApiQuotaError('quota'), '43']
+        run_session(session, RowQueue([0, 1, 2]), self.df, users, self.results, {})
+
+        # The session stops at the row refused by the quota, the next rows are left for the next run
+        self.assertEqual(list(self.df['Merge_status']), ['SUCCESS', 'NOT PROCESSED', 'NOT PROCESSED'])
+        self.assertEqual(session.merger.merge_users.call_count, 2)
+        session.recover.assert_not_called()
+
+    def test_merge_rows(self):
+        users = {'a': user('a'), 'b': user('b', internal_blocks=1), 'c': user('c'), 'x': user('x')}
+        session = mock.Mock()
+        with mock.patch('merge.copy_blocks', return_value={1: ApiQuotaError('quota')}):
+            merge_rows('UBS', self.df, [0, 1, 2], users, [session], self.results)
+
+        # No row is merged once the quota is reached by the copy of the internal blocks
+        self.assertEqual(list(self.df['Merge_status']), ['NOT PROCESSED'] * 3)
+        session.merger.merge_users.assert_not_called()
+
+    def test_close_sessions(self):
+        accounts = [mock.Mock(primary_id='staff_1'), mock.Mock(primary_id='staff_2')]
+        accounts[0].delete.side_effect = ApiQuotaError('quota')
+        close_sessions(accounts, [], mock.Mock())
+        accounts[1].delete.assert_called_once()
+
+
+class TestBatch(unittest.TestCase):
+    def test_unknown_outcome(self):
+        df = pd.DataFrame({'from_user': ['a', 'b'], 'to_user': ['x', 'x'], 'zone': ['UBS'] * 2,
+                           'Merge_status': ['NOT PROCESSED'] * 2})
+        results = MergeResults(df, 'unused.csv')
+        session = mock.Mock()
+        session.merger.merge_users_batch.return_value = '42'
+        tracker = mock.Mock(zone='UBS', env='S')
+        tracker.wait_for_merges.return_value = {'a': True, 'b': None}
+        users = {'a': user('a'), 'b': user('b'), 'x': user('x')}
+        run_batch_session(session, [[0, 1]], RowQueue([0]), df, users, results, tracker)
+
+        # The merge whose 'from' user could not be looked up is not failed
+        self.assertEqual(list(df['Merge_status']), ['SUCCESS', 'SUBMITTED'])
+        self.assertEqual(results.get_job_id(1), '42')
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'from_user': ['a', 'b'], 'to_user': ['x', 'y'], 'zone': ['UBS'] * 2,
+                                'Merge_status': ['NOT PROCESSED'] * 2})
+        self.results = MergeResults(self.df, 'unused.csv')
+        self.users = {'a': user('a', internal_blocks=1), 'b': user('b'), 'x': user('x'), 'y': user('y')}
+
+    def test_run_session(self):
+        session = mock.Mock()
+        session.merger.merge_users.side_effect = MergeProcessError('user table: TimeoutException', step='user table',
+                                                                   cause='TimeoutException', transient=True)
+        attempts = {}
+        run_session(session, RowQueue([0]), self.df, self.users, self.results, attempts, max_attempts=2)
+        self.assertEqual(self.results.get_status(0), RETRY)
+        run_session(session, RowQueue([0]), self.df, self.users, self.results, attempts, max_attempts=2)
+        self.assertEqual(self.results.get_status(0), 'FAIL')
+
+    def test_run_session_not_recovered(self):
+        session = mock.Mock()
+        session.merger.merge_users.side_effect = MergeProcessError('start button: TimeoutException',
+                                                                   step='start button', transient=False)
+        session.recover.side_effect = MergeProcessError('login failed')
+        rows = RowQueue([0])
+        run_session(session, rows, self.df, self.users, self.results, {})
+
+        # The merge job may be running: the row is not given to another session
+        self.assertEqual(self.results.get_status(0), 'FAIL')
+        self.assertIsNone(rows.get())
+
+        session.merger.merge_users.side_effect = MergeProcessError('user table: TimeoutException',
+                                                                   step='user table', transient=True)
+        rows = RowQueue([1])
+        run_session(session, rows, self.df, self.users, self.results, {})
+        self.assertEqual(rows.get(), 1)
+
+    def test_run_session_throttled(self):
+        session = mock.Mock()
+        session.merger.merge_users.side_effect = ApiThrottledError('throttled')
+        run_session(session, RowQueue([0]), self.df, self.users, self.results, {})
+
+        # The throttling of the API is not a browser problem: the session is not recovered
+        self.assertEqual(self.results.get_status(0), 'NOT PROCESSED')
+        session.recover.assert_not_called()
+
+    def test_merge_zone(self):
+        session = mock.Mock()
+        failures = {'a': [MergeProcessError('Add Job button: TimeoutException', transient=True)],
+                    'b': [MergeProcessError('No user found', transient=False)]}
+
+        def merge_users(from_user, *args):
+            if len(failures[from_user]) > 0:
+                raise failures[from_user].pop()
+            return '42'
+
+        session.merger.merge_users.side_effect = merge_users
+        warm = mock.Mock()
+        warm.get.return_value = [session]
+        with mock.patch('merge.prefetch_users', return_value=self.users) as m, \
+                mock.patch('merge.copy_blocks', return_value={}) as blocks:
+            merge_zone('UBS', self.df, self.results, pool=mock.Mock(), warm=warm)
+
+        # The transient failure is merged by the retry pass, after checking its users again
+        self.assertEqual(list(self.df['Merge_status']), ['SUCCESS', 'FAIL'])
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(session.merger.merge_users.call_count, 3)
+        # The blocks are copied before the first attempt of the row, not again for its retry
+        self.assertEqual([call.args[0] for call in blocks.call_args_list], [{0: ('a', 'x')}])
+        self.assertTrue(self.results.blocks_copied(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from utils.metrics import StepTimings
+from utils.progress import MetricsExporter, RunProgress, format_value, is_failure
+from utils.userapi import UserApiClient, set_client
+
+
+class TestRunProgress(unittest.TestCase):
+    def test_counts(self):
+        progress = RunProgress()
+        progress.add_rows('UBS', ['NOT PROCESSED', 'FAIL', 'SUCCESS', 'NOT PROCESSED'])
+        progress.update('UBS', 0, 'NOT PROCESSED', 'IN_FLIGHT')
+        progress.update('UBS', 0, 'IN_FLIGHT', 'SUCCESS')
+        # The row failed by a previous run is processed again
+        progress.update('UBS', 1, 'FAIL', 'IN_FLIGHT')
+        progress.update('UBS', 1, 'IN_FLIGHT', 'RETRY')
+        progress.update('UBS', 3, 'NOT PROCESSED', 'SELF_MERGE')
+
+        zone = progress.zones()['UBS']
+        self.assertEqual((zone['total'], zone['done'], zone['failed'], zone['remaining']), (4, 2, 1, 1))
+        self.assertGreater(zone['rate'], 0)
+        self.assertAlmostEqual(zone['eta'], 1 / zone['rate'])
+
+        # A submitted job failing moves its row from done to failed, without finishing it twice
+        progress.update('UBS', 1, 'RETRY', 'SUBMITTED')
+        progress.update('UBS', 1, 'SUBMITTED', 'FAILED')
+        zone = progress.zones()['UBS']
+        self.assertEqual((zone['done'], zone['failed'], zone['remaining']), (2, 2, 0))
+        self.assertAlmostEqual(zone['merge_rate'] / zone['rate'], 2 / 3)
+
+    def test_rolling_window(self):
+        progress = RunProgress(window=60)
+        progress.add_rows('UBS', ['NOT PROCESSED'] * 3)
+        with mock.patch('utils.progress.time.monotonic', return_value=progress.start + 1):
+            progress.update('UBS', 0, 'NOT PROCESSED', 'SUCCESS')
+        with mock.patch('utils.progress.time.monotonic', return_value=progress.start + 120):
+            zone = progress.zones()['UBS']
+        self.assertEqual((zone['done'], zone['remaining'], zone['rate']), (1, 2, 0))
+        self.assertIsNone(zone['eta'])
+
+    def test_is_failure(self):
+        self.assertTrue(is_failure('FAIL'))
+        self.assertTrue(is_failure('CYCLE'))
+        self.assertFalse(is_failure('COMPLETED'))
+        self.assertFalse(is_failure('RETRY'))
+        self.assertFalse(is_failure(None))
+
+    def test_format_value(self):
+        self.assertEqual(format_value(1234567), '1234567')
+        self.assertEqual(format_value(2.0), '2')
+        self.assertEqual(format_value(0.123456789), '0.123457')
+
+    def test_render(self):
+        progress = RunProgress()
+        progress.add_rows('UBS', ['NOT PROCESSED', 'NOT PROCESSED'])
+        progress.update('UBS', 0, 'NOT PROCESSED', 'SUCCESS')
+        timings = StepTimings('UBS', progress=progress)
+        timings.record('merge_users', 0.3)
+        timings.record('merge_users', 7)
+        timings.record('browser_restart', 12)
+
+        client = UserApiClient()
+        previous = set_client(client)
+        client.call_counts[('UBS', 'GET')] += 3
+        try:
+            lines = progress.render().splitlines()
+        finally:
+            set_client(previous)
+            client.close()
+
+        self.assertIn('alma_merge_rows_total{zone="UBS"} 2', lines)
+        self.assertIn('alma_merge_rows_remaining{zone="UBS"} 1', lines)
+        self.assertIn('alma_merge_outcomes_total{zone="UBS",status="SUCCESS"} 1', lines)
+        self.assertIn('alma_merge_browser_restarts_total{zone="UBS"} 1', lines)
+        self.assertIn('alma_merge_api_calls_total{zone="UBS",method="GET"} 3', lines)
+        self.assertIn('alma_merge_step_seconds_bucket{zone="UBS",step="merge_users",le="0.25"} 0', lines)
+        self.assertIn('alma_merge_step_seconds_bucket{zone="UBS",step="merge_users",le="0.5"} 1', lines)
+        self.assertIn('alma_merge_step_seconds_bucket{zone="UBS",step="merge_users",le="+Inf"} 2', lines)
+        self.assertIn('alma_merge_step_seconds_count{zone="UBS",step="merge_users"} 2', lines)
+        self.assertIn('alma_merge_step_seconds_sum{zone="UBS",step="merge_users"} 7.3', lines)
+        self.assertTrue(any(line.startswith('alma_merge_eta_seconds{zone="UBS"} ') for line in lines))
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def test_exporter(self):
+        progress = RunProgress()
+        progress.add_rows('HPH', ['NOT PROCESSED'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metrics', 'merge.prom')
+            exporter = MetricsExporter(progress, path, port=0, interval=0.05).start()
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{exporter.port}/metrics', timeout=5) as response:
+                    self.assertIn('text/plain', response.headers['Content-Type'])
+                    self.assertIn('alma_merge_rows_remaining{zone="HPH"} 1', response.read().decode())
+                with self.assertRaises(urllib.error.HTTPError):
+                    urllib.request.urlopen(f'http://127.0.0.1:{exporter.port}/other', timeout=5)
+                progress.update('HPH', 0, 'NOT PROCESSED', 'SUCCESS')
+            finally:
+                exporter.close()
+
+            # The file is written a last time when the exporter is closed
+            with open(path) as f:
+                self.assertIn('alma_merge_rows_done{zone="HPH"} 1', f.read().splitlines())
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['merge.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
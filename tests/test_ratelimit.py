@@ -0,0 +1,57 @@
+import threading
+import time
+import unittest
+
+from utils.ratelimit import RateLimiter, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire_paces_calls(self):
+        bucket = TokenBucket(rate=20, max_rate=20)
+        start = time.monotonic()
+        for _ in range(40):
+            bucket.acquire()
+        # The first 20 calls use the burst, the next 20 take one second
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+    def test_shared_by_threads(self):
+        bucket = TokenBucket(rate=50, max_rate=50)
+        threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(25)]) for _ in range(4)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+    def test_aimd(self):
+        bucket = TokenBucket(rate=20, max_rate=25, min_rate=1)
+        bucket.on_throttle()
+        self.assertEqual(bucket.rate, 10)
+        for _ in range(10):
+            bucket.on_success()
+        self.assertAlmostEqual(bucket.rate, 11, delta=0.1)
+
+        for _ in range(10):
+            bucket.on_throttle()
+        self.assertEqual(bucket.rate, 1)
+        self.assertEqual(bucket.throttled, 11)
+
+        for _ in range(1000):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 25)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_buckets(self):
+        limiter = RateLimiter(rate=10)
+        self.assertIs(limiter.bucket('UBS', 'key1'), limiter.bucket('UBS', 'key1'))
+        self.assertIsNot(limiter.bucket('UBS', 'key1'), limiter.bucket('UBS', 'key2'))
+        limiter.bucket('UBS', 'key2').on_throttle()
+        limiter.bucket('HPH', 'key3')
+        self.assertEqual(limiter.rates(), {'UBS': 5, 'HPH': 10})
+        self.assertEqual(limiter.throttled(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import unittest
+import gc
+import os
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pandas as pd
+
+from utils.journal import StatusJournal
+from utils.mergeprocess import MergeProcessError
+from utils.results import RETRY, MergeResults, StreamResults
+
+
+class TestMergeResults(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'merge.csv')
+        self.df = pd.DataFrame({'from_user': [f'from_{i}' for i in range(50)],
+                                'to_user': [f'to_{i}' for i in range(50)],
+                                'zone': ['UBS', 'HPH'] * 25,
+                                'Merge_status': ['NOT PROCESSED'] * 50})
+        self.journal = StatusJournal(os.path.join(self.tmp_dir.name, 'journal.jsonl'))
+        self.results = MergeResults(self.df, self.file_path, self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp_dir.cleanup()
+
+    def test_set_status(self):
+        self.results.set_status(3, 'SUCCESS', job_id='123')
+        self.assertEqual(self.results.get_status(3), 'SUCCESS')
+        self.assertFalse(os.path.exists(self.file_path))
+        self.results.write_csv()
+        df = pd.read_csv(self.file_path, dtype=str)
+        self.assertEqual(df.at[3, 'Merge_status'], 'SUCCESS')
+
+    def test_write_csv_atomic(self):
+        self.results.write_csv()
+        with open(self.file_path) as f:
+            written = f.read()
+        self.results.set_status(3, 'SUCCESS')
+        with mock.patch.object(pd.DataFrame, 'to_csv', side_effect=OSError('No space left on device')):
+            with self.assertRaises(OSError):
+                self.results.write_csv()
+        # The file written by the previous call is left untouched
+        with open(self.file_path) as f:
+            self.assertEqual(f.read(), written)
+
+        self.results.write_csv()
+        self.assertEqual(pd.read_csv(self.file_path, dtype=str).at[3, 'Merge_status'], 'SUCCESS')
+        self.assertNotIn('merge.csv.tmp', os.listdir(self.tmp_dir.name))
+
+    def test_blocks_copied(self):
+        self.results.set_status(3, 'IN_FLIGHT')
+        self.results.set_blocks_copied(3)
+        self.results.set_status(3, RETRY)
+        self.assertTrue(self.results.blocks_copied(3))
+
+        # A resumed run does not copy the blocks of the row again
+        results = MergeResults(self.df.assign(Merge_status='NOT PROCESSED'), self.file_path, self.journal)
+        results.replay_journal()
+        self.assertEqual(results.get_status(3), RETRY)
+        self.assertTrue(results.blocks_copied(3))
+        self.assertFalse(results.blocks_copied(4))
+
+    def test_error_details(self):
+        error = MergeProcessError('user table: TimeoutException', step='user table', cause='TimeoutException',
+                                  transient=True)
+        self.results.set_status(3, RETRY, error=error)
+        self.results.set_status(4, 'FAIL', error=ValueError('bad'))
+        entries = self.journal.replay()
+        self.assertEqual((entries[3]['error_class'], entries[3]['step']), ('TimeoutException', 'user table'))
+        self.assertEqual((entries[4]['error_class'], entries[4]['step']), ('ValueError', None))
+
+    def test_concurrent_set_status(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: self.results.set_status(i, 'FAIL'), range(50)))
+        self.assertEqual(len(self.journal.replay()), 50)
+        self.results.write_csv()
+        df = pd.read_csv(self.file_path, dtype=str)
+        self.assertTrue((df['Merge_status'] == 'FAIL').all())
+
+    def test_replay_journal(self):
+        self.results.set_status(1, 'SUCCESS', job_id='123')
+        self.results.set_status(2, 'FAIL', error=ValueError('boom'))
+        df = self.df.copy()
+        df['Merge_status'] = 'NOT PROCESSED'
+        df.at[2, 'to_user'] = 'edited'
+        results = MergeResults(df, self.file_path, self.journal)
+        self.assertEqual(results.replay_journal(), 1)
+        self.assertEqual(results.get_status(1), 'SUCCESS')
+        self.assertEqual(results.get_job_id(1), '123')
+        self.assertEqual(results.get_status(2), 'NOT PROCESSED')
+
+    def test_get_statuses(self):
+        self.results.set_status(1, 'SUCCESS')
+        statuses = self.results.get_statuses(self.df.index[:3])
+        self.assertEqual(list(statuses), ['NOT PROCESSED', 'SUCCESS', 'NOT PROCESSED'])
+
+    def test_replay_journal_unknown_row(self):
+        self.journal.record(99, 'from_99', 'to_99', 'UBS', 'SUCCESS')
+        self.journal.record(4, 'from_4', 'to_4', 'UBS', 'FAIL')
+        self.assertEqual(self.results.replay_journal(), 1)
+        self.assertEqual(self.results.get_status(4), 'FAIL')
+        self.assertNotIn(99, self.df.index)
+
+
+class TestStreamResults(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'merge.csv')
+        pd.DataFrame({'from_user': [f'from_{i}' for i in range(10)],
+                      'to_user': [f'to_{i}' for i in range(10)],
+                      'zone': ['UBS'] * 10}).to_csv(self.file_path, index=False)
+        self.journal = StatusJournal(os.path.join(self.tmp_dir.name, 'journal.jsonl'))
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp_dir.cleanup()
+
+    def test_chunks(self):
+        results = StreamResults(self.file_path, self.journal, chunksize=3)
+        chunks = pd.read_csv(self.file_path, dtype=str, chunksize=4)
+        for chunk in results.chunks(chunks):
+            for i in chunk.index:
+                results.set_status(i, 'SUBMITTED' if i == 1 else 'SUCCESS', job_id=str(i))
+        self.assertEqual(list(results._rows), [1])
+        self.assertEqual(results.submitted_rows(), [(1, 'UBS', 'from_1', '1')])
+        self.assertEqual(results.status_counts(), {'SUBMITTED': 1, 'SUCCESS': 9})
+
+        results.write_csv()
+        df = pd.read_csv(self.file_path, dtype=str)
+        self.assertEqual(list(df['Merge_status']), ['SUCCESS', 'SUBMITTED'] + ['SUCCESS'] * 8)
+        self.assertEqual(df.at[9, 'Merge_job_id'], '9')
+
+    def test_replay_journal(self):
+        self.journal.record(2, 'from_2', 'to_2', 'UBS', 'SUCCESS', job_id='2')
+        self.journal.record(3, 'from_3', 'edited', 'UBS', 'SUCCESS', job_id='3')
+        self.journal.record(4, 'from_4', 'to_4', 'UBS', 'SUBMITTED', job_id='4')
+        results = StreamResults(self.file_path, self.journal)
+        self.assertEqual(results.replay_journal(), 3)
+        self.assertEqual(results.submitted_rows(), [(4, 'UBS', 'from_4', '4')])
+
+        results.load(pd.read_csv(self.file_path, dtype=str))
+        self.assertEqual(results.get_status(2), 'SUCCESS')
+        self.assertEqual(results.get_status(3), 'NOT PROCESSED')
+        self.assertEqual(results.get_job_id(4), '4')
+        self.assertEqual(list(results.get_statuses(pd.Index([2, 3]))), ['SUCCESS', 'NOT PROCESSED'])
+
+    def test_released_rows(self):
+        results = StreamResults(self.file_path, self.journal, chunksize=3)
+        chunks = pd.read_csv(self.file_path, dtype=str, chunksize=4)
+        for chunk in results.chunks(chunks):
+            for i in chunk.index:
+                results.set_status(i, 'SUBMITTED' if i == 1 else 'SUCCESS', job_id=str(i))
+                results.set_target(i, 'target')
+        self.assertEqual(results.get_status(5), 'SUCCESS')
+        self.assertEqual(results.get_job_id(5), '5')
+        results.set_status(1, 'COMPLETED')
+        self.assertEqual(results._rows, {})
+        self.assertEqual(results.get_status(1), 'COMPLETED')
+        self.assertEqual(results.submitted_rows(), [])
+
+        results.write_csv()
+        df = pd.read_csv(self.file_path, dtype=str)
+        self.assertEqual(list(df['Merge_status']), ['SUCCESS', 'COMPLETED'] + ['SUCCESS'] * 8)
+        self.assertEqual(list(df['Merge_target']), ['target'] * 10)
+
+    def test_memory(self):
+        def held_memory(nb_rows: int) -> int:
+            file_path = os.path.join(self.tmp_dir.name, f'merge_{nb_rows}.csv')
+            pd.DataFrame({'from_user': [f'from_{i}' for i in range(nb_rows)],
+                          'to_user': [f'to_{i}' for i in range(nb_rows)],
+                          'zone': ['UBS'] * nb_rows}).to_csv(file_path, index=False)
+            journal = StatusJournal(os.path.join(self.tmp_dir.name, f'journal_{nb_rows}.jsonl'))
+            with mock.patch('utils.journal.os.fsync', new=lambda fd: None):
+                for i in range(0, nb_rows, 2):
+                    journal.record(i, f'from_{i}', f'to_{i}', 'UBS', RETRY)
+                gc.collect()
+                tracemalloc.start()
+                results = StreamResults(file_path, journal, chunksize=50)
+                results.replay_journal()
+                for chunk in results.chunks(pd.read_csv(file_path, dtype=str, chunksize=50)):
+                    for i in chunk.index:
+                        results.set_status(i, 'SUCCESS', job_id=str(i))
+                gc.collect()
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+            journal.close()
+            self.assertEqual(results.status_counts(), {'SUCCESS': nb_rows})
+            return memory
+
+        held_memory(50)
+        self.assertLess(held_memory(2000), held_memory(500) * 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import pandas as pd
+
+from utils.scheduler import order_rows, order_zones, parse_weights, zone_session_count
+
+
+class TestScheduler(unittest.TestCase):
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights('UBS=3, HPH=0.5'), {'UBS': 3, 'HPH': 0.5})
+        self.assertEqual(parse_weights(None), {})
+        with self.assertRaises(ValueError):
+            parse_weights('UBS=0')
+        with self.assertRaises(ValueError):
+            parse_weights('UBS')
+
+    def test_order_rows(self):
+        data = pd.DataFrame({'from_user': [f'f{i}' for i in range(5)],
+                             'priority': [None, '1', '1', 'x', '2'],
+                             'deadline': ['2024-01-01', None, '2024-01-02', None, 'later']},
+                            index=[10, 11, 12, 13, 14])
+        self.assertEqual(order_rows(data, [10, 11, 12, 13, 14]), [14, 12, 11, 10, 13])
+        self.assertEqual(order_rows(data, [13, 10]), [10, 13])
+
+    def test_order_rows_without_columns(self):
+        data = pd.DataFrame({'from_user': ['a', 'b']}, index=[3, 4])
+        self.assertEqual(order_rows(data, [4, 3]), [4, 3])
+
+    def test_order_zones(self):
+        accounts = {'BIG': pd.DataFrame({'from_user': range(100)}),
+                    'SMALL': pd.DataFrame({'from_user': range(10)}),
+                    'MID': pd.DataFrame({'from_user': range(50)})}
+        self.assertEqual(order_zones(accounts), ['SMALL', 'MID', 'BIG'])
+        self.assertEqual(order_zones(accounts, {'BIG': 20}), ['BIG', 'SMALL', 'MID'])
+
+        # Urgent rows move their zone forward, whatever its size
+        accounts['BIG']['deadline'] = None
+        accounts['BIG'].loc[99, 'deadline'] = '2024-01-01'
+        self.assertEqual(order_zones(accounts), ['BIG', 'SMALL', 'MID'])
+        accounts['MID']['priority'] = '1'
+        self.assertEqual(order_zones(accounts), ['MID', 'BIG', 'SMALL'])
+
+    def test_zone_session_count(self):
+        self.assertEqual(zone_session_count('UBS', 2), 2)
+        self.assertEqual(zone_session_count('UBS', 2, {'UBS': 3}), 6)
+        self.assertEqual(zone_session_count('UBS', 2, {'UBS': 3}, max_zone_sessions=4), 4)
+        self.assertEqual(zone_session_count('UBS', 2, {'UBS': 0.1}), 1)
+        self.assertEqual(zone_session_count('HPH', 2, {'UBS': 3}), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from unittest import mock
+
+from utils.session import MergeSession, SessionPool, check_backend
+
+
+class TestMergeSession(unittest.TestCase):
+    def setUp(self):
+        self.AlmaMerger = mock.Mock()
+        patcher = mock.patch.dict('utils.session.BACKENDS', {'selenium': self.AlmaMerger})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.staff = mock.Mock(primary_id='automation_ubs@slsp.ch')
+
+    def test_soft_recovery(self):
+        session = MergeSession(self.staff).start()
+        session.recover()
+        self.assertEqual(self.AlmaMerger.call_count, 1)
+        self.assertEqual(session.soft_recoveries, 1)
+        self.assertEqual(session.restarts, 0)
+
+    def test_restart_when_soft_recovery_fails(self):
+        session = MergeSession(self.staff).start()
+        session.merger.reset_page.side_effect = TimeoutError()
+        session.recover()
+        self.assertEqual(self.AlmaMerger.call_count, 2)
+        self.assertEqual(session.restarts, 1)
+
+    def test_pool_reuses_browser(self):
+        pool = SessionPool()
+        session = pool.acquire(self.staff)
+        pool.release(session)
+        other_staff = mock.Mock(primary_id='automation_hph@slsp.ch')
+        self.assertIs(pool.acquire(other_staff), session)
+        self.assertEqual(self.AlmaMerger.call_count, 1)
+        self.assertIs(session.merger.temp_staff, other_staff)
+        session.merger.logout.assert_called_once()
+        pool.release(session)
+        pool.close()
+        self.assertIsNone(session.merger)
+
+
+class TestCheckBackend(unittest.TestCase):
+    def test_check_backend(self):
+        check_backend('selenium', batch_size=10)
+        check_backend('http')
+        with self.assertRaises(ValueError):
+            check_backend('http', batch_size=10)
+        with self.assertRaises(ValueError):
+            check_backend('other')
+
+    def test_experimental_backend(self):
+        with self.assertLogs(level='WARNING') as logs:
+            SessionPool(backend='http')
+        self.assertIn('experimental', logs.output[0])
+        with self.assertNoLogs(level='WARNING'):
+            SessionPool(backend='selenium')
+
+
+if __name__ == '__main__':
+    unittest.main()
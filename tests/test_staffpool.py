@@ -0,0 +1,103 @@
+import json
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.fakealma import FakeAlma
+from utils.staffpool import StaffPool, get_staff_primary_id
+from utils.userapi import ApiThrottledError, UserApiClient, set_client
+
+
+class TestStaffPool(unittest.TestCase):
+    def setUp(self):
+        self.alma = FakeAlma().start()
+        self.installed = self.alma.install(['UBS', 'HPH'])
+        self.installed.__enter__()
+        self.previous = set_client(UserApiClient())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'staff_pool.json')
+
+    def tearDown(self):
+        set_client(self.previous).close()
+        self.tmp_dir.cleanup()
+        self.installed.__exit__(None, None, None)
+        self.alma.stop()
+
+    def test_lease_creates_lazily(self):
+        pool = StaffPool(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+        first = pool.lease('UBS')
+        second = pool.lease('UBS')
+        self.assertEqual(first.primary_id, get_staff_primary_id('UBS', 0))
+        self.assertEqual(second.primary_id, get_staff_primary_id('UBS', 1))
+        self.assertIsNotNone(self.alma.get_user('UBS', second.primary_id))
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+        pool.release(first)
+        self.assertEqual(pool.lease('UBS').primary_id, first.primary_id)
+        self.assertEqual([account['leased'] for account in pool.accounts('UBS')], [True, True])
+
+    def test_reused_across_runs(self):
+        temp_staff = StaffPool(self.path).lease('UBS')
+        posts = self.alma.request_counts['POST user']
+
+        # Next run: the account is only checked
+        reused = StaffPool(self.path).lease('UBS')
+        self.assertEqual(reused.primary_id, temp_staff.primary_id)
+        self.assertEqual(reused.password, temp_staff.password)
+        self.assertEqual(self.alma.request_counts['POST user'], posts)
+        self.assertNotIn('PUT user', self.alma.request_counts)
+
+    def test_rotation(self):
+        temp_staff = StaffPool(self.path).lease('UBS')
+        rotated = StaffPool(self.path, rotate_after=0).lease('UBS')
+        self.assertNotEqual(rotated.password, temp_staff.password)
+        self.assertEqual(self.alma.get_user('UBS', rotated.primary_id)['password'], rotated.password)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['accounts'][0]['password'], rotated.password)
+
+    def test_health_check(self):
+        temp_staff = StaffPool(self.path).lease('UBS')
+        temp_staff.delete()
+
+        recreated = StaffPool(self.path).lease('UBS')
+        self.assertEqual(recreated.primary_id, temp_staff.primary_id)
+        self.assertIsNotNone(self.alma.get_user('UBS', recreated.primary_id))
+
+    def test_failed_creation(self):
+        def create_staff_account(temp_staff):
+            temp_staff.temp_user = mock.Mock(error=True)
+            return temp_staff
+
+        pool = StaffPool(self.path)
+        with mock.patch('utils.staffpool.TempStaffUser.create_staff_account', create_staff_account):
+            self.assertIsNone(pool.lease('UBS'))
+        self.assertEqual(pool.accounts(), [])
+
+    def test_throttled(self):
+        pool = StaffPool(self.path)
+        temp_staff = pool.lease('UBS')
+        pool.release(temp_staff)
+        with mock.patch('utils.staffpool.TempStaffUser.check_account', side_effect=ApiThrottledError('throttled')):
+            self.assertIsNone(pool.lease('UBS'))
+        # The account is not kept leased by the failed attempt
+        self.assertEqual([account['leased'] for account in pool.accounts('UBS')], [False])
+        self.assertEqual(pool.lease('UBS').primary_id, temp_staff.primary_id)
+
+    def test_teardown(self):
+        pool = StaffPool(self.path)
+        ubs = pool.lease('UBS')
+        hph = pool.lease('HPH')
+        pool.release(ubs)
+
+        self.assertEqual(pool.teardown(), 1)
+        self.assertIsNone(self.alma.get_user('UBS', ubs.primary_id))
+        self.assertIsNotNone(self.alma.get_user('HPH', hph.primary_id))
+        self.assertEqual([account['primary_id'] for account in StaffPool(self.path).accounts()], [hph.primary_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
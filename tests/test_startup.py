@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import merge
+from benchmark import HEAVY_MODULES
+from utils.journal import StatusJournal
+from utils.lazy import LazyImport
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_is_light(self):
+        code = f'import sys, merge; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+        loaded = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True,
+                                text=True).stdout.strip()
+        self.assertEqual(loaded, '')
+
+    def test_help_is_fast(self):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, 'merge.py', '--help'], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        self.assertLess(min(times), 0.5)
+
+    def test_lazy_import(self):
+        path = LazyImport('os', 'path')
+        self.assertEqual(repr(path), '<LazyImport os.path>')
+        self.assertIsNone(path._target)
+        self.assertEqual(path.join('a', 'b'), os.path.join('a', 'b'))
+        self.assertIs(path._target, os.path)
+        self.assertEqual(LazyImport('os.path', 'basename')('a/b'), 'b')
+
+
+class TestFileStatus(unittest.TestCase):
+    def test_file_status(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            try:
+                with open('status.csv', 'w') as f:
+                    f.write('from_user,to_user,zone,Merge_status\n'
+                            'f1,t1,UBS,SUCCESS\n'
+                            'f2,t2,UBS,\n'
+                            'f3,t3,HPH,\n'
+                            'f4,t4,HPH,\n')
+                journal = StatusJournal(merge.journal_path('status.csv'))
+                journal.record(1, 'f2', 't2', 'UBS', 'FAIL')
+                journal.record(2, 'f3', 't3', 'HPH', 'SUCCESS')
+                # Entry of another version of the file, ignored
+                journal.record(3, 'other', 't4', 'HPH', 'SUCCESS')
+                journal.close()
+
+                self.assertEqual(merge.file_status('status.csv'),
+                                 {'UBS': {'SUCCESS': 1, 'FAIL': 1}, 'HPH': {'SUCCESS': 1, 'NOT PROCESSED': 1}})
+
+                output = subprocess.run([sys.executable, os.path.join(ROOT, 'merge.py'), 'status.csv', '--status'],
+                                        check=True, capture_output=True, text=True).stdout
+                self.assertEqual(output, 'HPH: NOT PROCESSED: 1, SUCCESS: 1\nUBS: FAIL: 1, SUCCESS: 1\n')
+            finally:
+                os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
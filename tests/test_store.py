@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import pandas as pd
+
+from merge import skip_merged
+from utils.results import MergeResults
+from utils.store import ResultStore
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'results.db')
+        self.store = ResultStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_record_keeps_job_id(self):
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'SUBMITTED', job_id='42')
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'COMPLETED')
+        rows = self.store.query()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['status'], rows[0]['job_id']), ('COMPLETED', '42'))
+        self.assertEqual(rows[0]['file'], os.path.abspath('first.csv'))
+
+    def test_query(self):
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'SUCCESS')
+        self.store.record('first.csv', 1, 'c', 'd', 'UBS', 'FAIL', error_class='MergeProcessError',
+                          error='Add Job button', step='merge_users')
+        self.store.record('second.csv', 0, 'e', 'd', 'HPH', 'FAIL')
+
+        self.assertEqual([row['from_user'] for row in self.store.query(zone='UBS', status='FAIL')], ['c'])
+        self.assertEqual(len(self.store.query(to_user='d')), 2)
+        self.assertEqual(len(self.store.query(file_path='first.csv')), 2)
+        self.assertEqual(len(self.store.query(limit=1)), 1)
+        self.assertEqual(self.store.status_counts(), {'UBS': {'SUCCESS': 1, 'FAIL': 1}, 'HPH': {'FAIL': 1}})
+        self.assertEqual(self.store.status_counts('second.csv'), {'HPH': {'FAIL': 1}})
+
+    def test_merged_pairs(self):
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'SUCCESS')
+        self.store.record('first.csv', 1, 'c', 'd', 'UBS', 'FAIL')
+        self.store.record('second.csv', 0, 'e', 'f', 'UBS', 'COMPLETED', job_id='7')
+        self.store.record('second.csv', 1, 'a', 'b', 'HPH', 'SUCCESS')
+        self.store.close()
+
+        # The results persist across the runs
+        self.store = ResultStore(self.path)
+        self.assertEqual(self.store.merged_pairs('UBS', ['a', 'c', 'e', 'g']),
+                         {('a', 'b'): ('SUCCESS', None), ('e', 'f'): ('COMPLETED', '7')})
+
+    def test_merged_pairs_of_replaced_file(self):
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'SUBMITTED', job_id='7')
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'COMPLETED')
+        # A new file written to the same path replaces the outcome of its rows, not the merged pairs
+        self.store.record('first.csv', 0, 'c', 'd', 'UBS', 'NOT PROCESSED')
+        self.store.record('first.csv', 0, 'c', 'd', 'UBS', 'SUCCESS')
+        self.assertEqual(len(self.store.query(file_path='first.csv')), 1)
+        self.assertEqual(self.store.merged_pairs('UBS', ['a', 'c']),
+                         {('a', 'b'): ('COMPLETED', '7'), ('c', 'd'): ('SUCCESS', None)})
+
+    def test_merged_pairs_of_older_store(self):
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'SUCCESS')
+        self.store.close()
+        connection = sqlite3.connect(self.path)
+        connection.execute('DROP TABLE merged_pairs')
+        connection.execute('PRAGMA user_version = 0')
+        connection.commit()
+        connection.close()
+
+        self.store = ResultStore(self.path)
+        self.assertEqual(self.store.merged_pairs('UBS', ['a']), {('a', 'b'): ('SUCCESS', None)})
+        self.store.close()
+
+        # The merged pairs are filled once, not at each open
+        connection = sqlite3.connect(self.path)
+        connection.execute('DELETE FROM merged_pairs')
+        connection.commit()
+        connection.close()
+        self.store = ResultStore(self.path)
+        self.assertEqual(self.store.merged_pairs('UBS', ['a']), {})
+
+    def test_skip_merged(self):
+        self.store.record('first.csv', 0, 'a', 'b', 'UBS', 'COMPLETED', job_id='7')
+        self.store.record('first.csv', 1, 'c', 'd', 'UBS', 'FAIL')
+        df = pd.DataFrame({'from_user': ['a', 'c', 'a'], 'to_user': ['b', 'd', 'x'], 'zone': 'UBS',
+                           'Merge_status': ''})
+        results = MergeResults(df, os.path.join(self.tmp_dir.name, 'second.csv'), store=self.store)
+
+        self.assertEqual(skip_merged('UBS', df, results, self.store), 1)
+        self.assertEqual(list(df['Merge_status']), ['COMPLETED', '', ''])
+        self.assertEqual(df.loc[0, 'Merge_job_id'], '7')
+        self.assertEqual(self.store.status_counts(results.file_path), {'UBS': {'COMPLETED': 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
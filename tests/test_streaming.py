@@ -0,0 +1,41 @@
+import unittest
+import os
+import tempfile
+
+import pandas as pd
+
+from utils.streaming import read_zone, scan_zones
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'merge.csv')
+        self.df = pd.DataFrame({'from_user': [f'from_{i}' for i in range(23)],
+                                'to_user': [f'to_{i}' for i in range(23)],
+                                'zone': ['UBS'] * 7 + ['HPH'] * 10 + ['NZ'] * 6})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_scan_zones(self):
+        self.df.to_csv(self.file_path, index=False)
+        self.assertEqual(list(scan_zones(self.file_path, chunksize=5)), [('UBS', 0), ('HPH', 7), ('NZ', 17)])
+
+    def test_read_zone(self):
+        df = self.df.sample(frac=1, random_state=1).reset_index(drop=True)
+        df.to_csv(self.file_path, index=False)
+        chunks = list(read_zone(self.file_path, 'HPH', chunksize=4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+        rows = pd.concat(chunks)
+        pd.testing.assert_frame_equal(rows, df.loc[df['zone'] == 'HPH'])
+
+    def test_read_sorted_zone(self):
+        self.df.to_csv(self.file_path, index=False)
+        for zone, first_row in scan_zones(self.file_path, chunksize=5):
+            rows = pd.concat(read_zone(self.file_path, zone, chunksize=4, start=first_row, sorted_by_zone=True))
+            pd.testing.assert_frame_equal(rows, self.df.loc[self.df['zone'] == zone])
+
+
+if __name__ == '__main__':
+    unittest.main()
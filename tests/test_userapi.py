@@ -0,0 +1,120 @@
+import unittest
+from unittest import mock
+
+from tests.fakealma import FakeAlma
+from utils.mergeprocess import UserNotFoundError, get_user_data
+from utils.preflight import prefetch_users
+from utils.userapi import ApiQuotaError, ApiThrottledError, UserApiClient, get_client, set_client
+
+
+class TestUserApiClient(unittest.TestCase):
+    def setUp(self):
+        self.alma = FakeAlma().start()
+        self.installed = self.alma.install(['UBS'])
+        self.installed.__enter__()
+        self.alma.add_user('UBS', 'from@test.ch', internal_blocks=1)
+        self.alma.add_user('UBS', 'to@test.ch')
+        self.client = UserApiClient(ttl=60)
+        self.previous = set_client(self.client)
+
+    def tearDown(self):
+        set_client(self.previous)
+        self.client.close()
+        self.installed.__exit__(None, None, None)
+        self.alma.stop()
+
+    def test_cache(self):
+        u1 = get_user_data('to@test.ch', 'UBS', 'S')
+        u2 = get_user_data('to@test.ch', 'UBS', 'S')
+        self.assertEqual(self.alma.request_counts['GET user'], 1)
+        self.assertEqual((self.client.hits, self.client.misses), (1, 1))
+
+        # Each call gets its own copy of the record
+        u1.data['user_block'].append({'segment_type': 'Internal'})
+        self.assertEqual(u2.data['user_block'], [])
+        self.assertEqual(u2.primary_id, 'to@test.ch')
+
+        with self.assertRaises(UserNotFoundError):
+            get_user_data('missing@test.ch', 'UBS', 'S')
+        self.assertEqual(self.client.call_counts[('UBS', 'GET')], 2)
+
+    def test_ttl(self):
+        self.client.ttl = 0
+        get_user_data('to@test.ch', 'UBS', 'S')
+        get_user_data('to@test.ch', 'UBS', 'S')
+        self.assertEqual(self.alma.request_counts['GET user'], 2)
+
+    def test_lru(self):
+        self.client.max_size = 1
+        get_user_data('to@test.ch', 'UBS', 'S')
+        get_user_data('from@test.ch', 'UBS', 'S')
+        get_user_data('to@test.ch', 'UBS', 'S')
+        self.assertEqual(self.alma.request_counts['GET user'], 3)
+
+    def test_update_invalidates(self):
+        u = get_user_data('to@test.ch', 'UBS', 'S')
+        u.data['user_identifier'] = []
+        self.client.update_user(u)
+        self.assertFalse(u.error)
+        get_user_data('to@test.ch', 'UBS', 'S')
+        self.assertEqual(self.alma.request_counts['GET user'], 2)
+        self.assertEqual(self.client.call_counts[('UBS', 'PUT')], 1)
+
+    def test_quota(self):
+        self.client.max_calls = 1
+        get_user_data('to@test.ch', 'UBS', 'S')
+        get_user_data('to@test.ch', 'UBS', 'S')
+        with self.assertRaises(ApiQuotaError):
+            get_user_data('from@test.ch', 'UBS', 'S')
+
+    def test_remaining_quota(self):
+        response = mock.Mock(status_code=200, headers={'X-Exl-Api-Remaining': '4000'})
+        with mock.patch.object(self.client.session, 'request', return_value=response) as m:
+            self.client.api_call('get', 'https://alma/users/a', zone='UBS')
+            with self.assertRaises(ApiQuotaError):
+                self.client.api_call('get', 'https://alma/users/b', zone='UBS')
+            # The cleanup calls are made anyway
+            self.client.api_call('delete', 'https://alma/users/staff', zone='UBS', quota=False)
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(self.client.remaining, 4000)
+
+    def test_throttled(self):
+        throttled = mock.Mock(status_code=429, headers={})
+        unavailable = mock.Mock(status_code=503, headers={})
+        ok = mock.Mock(status_code=200, headers={})
+        self.client.backoff = 0.01
+        with mock.patch.object(self.client.session, 'request', side_effect=[throttled, unavailable, ok]):
+            self.assertIs(self.client.api_call('get', 'https://alma/users/a', zone='UBS'), ok)
+        self.assertEqual(self.client.calls, 3)
+        self.assertEqual(self.client.limiter.throttled(), 2)
+
+    def test_still_throttled(self):
+        self.client.max_wait = 0
+        throttled = mock.Mock(status_code=429, headers={})
+        with mock.patch.object(self.client.session, 'request', return_value=throttled):
+            with self.assertRaises(ApiThrottledError):
+                self.client.api_call('get', 'https://alma/users/a', zone='UBS')
+            users = prefetch_users(['to@test.ch'], 'UBS', 'S')
+        self.assertIsInstance(users['to@test.ch'], ApiThrottledError)
+
+    def test_rate_limit(self):
+        # Alma answers 429 above 10 calls per second, the client adapts its rate
+        self.alma.api_rate_limit = 10
+        self.client.ttl = 0
+        self.client.backoff = 0.1
+        users = prefetch_users(['to@test.ch'] + [f'missing{n}@test.ch' for n in range(20)], 'UBS', 'S',
+                               max_workers=8)
+        self.assertFalse(users['to@test.ch'].error)
+        self.assertTrue(all(isinstance(u, UserNotFoundError) for primary_id, u in users.items()
+                            if primary_id != 'to@test.ch'))
+        self.assertGreater(self.alma.request_counts['throttled'], 0)
+        self.assertLess(self.client.limiter.rates()['UBS'], 20)
+
+    def test_shared_client(self):
+        set_client(None)
+        self.assertIs(get_client(), get_client())
+        set_client(self.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
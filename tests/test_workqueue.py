@@ -0,0 +1,53 @@
+import unittest
+import threading
+
+from utils.workqueue import RowQueue
+
+
+class TestRowQueue(unittest.TestCase):
+    def test_drain(self):
+        rows = RowQueue(range(3))
+        taken = []
+        while (i := rows.get()) is not None:
+            taken.append(i)
+            rows.done(i)
+        self.assertEqual(taken, [0, 1, 2])
+
+    def test_requeue(self):
+        rows = RowQueue([0, 1])
+        i = rows.get()
+        rows.requeue(i)
+        self.assertEqual(len(rows), 2)
+        taken = []
+        while (i := rows.get()) is not None:
+            taken.append(i)
+            rows.done(i)
+        self.assertEqual(taken, [1, 0])
+
+    def test_wait_for_in_flight_row(self):
+        rows = RowQueue([0])
+        i = rows.get()
+        taken = []
+
+        def drain():
+            while (j := rows.get()) is not None:
+                taken.append(j)
+                rows.done(j)
+
+        thread = threading.Thread(target=drain)
+        thread.start()
+        rows.requeue(i)
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(taken, [0])
+
+    def test_close(self):
+        rows = RowQueue([0, 1, 2])
+        i = rows.get()
+        self.assertEqual(rows.close(), [1, 2])
+        rows.done(i)
+        self.assertIsNone(rows.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
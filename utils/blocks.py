@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Tuple
+import logging
+import time
+
+from utils.mergeprocess import MergeProcessError, internal_blocks
+from utils.metrics import StepTimings
+from utils.userapi import ApiQuotaError, ApiThrottledError, get_client
+
+
+def block_key(block: Dict) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Return the fields identifying a block: its type, description and creation date.
+
+    args:
+        block (Dict): Block of a user record.
+
+    returns:
+        Tuple[Optional[str], Optional[str], Optional[str]]: Type, description and creation date of the block.
+    """
+    return ((block.get('block_type') or {}).get('value'),
+            (block.get('block_description') or {}).get('value'),
+            block.get('created_date'))
+
+
+def missing_blocks(blocks: List[Dict], u_to) -> List[Dict]:
+    """Return the blocks not already on a user, so a copy done twice does not duplicate them.
+
+    args:
+        blocks (List[Dict]): Blocks to copy.
+        u_to (User): The user receiving the blocks.
+
+    returns:
+        List[Dict]: The blocks of `blocks` the user does not have yet.
+    """
+    present = {block_key(block) for block in u_to.data['user_block']}
+    missing = []
+    for block in blocks:
+        if block_key(block) not in present:
+            present.add(block_key(block))
+            missing.append(block)
+    return missing
+
+
+def group_by_target(rows: Dict[Hashable, Tuple[str, str]], users: Dict) -> Dict[str, List[Hashable]]:
+    """Group the rows whose 'from' user has internal blocks by 'to' user.
+
+    args:
+        rows (Dict[Hashable, Tuple[str, str]]): 'from' and 'to' users of the rows, by row index.
+        users (Dict): Prefetched User objects by primary ID.
+
+    returns:
+        Dict[str, List[Hashable]]: Indexes of the rows of each 'to' user.
+    """
+    targets = {}
+    for i, (from_user, to_user) in rows.items():
+        if len(internal_blocks(users[from_user])) > 0:
+            targets.setdefault(to_user, []).append(i)
+    return targets
+
+
+def copy_blocks(rows: Dict[Hashable, Tuple[str, str]], users: Dict, zone: str, max_workers: int = 4,
+                timings: Optional[StepTimings] = None) -> Dict[Hashable, Exception]:
+    """Copy the internal blocks of the 'from' users to their 'to' users, just before their merge is submitted.
+
+    The merge removes the 'from' user with its internal blocks, so they are copied
+    by the sessions right before the submission of the row, or of the batch, instead
+    of between the Merge and Start buttons, where the two updates kept the browser idle.
+    The identifiers of each 'from' user still having some are removed with one
+    update, then each 'to' user receives the blocks of its 'from' users it does not
+    have yet with one update. The copy can be run again after a crash or a failed
+    merge: the updates already done are not repeated and no block is duplicated.
+    The 'to' users are updated concurrently, the calls being paced by the rate limit
+    of the shared API client.
+
+    args:
+        rows (Dict[Hashable, Tuple[str, str]]): 'from' and 'to' users of the rows, by row index.
+        users (Dict): Prefetched User objects by primary ID, updated in place.
+        zone (str): Zone of the users.
+        max_workers (int): Maximum number of concurrent API calls. Default is 4.
+        timings (Optional[StepTimings]): Collection receiving the duration of the copy to each 'to' user.
+            Default is None.
+
+    returns:
+        Dict[Hashable, Exception]: Error of the rows whose blocks could not be copied, by row index:
+            MergeProcessError, ApiThrottledError or ApiQuotaError. These rows must not be merged.
+    """
+    def copy_to(to_user: str, indexes: List[Hashable]) -> Dict[Hashable, Exception]:
+        start = time.perf_counter()
+        errors = {}
+        blocks = []
+        for i in indexes:
+            u_from = users[rows[i][0]]
+            try:
+                if len(u_from.data.get('user_identifier') or []) > 0:
+                    u_from.data['user_identifier'] = []
+                    get_client().update_user(u_from)
+                    if u_from.error:
+                        raise MergeProcessError(f"Failed to update user {u_from.primary_id} before copying its "
+                                                f"blocks: {u_from.error_msg} ({type(u_from.error).__name__})",
+                                                step='copy_internal_blocks')
+            except (MergeProcessError, ApiThrottledError, ApiQuotaError) as e:
+                errors[i] = e
+                continue
+            blocks.append((i, internal_blocks(u_from)))
+
+        u_to = users[to_user]
+        missing = missing_blocks([block for _, source_blocks in blocks for block in source_blocks], u_to)
+        if len(missing) > 0:
+            u_to.data['user_block'] += missing
+            try:
+                get_client().update_user(u_to)
+                if u_to.error:
+                    raise MergeProcessError(f"Failed to update user {u_to.primary_id} after copying blocks: "
+                                            f"{u_to.error_msg} ({type(u_to.error).__name__})",
+                                            step='copy_internal_blocks')
+            except (MergeProcessError, ApiThrottledError, ApiQuotaError) as e:
+                # The blocks are not on the user in Alma, they are copied again with the next attempt
+                copied = {id(block) for block in missing}
+                u_to.data['user_block'] = [block for block in u_to.data['user_block'] if id(block) not in copied]
+                errors.update({i: e for i, _ in blocks})
+
+        if timings is not None:
+            timings.record('copy_internal_blocks', time.perf_counter() - start, ok=len(errors) == 0)
+        return errors
+
+    targets = group_by_target(rows, users)
+    if len(targets) == 0:
+        return {}
+
+    errors = {}
+    if len(targets) == 1 or max_workers <= 1:
+        for to_user, indexes in targets.items():
+            errors.update(copy_to(to_user, indexes))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{zone}-blocks') as executor:
+            for target_errors in executor.map(copy_to, targets, targets.values()):
+                errors.update(target_errors)
+
+    copied = sum(len(indexes) for indexes in targets.values()) - len(errors)
+    if len(rows) > 1:
+        logging.info(f'Internal blocks of {zone}: blocks of {copied} users copied to {len(targets)} users, '
+                     f'{len(errors)} failed')
+    return errors
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+from typing import Iterable, List, Optional, Tuple, TYPE_CHECKING
+from urllib.parse import urljoin
+import logging
+
+from utils.lazy import LazyImport
+from utils.mergeprocess import AlmaMerger, MergeBackend, MergeProcessError
+from utils.metrics import StepTimings
+from utils.staff import TempStaffUser
+
+if TYPE_CHECKING:
+    from almapiwrapper.users import User
+
+html = LazyImport('lxml.html')
+requests = LazyImport('requests')
+HTTPAdapter = LazyImport('requests.adapters', 'HTTPAdapter')
+
+
+class HttpMerger(MergeBackend):
+    """Merge backend replaying the form posts of the Merge Users page over HTTP.
+
+    Alma has no REST endpoint to merge users, so this backend still goes through
+    the UI forms, but without rendering them: a browser is only used to log in,
+    then its cookies are copied to a pooled `requests.Session` which fetches the
+    pages, fills the forms and posts them.
+
+    The names of the form fields are read from the pages through the element IDs
+    also used by `AlmaMerger`. If Ex Libris changes the page, a missing element
+    raises MergeProcessError instead of posting an incomplete form.
+
+    Experimental: the fields are only checked against the stand-in of `tests.fakealma`,
+    not yet against the real Merge Users form, see `user_fields`.
+    """
+    ADD_JOB_XPATH = "//a[normalize-space()='Add Job']"
+    FROM_USER_ID = 'PICKUP_ID_pageBeandisplayNameOfFromUserOrUserIdendifier'
+    TO_USER_ID = 'PICKUP_ID_pageBeandisplayNameOfToUserOrUserIdendifier'
+    MERGE_BUTTON_ID = 'PAGE_BUTTONS_cbuttonmerge'
+    START_BUTTON_ID = 'PAGE_BUTTONS_cbuttonconfirmationconfirm'
+    JOB_ID_XPATH = "//tr[@id='recordContainerjobList1']/td[2]"
+    COPY_PARAMS = ['PARAM_COPY_ATTACHMENTS', 'PARAM_COPY_NOTES', 'PARAM_COPY_DEMERITS', 'PARAM_COPY_PROXY_OF']
+
+    def __init__(self, temp_staff: TempStaffUser, headless: bool = True, timings: Optional[StepTimings] = None,
+                 pool_size: int = 4, timeout: float = 60):
+        """
+        Initialize the backend and the browser used for the login.
+
+        args:
+            temp_staff (TempStaffUser): The staff user object with login credentials.
+            headless (bool): Whether to run the login browser in headless mode. Default is True.
+            timings (Optional[StepTimings]): Collection receiving the step durations. Default is a new one.
+            pool_size (int): Number of keep-alive connections of the HTTP session. Default is 4.
+            timeout (float): Timeout of the HTTP requests in seconds. Default is 60.
+        """
+        super().__init__(temp_staff, timings)
+        self.timeout = timeout
+        self.browser = AlmaMerger(temp_staff, headless=headless, timings=self.timings)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.merge_page_url = None
+
+    def login(self):
+        """Log in with the browser and copy its cookies to the HTTP session."""
+        self.browser.temp_staff = self.temp_staff
+        self.browser.timings = self.timings
+        self.browser.login()
+        self.http.headers['User-Agent'] = self.browser.driver.execute_script('return navigator.userAgent')
+
+    def open_merge_users_page(self):
+        """Open the merge users page in the browser and keep its URL for the HTTP session."""
+        self.browser.open_merge_users_page()
+        self.browser.wait_ready('merge users page', self.browser.page_loaded)
+        self.merge_page_url = self.browser.driver.current_url
+        self.http.cookies.clear()
+        for cookie in self.browser.driver.get_cookies():
+            self.http.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'),
+                                  path=cookie.get('path', '/'))
+
+    def reset_page(self):
+        """Check that the HTTP session is still logged in on the Merge Users page."""
+        self.get(self.merge_page_url)
+
+    def logout(self):
+        """Drop the cookies of the browser and of the HTTP session."""
+        self.browser.logout()
+        self.http.cookies.clear()
+
+    def quit(self):
+        """Close the HTTP session and quit the login browser."""
+        self.http.close()
+        self.browser.quit()
+
+    def get(self, url: str) -> requests.Response:
+        """Fetch a page of the UI.
+
+        Args:
+            url (str): URL of the page.
+
+        Returns:
+            requests.Response: The response.
+
+        Raises:
+            MergeProcessError: If the request fails or the session was logged out.
+        """
+        r = self.http.get(url, timeout=self.timeout)
+        return self.check_response(r)
+
+    def check_response(self, r: requests.Response) -> requests.Response:
+        """Check that a UI page was returned, and not an error or the login page.
+
+        Args:
+            r (requests.Response): Response of the UI.
+
+        Returns:
+            requests.Response: The same response.
+
+        Raises:
+            MergeProcessError: If the request failed or the session was logged out.
+        """
+        if not r.ok:
+            raise MergeProcessError(f"HTTP {r.status_code} for {r.url}", cause=f'HTTP {r.status_code}',
+                                    transient=r.status_code == 429 or r.status_code >= 500)
+        if b'id="username"' in r.content and b'id="password"' in r.content:
+            raise MergeProcessError("HTTP session logged out", cause='LoggedOut', transient=True)
+        return r
+
+    @staticmethod
+    def find_element(r: requests.Response, element_id: Optional[str] = None,
+                     xpath: Optional[str] = None) -> html.HtmlElement:
+        """Find an element in a page, by ID or XPath.
+
+        Args:
+            r (requests.Response): Response with the page.
+            element_id (Optional[str]): ID of the element.
+            xpath (Optional[str]): XPath of the element, used if no ID is provided.
+
+        Returns:
+            html.HtmlElement: The element.
+
+        Raises:
+            MergeProcessError: If the element is not in the page.
+        """
+        doc = html.fromstring(r.content, base_url=r.url)
+        elements = doc.xpath(f"//*[@id='{element_id}']" if element_id is not None else xpath)
+        if len(elements) == 0:
+            raise MergeProcessError(f"element {element_id or xpath} not found in {r.url}")
+        return elements[0]
+
+    def submit(self, r: requests.Response, button_id: str, values: Iterable[Tuple[str, str]] = (),
+               extra: Iterable[Tuple[str, str]] = ()) -> requests.Response:
+        """Post the form of a page as if the button was clicked.
+
+        Args:
+            r (requests.Response): Response with the page containing the form.
+            button_id (str): ID of the submit button.
+            values (Iterable[Tuple[str, str]]): Field values replacing the ones of the form.
+            extra (Iterable[Tuple[str, str]]): Field values added to the ones of the form, like checked boxes.
+
+        Returns:
+            requests.Response: The response to the post.
+
+        Raises:
+            MergeProcessError: If the form cannot be found or the post fails.
+        """
+        button = self.find_element(r, button_id)
+        form = next(button.iterancestors('form'), None)
+        if form is None:
+            raise MergeProcessError(f"no form around {button_id} in {r.url}")
+
+        values = list(values)
+        overridden = {name for name, _ in values}
+        fields = [(name, value) for name, value in form.form_values() if name not in overridden] + values
+        fields += [field for field in extra if field not in fields]
+        if button.get('name') is not None:
+            fields.append((button.get('name'), button.get('value', '')))
+
+        return self.check_response(self.http.post(form.action or r.url, data=fields, timeout=self.timeout))
+
+    def user_fields(self, r: requests.Response, pickup_id: str, primary_id: str) -> List[Tuple[str, str]]:
+        """Return the form value selecting a user in the field of a pickup button.
+
+        The field is assumed to be the text input preceding the pickup button. This
+        is not yet checked against the real Merge Users form.
+
+        Args:
+            r (requests.Response): Response with the merge form.
+            pickup_id (str): ID of the pickup button of the field.
+            primary_id (str): The primary ID of the user.
+
+        Returns:
+            List[Tuple[str, str]]: Field name and value.
+        """
+        field = self.find_element(r, xpath=f"//*[@id='{pickup_id}']/preceding::input[@type='text'][1]")
+        return [(field.get('name'), primary_id)]
+
+    def _merge_users(self, from_user: str, to_user: str, from_user_data: Optional[User],
+                     to_user_data: Optional[User], copy_blocks: bool = True) -> str:
+        """Run the steps of `merge_users` over HTTP."""
+        if from_user_data is None and copy_blocks:
+            with self.timings.measure('get_user_data (from_user)'):
+                from_user_data = self.get_user_data(from_user)
+        if to_user_data is None and copy_blocks:
+            with self.timings.measure('get_user_data (to_user)'):
+                to_user_data = self.get_user_data(to_user)
+
+        with self.step('Add Job form'):
+            page = self.get(self.merge_page_url)
+            add_job = self.find_element(page, xpath=self.ADD_JOB_XPATH)
+            form = self.get(urljoin(page.url, add_job.get('href')))
+        with self.step('merge options'):
+            values = self.user_fields(form, self.FROM_USER_ID, from_user)
+            values += self.user_fields(form, self.TO_USER_ID, to_user)
+            checked = []
+            for param in self.COPY_PARAMS:
+                checkbox = self.find_element(form, xpath=f"//input[@type='checkbox' and @value='{param}']")
+                checked.append((checkbox.get('name'), param))
+        with self.step('merge button'):
+            confirmation = self.submit(form, self.MERGE_BUTTON_ID, values, checked)
+
+        if copy_blocks:
+            with self.timings.measure('copy_internal_blocks'):
+                self.copy_internal_blocks(from_user_data, to_user_data)
+
+        with self.step('start button'):
+            job_list = self.submit(confirmation, self.START_BUTTON_ID)
+        with self.step('log_merge_job_id'):
+            job_id = self.find_element(job_list, xpath=self.JOB_ID_XPATH).text_content().strip()
+            logging.info(f"Merge job initiated with ID: {job_id}")
+            return job_id
@@ -0,0 +1,283 @@
+from typing import Dict, Hashable, Iterable, Optional, TYPE_CHECKING
+import logging
+import os
+import threading
+import time
+
+from utils.lazy import LazyImport
+from utils.mergeprocess import UserNotFoundError
+from utils.preflight import prefetch_users
+from utils.userapi import ApiQuotaError, ApiThrottledError, get_client
+
+if TYPE_CHECKING:
+    from utils.results import MergeResults
+
+Job = LazyImport('almapiwrapper.config', 'Job')
+
+FINAL_JOB_STATES = {'COMPLETED_SUCCESS', 'COMPLETED_WARNING', 'COMPLETED_FAILED', 'COMPLETED_NO_BULKS',
+                    'FAILED', 'CANCELLED', 'SYSTEM_ABORTED', 'ABORTED'}
+
+
+class MergeJobTracker:
+    """Follow the state of the merge job instances of a zone with the Alma API.
+
+    The ID shown in the job list of the Merge Users page is the instance ID of the
+    merge job. The job itself is identified by the `ALMA_MERGE_JOB_ID` environment
+    variable. Without it, job states are not available and the outcome of the merges
+    can only be checked on the users, see `check_merged_users`.
+    """
+    def __init__(self, zone: str, env: str, job_definition_id: Optional[str] = None):
+        """
+        Initialize the tracker.
+
+        args:
+            zone (str): Zone of the merge jobs.
+            env (str): Alma environment, 'P' or 'S'.
+            job_definition_id (Optional[str]): ID of the merge job. Default is the
+                ALMA_MERGE_JOB_ID environment variable.
+        """
+        self.zone = zone
+        self.env = env
+        self.job_definition_id = job_definition_id if job_definition_id is not None \
+            else os.getenv('ALMA_MERGE_JOB_ID')
+
+    def get_states(self) -> Dict[str, str]:
+        """Fetch the states of the recent instances of the merge job in one call.
+
+        The call goes through the shared API client, so it is paced and counted with
+        the other calls of the zone and refused once the quota is reached.
+
+        Returns:
+            Dict[str, str]: State of each job instance, by instance ID. Empty if the
+                job ID is not configured or the API call fails.
+        """
+        if self.job_definition_id is None:
+            return {}
+
+        job = get_client().bind(Job(self.job_definition_id, self.zone, self.env))
+        try:
+            instances = job.get_instances()
+        except (ApiQuotaError, ApiThrottledError) as e:
+            logging.warning(f'Failed to fetch the states of the merge jobs of {self.zone}: {e}')
+            return {}
+        # On error, almapiwrapper skips the call and returns the job itself
+        if job.error or instances is None:
+            return {}
+
+        return {instance['id']: instance['status']['value']
+                for instance in instances.content.get('job_instance', [])}
+
+    def wait(self, instance_id: str, timeout: float = 3600, interval: float = 30) -> Optional[str]:
+        """Wait until a job instance reaches a final state.
+
+        Args:
+            instance_id (str): ID of the job instance.
+            timeout (float): Maximum time to wait in seconds. Default is 3600.
+            interval (float): Time between two checks in seconds. Default is 30.
+
+        Returns:
+            Optional[str]: The final state, or None if it is unknown after the timeout.
+        """
+        if self.job_definition_id is None:
+            return None
+
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.get_states().get(instance_id)
+            if state in FINAL_JOB_STATES:
+                logging.info(f'Merge job {instance_id} finished: {state}')
+                return state
+            if time.monotonic() + interval > deadline:
+                logging.warning(f'Merge job {instance_id} not finished after {timeout}s: {state}')
+                return None
+            time.sleep(interval)
+
+    def wait_for_merges(self, instance_id: str, from_users: Iterable[str], max_workers: int = 4,
+                        timeout: float = 3600, interval: float = 30) -> Dict[str, Optional[bool]]:
+        """Wait for the end of a merge job and return the outcome of each of its merges.
+
+        If the job state is available, the users are checked once the job is finished
+        or the timeout is reached. Otherwise the users still existing are checked again
+        every `interval` seconds until all are merged or the timeout is reached. The
+        users whose lookup failed are checked again every `interval` seconds too.
+
+        Args:
+            instance_id (str): ID of the job instance.
+            from_users (Iterable[str]): Primary IDs of the users merged from by the job.
+            max_workers (int): Maximum number of concurrent API calls. Default is 4.
+            timeout (float): Maximum time to wait in seconds. Default is 3600.
+            interval (float): Time between two checks in seconds. Default is 30.
+
+        Returns:
+            Dict[str, Optional[bool]]: True if the user was merged, None if it is still unknown
+                after the timeout, by primary ID.
+        """
+        deadline = time.monotonic() + timeout
+        if self.job_definition_id is not None:
+            self.wait(instance_id, timeout, interval)
+
+        merged: Dict[str, Optional[bool]] = {primary_id: None for primary_id in from_users}
+        while True:
+            # Once the job is finished, a user still existing is not merged
+            pending = [primary_id for primary_id, done in merged.items()
+                       if done is None or (done is False and self.job_definition_id is None)]
+            if len(pending) == 0:
+                return merged
+            merged.update(check_merged_users(pending, self.zone, self.env, max_workers))
+            if time.monotonic() + interval > deadline:
+                return merged
+            time.sleep(interval)
+
+
+def check_merged_users(from_users: Iterable[str], zone: str, env: str,
+                       max_workers: int = 4) -> Dict[str, Optional[bool]]:
+    """Check which merges are done: the 'from' user of a completed merge does not exist anymore.
+
+    The merge of a user whose lookup failed, as the API is still throttling or its
+    quota is reached, is unknown: the user must be checked again later.
+
+    Args:
+        from_users (Iterable[str]): Primary IDs of the users merged from.
+        zone (str): Zone of the users.
+        env (str): Alma environment, 'P' or 'S'.
+        max_workers (int): Maximum number of concurrent API calls. Default is 4.
+
+    Returns:
+        Dict[str, Optional[bool]]: True if the user was merged, False if it still exists,
+            None if its lookup failed, by primary ID.
+    """
+    users = prefetch_users(from_users, zone, env, max_workers=max_workers)
+    return {primary_id: True if isinstance(u, UserNotFoundError) else None if isinstance(u, Exception) else False
+            for primary_id, u in users.items()}
+
+
+class JobPoller:
+    """Background thread following the submitted merges until their job is finished.
+
+    Rows are tracked with the SUBMITTED status and move to COMPLETED or FAILED. The
+    job states of a zone are fetched in one call per cycle, then the 'from' users of
+    the finished jobs are checked in bulk. Without job states (no ALMA_MERGE_JOB_ID),
+    the 'from' users are checked at each cycle. A row whose 'from' user could not be
+    looked up stays SUBMITTED until the next cycle. The submission loop never waits for it.
+    """
+    def __init__(self, results: 'MergeResults', env: str, interval: float = 30, max_workers: int = 4):
+        """
+        Initialize the poller. The thread is only started by `start`.
+
+        args:
+            results (MergeResults): Shared store of the merge statuses.
+            env (str): Alma environment, 'P' or 'S'.
+            interval (float): Time between two cycles in seconds. Default is 30.
+            max_workers (int): Maximum number of concurrent API calls. Default is 4.
+        """
+        self.results = results
+        self.env = env
+        self.interval = interval
+        self.max_workers = max_workers
+        self._pending = {}
+        self._trackers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='job-poller', daemon=True)
+
+    def start(self) -> 'JobPoller':
+        """Start the polling thread.
+
+        Returns:
+            JobPoller: The started poller.
+        """
+        self._thread.start()
+        return self
+
+    def track(self, i: Hashable, zone: str, from_user: str, job_id: str) -> None:
+        """Mark a row as SUBMITTED and follow its merge job.
+
+        Args:
+            i (Hashable): Index of the row.
+            zone (str): Zone of the users.
+            from_user (str): The primary ID of the user to merge from.
+            job_id (str): ID of the merge job instance.
+        """
+        self.results.set_status(i, 'SUBMITTED', job_id=job_id)
+        self.watch(i, zone, from_user, job_id)
+
+    def watch(self, i: Hashable, zone: str, from_user: str, job_id: str) -> None:
+        """Follow the merge job of a row already SUBMITTED, like the ones of a previous run.
+
+        Args:
+            i (Hashable): Index of the row.
+            zone (str): Zone of the users.
+            from_user (str): The primary ID of the user to merge from.
+            job_id (str): ID of the merge job instance.
+        """
+        with self._lock:
+            self._pending[i] = (zone, from_user, job_id)
+            if zone not in self._trackers:
+                self._trackers[zone] = MergeJobTracker(zone, self.env)
+
+    def __len__(self) -> int:
+        """Return the number of rows whose merge job is not finished."""
+        with self._lock:
+            return len(self._pending)
+
+    def poll(self) -> None:
+        """Run one polling cycle: update the rows whose merge job is finished."""
+        with self._lock:
+            pending = dict(self._pending)
+            trackers = dict(self._trackers)
+
+        for zone, tracker in trackers.items():
+            rows = {i: (from_user, job_id) for i, (row_zone, from_user, job_id) in pending.items() if row_zone == zone}
+            if len(rows) == 0:
+                continue
+
+            if tracker.job_definition_id is not None:
+                states = tracker.get_states()
+                finished = {i: row for i, row in rows.items() if states.get(row[1]) in FINAL_JOB_STATES}
+            else:
+                finished = rows
+
+            merged = check_merged_users([from_user for from_user, _ in finished.values()], zone, self.env,
+                                        self.max_workers)
+            for i, (from_user, job_id) in finished.items():
+                if merged[from_user] is None:
+                    # The lookup failed, the row is checked again at the next cycle
+                    continue
+                if merged[from_user]:
+                    self.results.set_status(i, 'COMPLETED', job_id=job_id)
+                elif tracker.job_definition_id is not None:
+                    logging.warning(f'Merge job {job_id} finished but {from_user} still exists')
+                    self.results.set_status(i, 'FAILED', job_id=job_id)
+                else:
+                    continue
+                with self._lock:
+                    del self._pending[i]
+
+    def _run(self) -> None:
+        """Poll until stopped."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except (Exception, SystemExit) as e:
+                # A SystemExit would end the thread and leave the rows SUBMITTED until the timeout of `close`
+                logging.error(f'Job status polling failed: {type(e).__name__} - {e}')
+
+    def close(self, timeout: float = 3600) -> None:
+        """Wait for the tracked merge jobs to finish, then stop the thread.
+
+        Rows whose job is still not finished after the timeout stay SUBMITTED.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds. Default is 3600.
+        """
+        if self._stop.is_set():
+            return
+
+        deadline = time.monotonic() + timeout
+        while len(self) > 0 and time.monotonic() < deadline:
+            time.sleep(min(self.interval, 5))
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if len(self) > 0:
+            logging.warning(f'{len(self)} merge jobs not finished after {timeout}s: rows left SUBMITTED')
@@ -0,0 +1,154 @@
+from datetime import datetime
+from typing import Dict, Hashable, Iterator, Optional
+import json
+import logging
+import os
+import threading
+
+
+def iter_journal(path: str) -> Iterator[Dict]:
+    """Yield the entries of a journal file one by one, in the order they were written.
+
+    A truncated last line, left by a crash during a write, is ignored.
+
+    args:
+        path (str): Path of the JSONL journal file.
+
+    returns:
+        Iterator[Dict]: Journal entries, none if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        for line_nb, line in enumerate(f, start=1):
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f'Ignoring corrupted line {line_nb} of journal {path}')
+
+
+def read_journal(path: str) -> Dict[int, Dict]:
+    """Read a journal file and return the last entry of each row, without opening it for writing.
+
+    A truncated last line, left by a crash during a write, is ignored. The
+    'blocks_copied' flag of a row is kept by its later entries for the same users.
+
+    args:
+        path (str): Path of the JSONL journal file.
+
+    returns:
+        Dict[int, Dict]: Last journal entry of each row, by row index, empty if the file does not exist.
+    """
+    entries = {}
+    for entry in iter_journal(path):
+        previous = entries.get(entry['row'])
+        if previous is not None and previous.get('blocks_copied') \
+                and (previous['from_user'], previous['to_user']) == (entry['from_user'], entry['to_user']):
+            entry['blocks_copied'] = True
+        entries[entry['row']] = entry
+
+    return entries
+
+
+def journal_path(file_path: str) -> str:
+    """Return the path of the status journal of an input file.
+
+    args:
+        file_path (str): Path of the input file.
+
+    returns:
+        str: Path of the journal, `log/journal_<file>.jsonl`.
+    """
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    return f'log/journal{"" if len(file_name) == 0 else "_"}{file_name}.jsonl'
+
+
+class StatusJournal:
+    """Append-only journal of the merge outcomes of an input file.
+
+    Each outcome is written as one JSON line and flushed to disk immediately, so
+    a crash loses at most the line being written. On restart, the journal is
+    replayed over the input file to restore the statuses of the processed rows.
+    """
+    def __init__(self, path: str):
+        """
+        Initialize the journal and open it in append mode.
+
+        args:
+            path (str): Path of the JSONL journal file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+        # Terminate a line truncated by a crash, so new entries start on their own line
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def record(self, i: Hashable, from_user: str, to_user: str, zone: str, status: str,
+               job_id: Optional[str] = None, error_class: Optional[str] = None,
+               error: Optional[str] = None, step: Optional[str] = None, blocks_copied: bool = False) -> None:
+        """Append the outcome of a row to the journal.
+
+        Args:
+            i (Hashable): Index of the row in the input file.
+            from_user (str): The primary ID of the user to merge from.
+            to_user (str): The primary ID of the user to merge to.
+            zone (str): Zone of the users.
+            status (str): Merge status of the row.
+            job_id (Optional[str]): ID of the Alma merge job, if any.
+            error_class (Optional[str]): Class name of the error, if any.
+            error (Optional[str]): Error message, if any.
+            step (Optional[str]): Step of the merge where the error occurred, if known.
+            blocks_copied (bool): The internal blocks of the row are copied to its 'to' user. Default is False.
+        """
+        entry = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                 'row': int(i),
+                 'from_user': from_user,
+                 'to_user': to_user,
+                 'zone': zone,
+                 'status': status,
+                 'job_id': job_id,
+                 'error_class': error_class,
+                 'error': error,
+                 'step': step}
+        if blocks_copied:
+            entry['blocks_copied'] = True
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def replay(self) -> Dict[int, Dict]:
+        """Read the journal and return the last entry of each row.
+
+        A truncated last line, left by a crash during a write, is ignored.
+
+        Returns:
+            Dict[int, Dict]: Last journal entry of each row, by row index.
+        """
+        with self._lock:
+            return read_journal(self.path)
+
+    def iter_entries(self) -> Iterator[Dict]:
+        """Yield the entries of the journal one by one, without holding all the rows in memory.
+
+        No entry can be recorded until the iteration is over.
+
+        Returns:
+            Iterator[Dict]: Journal entries, in the order they were written.
+        """
+        with self._lock:
+            yield from iter_journal(self.path)
+
+    def close(self) -> None:
+        """Close the journal file."""
+        with self._lock:
+            self._file.close()
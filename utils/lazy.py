@@ -0,0 +1,49 @@
+from typing import Any, Optional
+import importlib
+
+
+class LazyImport:
+    """Module, or attribute of a module, imported on first use.
+
+    pandas, almapiwrapper and the Selenium WebDriver take most of the startup time
+    of the command line, while `--help` or `--status` need none of them. The modules
+    using them bind a `LazyImport` in their place, which imports the dependency on
+    the first attribute access or call. The import itself goes through the import
+    system, so concurrent first uses from several threads are safe.
+
+    The type annotations of these modules are not evaluated, see
+    `from __future__ import annotations`, and exceptions caught in `except` clauses
+    are imported normally.
+    """
+    def __init__(self, module: str, attribute: Optional[str] = None):
+        """
+        Initialize the deferred import.
+
+        args:
+            module (str): Full name of the module, like 'selenium.webdriver.common.by'.
+            attribute (Optional[str]): Name of the attribute of the module, like 'By', None for
+                the module itself. Default is None.
+        """
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+
+    def _resolve(self) -> Any:
+        """Import the module and return the target of the deferred import."""
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attribute) if self._attribute is not None else target
+        return self._target
+
+    def __getattr__(self, name: str) -> Any:
+        """Return an attribute of the target, importing it first if needed."""
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        """Call the target, like a class or a function, importing it first if needed."""
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        """Return the name of the target."""
+        name = self._module if self._attribute is None else f'{self._module}.{self._attribute}'
+        return f'<LazyImport {name}>'
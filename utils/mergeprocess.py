@@ -1,41 +1,295 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support import expected_conditions as EC
+from __future__ import annotations
 
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
 from selenium.common.exceptions import StaleElementReferenceException, NoSuchElementException, TimeoutException, ElementNotInteractableException, ElementClickInterceptedException
 
+from contextlib import contextmanager
+import abc
+import csv
 import os
+import tempfile
 import time
-from typing import Optional
-
-from almapiwrapper.users import User
+from typing import Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
 
+from utils.lazy import LazyImport
+from utils.metrics import StepTimings
 from utils.staff import TempStaffUser
+from utils.userapi import get_client
 
 import logging
 
+if TYPE_CHECKING:
+    from almapiwrapper.users import User
+
+# The WebDriver is only imported when a browser is started
+webdriver = LazyImport('selenium.webdriver')
+Options = LazyImport('selenium.webdriver.chrome.options', 'Options')
+EC = LazyImport('selenium.webdriver.support.expected_conditions')
+WebDriverWait = LazyImport('selenium.webdriver.support.ui', 'WebDriverWait')
+By = LazyImport('selenium.webdriver.common.by', 'By')
+Keys = LazyImport('selenium.webdriver.common.keys', 'Keys')
+ActionChains = LazyImport('selenium.webdriver.common.action_chains', 'ActionChains')
+requests = LazyImport('requests')
+
+# Errors of a step that may pass when the step is tried again, like a slow page
+TRANSIENT_ERRORS = (TimeoutException, StaleElementReferenceException, ElementNotInteractableException,
+                    ElementClickInterceptedException)
+
+# Steps after which the merge job may already be started, their errors are never retried
+SUBMITTED_STEPS = {'start button', 'log_merge_job_id'}
+
+# Maximum wait in seconds for a checkbox of the merge options to become clickable before its next attempt
+CHECKBOX_RETRY_WAIT = 5
+
+
+def is_transient(error: Exception) -> bool:
+    """Return whether a failed step may pass when it is tried again.
+
+    args:
+        error (Exception): Error of the step.
+
+    returns:
+        bool: True for the errors in `TRANSIENT_ERRORS` and the connection errors and timeouts of requests.
+    """
+    return isinstance(error, TRANSIENT_ERRORS + (requests.ConnectionError, requests.Timeout))
+
+
 class MergeProcessError(Exception):
-    """Custom exception for merge process errors."""
-    pass
+    """Custom exception for merge process errors.
+
+    The error keeps the step of the merge where it occurred and the class of the
+    original error. It is transient when the merge may pass on a retry, like after
+    a timeout, and permanent when the data is the cause, like a user not found.
+    """
+    def __init__(self, message: str = '', step: Optional[str] = None, cause: Optional[str] = None,
+                 transient: bool = False):
+        """
+        Initialize the error.
+
+        args:
+            message (str): Error message.
+            step (Optional[str]): Name of the step of the merge that failed. Default is None.
+            cause (Optional[str]): Class name of the original error. Default is None.
+            transient (bool): The merge may pass on a retry. Default is False.
+        """
+        super().__init__(message)
+        self.step = step
+        self.cause = cause
+        self.transient = transient
+
 
 class UserNotFoundError(Exception):
     """Custom exception for user not found errors."""
     pass
 
-class AlmaMerger:
+def get_user_data(primary_id: str, zone: str, env: str) -> User:
+    """Fetch a user with the Alma API and check that it exists.
+
+    The user comes from the cache of the shared API client if it was fetched recently.
+
+    Args:
+        primary_id (str): The primary ID of the user.
+        zone (str): Zone of the user.
+        env (str): Alma environment, 'P' or 'S'.
+    Raises:
+        UserNotFoundError: If the user does not exist.
+    Returns:
+        User: The user object if found.
+    """
+    u = get_client().get_user(primary_id, zone, env)
+    if u.error:
+        msg = f"User {primary_id} does not exist. ({type(u.error).__name__})"
+        logging.warning(msg)
+        raise UserNotFoundError(msg)
+
+    return u
+
+
+def internal_blocks(u: User) -> List[Dict]:
+    """Return the internal blocks of a user, the ones copied to the target of its merge.
+
+    Args:
+        u (User): The user object.
+    Returns:
+        List[Dict]: The blocks of the user with the 'Internal' segment type.
+    """
+    return [block for block in u.data['user_block'] if block['segment_type'] == 'Internal']
+
+
+class MergeBackend(abc.ABC):
+    """Interface of the engines submitting merge jobs to Alma.
+
+    The API part of a merge (user data, internal blocks) is common to all backends,
+    the submission of the merge job is implemented by each backend in `_merge_users`.
+    The backends with `batch_mode` also submit a list of pairs as one merge job.
+    """
+    batch_mode = False
+
+    def __init__(self, temp_staff: TempStaffUser, timings: Optional[StepTimings] = None):
+        """
+        Initialize the backend.
+
+        args:
+            temp_staff (TempStaffUser): The staff user object with login credentials.
+            timings (Optional[StepTimings]): Collection receiving the step durations. Default is a new one.
+        """
+        self.temp_staff = temp_staff
+        self.env = os.getenv('ALMA_ENV', 'P')
+        self.timings = timings if timings is not None else StepTimings()
+
+    @abc.abstractmethod
+    def login(self):
+        """Log in to Alma using the temporary staff user credentials."""
+
+    @abc.abstractmethod
+    def open_merge_users_page(self):
+        """Open the merge users page in Alma."""
+
+    @abc.abstractmethod
+    def reset_page(self):
+        """Bring the session back to an empty Merge Users page without logging in again."""
+
+    @abc.abstractmethod
+    def logout(self):
+        """Drop the session, so that another staff user can log in."""
+
+    @abc.abstractmethod
+    def quit(self):
+        """Release the resources of the backend, like the browser."""
+
+    def merge_users(self, from_user: str, to_user: str, from_user_data: Optional[User] = None,
+                    to_user_data: Optional[User] = None, copy_blocks: bool = True) -> str:
+        """Merge two users in Alma.
+
+        Args:
+            from_user (str): The primary ID of the user to merge from.
+            to_user (str): The primary ID of the user to merge to.
+            from_user_data (Optional[User]): Already fetched data of the user to merge from.
+            to_user_data (Optional[User]): Already fetched data of the user to merge to.
+            copy_blocks (bool): Copy the internal blocks of the user to merge from before starting the job,
+                False when they were copied beforehand, see `utils.blocks.copy_blocks`. Default is True.
+
+        Returns:
+            str: The ID of the merge job.
+
+        Raises:
+            MergeProcessError: If any step fails during the merge process.
+        """
+
+        with self.timings.measure('merge_users'):
+            try:
+                return self._merge_users(from_user, to_user, from_user_data, to_user_data, copy_blocks)
+            finally:
+                # The merge changes both users in Alma
+                for primary_id in (from_user, to_user):
+                    get_client().invalidate(primary_id, self.temp_staff.zone, self.env)
+
+    @contextmanager
+    def step(self, name: str, method: str = 'merge_users') -> Iterator[None]:
+        """Time a named step of the merge flow and turn its errors into MergeProcessError.
+
+        The error keeps the innermost failed step and the class of the original error.
+        It is transient according to `is_transient`, unless the
+        merge job may already be started.
+
+        Args:
+            name (str): Name of the step, used for the timings and the error messages.
+            method (str): Name of the method running the step, used in the logs. Default is 'merge_users'.
+
+        Raises:
+            MergeProcessError: If the step fails.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.timings.record(name, time.perf_counter() - start, ok=False)
+            logging.error(f"[{method}] Error at {name}: {type(e).__name__}")
+            if isinstance(e, MergeProcessError):
+                message, step = f"{name}: {e}", e.step if e.step is not None else name
+                cause = e.cause if e.cause is not None else type(e).__name__
+                transient = e.transient
+            else:
+                message, step, cause = f"{name}: {type(e).__name__}", name, type(e).__name__
+                transient = is_transient(e)
+            raise MergeProcessError(message, step=step, cause=cause,
+                                    transient=transient and name not in SUBMITTED_STEPS) from e
+        self.timings.record(name, time.perf_counter() - start)
+
+    @abc.abstractmethod
+    def _merge_users(self, from_user: str, to_user: str, from_user_data: Optional[User],
+                     to_user_data: Optional[User], copy_blocks: bool = True) -> str:
+        """Run the steps of `merge_users`."""
+
+    def merge_users_batch(self, pairs: List[Tuple[str, str]]) -> str:
+        """Submit one merge job for a list of user pairs.
+
+        Args:
+            pairs (List[Tuple[str, str]]): Primary IDs of the users to merge from and to.
+
+        Returns:
+            str: The ID of the merge job.
+
+        Raises:
+            MergeProcessError: If the backend has no batch mode, see `check_backend`.
+        """
+        raise MergeProcessError(f'{type(self).__name__} has no batch mode', step='merge_users_batch')
+
+    def get_user_data(self, primary_id: str) -> Optional[User]:
+        """Check if both users exist in Alma.
+
+        Args:
+            primary_id (str): The primary ID of the user to merge from.
+        Raises:
+            UserNotFoundError: If either user does not exist.
+        Returns:
+            User: The user object if found.
+        """
+        return get_user_data(primary_id, self.temp_staff.zone, self.env)
+
+    def copy_internal_blocks(self, u_from: User, u_to: User) -> None:
+        """Copy internal blocks from one user to another.
+
+        Args:
+            from_user (User): The user to copy blocks from.
+            to_user (User): The user to copy blocks to.
+
+        Raises:
+            MergeProcessError: If any step fails during the block copying process.
+        """
+
+        blocks = internal_blocks(u_from)
+
+        if len(blocks) > 0:
+            u_from.data['user_identifier'] = []
+            get_client().update_user(u_from)
+            u_to.data['user_block'] += internal_blocks(u_from)
+            get_client().update_user(u_to)
+            if u_to.error:
+                logging.error(f"Failed to update user {u_to.primary_id} after copying blocks: {u_to.error_msg} ({type(u_to.error).__name__})")
+                raise MergeProcessError(f"Failed to update user {u_to.primary_id} after copying blocks: {u_to.error_msg} ({type(u_to.error).__name__})")
+
+
+class AlmaMerger(MergeBackend):
     """Class to handle merging users in Alma using Selenium WebDriver."""
-    def __init__(self, temp_staff: TempStaffUser, headless: bool = True):
+    batch_mode = True
+    BATCH_MODE_XPATH = "//input[@type='radio' and contains(@value, 'FILE')]/following-sibling::label[1]"
+    BATCH_FILE_XPATH = "//input[@type='file']"
+
+    def __init__(self, temp_staff: TempStaffUser, headless: bool = True, timings: Optional[StepTimings] = None,
+                 settle_delay: Optional[float] = None):
         """
         Initialize the AlmaMerger with a Selenium WebDriver.
 
         args:
             temp_staff (TempStaffUser): The staff user object with login credentials.
             headless (bool): Whether to run the browser in headless mode. Default is True.
+            timings (Optional[StepTimings]): Collection receiving the step durations. Default is a new one.
+            settle_delay (Optional[float]): Fixed delay in seconds added after each readiness condition,
+                as a fallback if the UI needs more time. Default is the MERGE_SETTLE_DELAY
+                environment variable or 0.
         """
-        self.temp_staff = temp_staff
-        self.env = os.getenv('ALMA_ENV', 'P')
+        super().__init__(temp_staff, timings)
+        self.settle_delay = settle_delay if settle_delay is not None else float(os.getenv('MERGE_SETTLE_DELAY', 0))
         options = Options()
         if headless:
             options.add_argument("--headless")
@@ -78,99 +332,177 @@ class AlmaMerger:
         )))
         li_merge.click()
 
-    def merge_users(self, from_user: str, to_user: str):
-        """Merge two users in Alma using Selenium WebDriver.
+    def reset_page(self):
+        """Bring the browser back to an empty Merge Users page without logging in again.
 
-        Args:
-            from_user (str): The primary ID of the user to merge from.
-            to_user (str): The primary ID of the user to merge to.
+        Leaves any iframe, closes the user pickup popup if it is still open and
+        navigates back to the Merge Users page.
+        """
+        self.driver.switch_to.default_content()
+        if EC.visibility_of_element_located((By.ID, "iframePopupIframe"))(self.driver):
+            ActionChains(self.driver).send_keys(Keys.ESCAPE).perform()
+            self.wait.until(EC.invisibility_of_element_located((By.ID, "iframePopupIframe")))
+        self.open_merge_users_page()
+        self.wait.until(EC.element_to_be_clickable((By.XPATH, "//a[normalize-space()='Add Job']")))
 
-        Returns:
-            None
+    def logout(self):
+        """Drop the session cookies of the browser, so that another staff user can log in."""
+        self.driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
 
-        Raises:
-            MergeProcessError: If any step fails during the merge process.
-        """
+    def quit(self):
+        """Quit the browser."""
+        self.driver.quit()
 
-        from_user_data = self.get_user_data(from_user)
-        to_user_data = self.get_user_data(to_user)
+    def wait_ready(self, step: str, condition):
+        """Wait until a readiness condition is met and record the waiting time.
 
-        try:
+        Args:
+            step (str): Name of the step, used for the timings.
+            condition: Expected condition passed to WebDriverWait.until.
+
+        Returns:
+            The value returned by the condition.
+        """
+        start = time.perf_counter()
+        result = self.wait.until(condition)
+        if self.settle_delay > 0:
+            time.sleep(self.settle_delay)
+        self.timings.record(f'wait {step}', time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    def page_loaded(driver) -> bool:
+        """Expected condition: the current document (or frame) is completely loaded."""
+        return driver.execute_script('return document.readyState') == 'complete'
+
+    def _merge_users(self, from_user: str, to_user: str, from_user_data: Optional[User],
+                     to_user_data: Optional[User], copy_blocks: bool = True) -> str:
+        """Run the steps of `merge_users`."""
+        if from_user_data is None and copy_blocks:
+            with self.timings.measure('get_user_data (from_user)'):
+                from_user_data = self.get_user_data(from_user)
+        if to_user_data is None and copy_blocks:
+            with self.timings.measure('get_user_data (to_user)'):
+                to_user_data = self.get_user_data(to_user)
+
+        with self.step('Add Job button'):
             add_job = self.wait.until(EC.element_to_be_clickable((
                 By.XPATH, "//a[normalize-space()='Add Job']"
             )))
             add_job.click()
-        except Exception as e:
-            logging.error(f"[merge_users] Error at Add Job button: {type(e).__name__}")
-            raise MergeProcessError(f"Add Job button: {type(e).__name__}")
-        try:
+        with self.step("Pickup 'from user' button"):
             pickup_btn = self.wait.until(
                 EC.element_to_be_clickable((By.ID,"PICKUP_ID_pageBeandisplayNameOfFromUserOrUserIdendifier"))
             )
             pickup_btn.click()
-        except Exception as e:
-            logging.error(f"[merge_users] Error at Pickup 'from user' button: {type(e).__name__}")
-            raise MergeProcessError(f"Pickup 'from user' button: {type(e).__name__}")
-        try:
+        with self.step('search_user_in_iframe (from_user)'):
             self.search_user_in_iframe(from_user)
-        except Exception as e:
-            logging.error(f"[merge_users] Error at search_user_in_iframe (from_user): {type(e).__name__}")
-            raise MergeProcessError(f"search_user_in_iframe (from_user): {type(e).__name__}")
-        try:
+        with self.step("Pickup 'to user' button"):
             pickup_btn = self.wait.until(EC.element_to_be_clickable((By.ID, "PICKUP_ID_pageBeandisplayNameOfToUserOrUserIdendifier")))
             pickup_btn.click()
-        except Exception as e:
-            logging.error(f"[merge_users] Error at Pickup 'to user' button: {type(e).__name__}")
-            raise MergeProcessError(f"Pickup 'to user' button: {type(e).__name__}")
-        try:
+        with self.step('search_user_in_iframe (to_user)'):
             self.search_user_in_iframe(to_user)
-        except Exception as e:
-            logging.error(f"[merge_users] Error at search_user_in_iframe (to_user): {type(e).__name__}")
-            raise MergeProcessError(f"search_user_in_iframe (to_user): {type(e).__name__}")
-        try:
-            time.sleep(2)
-            for param in [
-                'PARAM_COPY_ATTACHMENTS',
-                'PARAM_COPY_NOTES',
-                'PARAM_COPY_DEMERITS',
-                'PARAM_COPY_PROXY_OF'
-            ]:
-                for attempt in range(3):
-                    try:
-                        checkbox_input = self.wait.until(EC.presence_of_element_located((By.XPATH, f"//input[@type='checkbox' and @value='{param}']")))
-                        if not checkbox_input.is_selected():
-                            checkbox_label = self.wait.until(EC.element_to_be_clickable((By.XPATH, f"//input[@type='checkbox' and @value='{param}']/following-sibling::label[1]")))
-                            checkbox_label.click()
-                        break
-                    except (StaleElementReferenceException, NoSuchElementException, TimeoutException, ElementNotInteractableException, ElementClickInterceptedException) as e:
-                        logging.error(f"[merge_users] Error at checkbox {param}: {type(e).__name__}")
-                        if attempt == 2:
-                            raise MergeProcessError(f"Checkbox {param}: {type(e).__name__}")
-                        time.sleep(0.5)
-        except Exception as e:
-            logging.error(f"[merge_users] Error at merge options: {type(e).__name__}")
-            raise MergeProcessError(f"merge options: {type(e).__name__}")
-        try:
+        with self.step('merge options'):
+            self.select_merge_options()
+        with self.step('merge button'):
             merge_btn = self.wait.until(EC.element_to_be_clickable((By.ID, 'PAGE_BUTTONS_cbuttonmerge')))
             merge_btn.click()
-        except Exception as e:
-            logging.error(f"[merge_users] Error at merge button: {type(e).__name__}")
-            raise MergeProcessError(f"merge button: {type(e).__name__}")
 
-        self.copy_internal_blocks(from_user_data, to_user_data)
+        if copy_blocks:
+            with self.timings.measure('copy_internal_blocks'):
+                self.copy_internal_blocks(from_user_data, to_user_data)
 
-        try:
+        with self.step('start button'):
             start_btn = self.wait.until(EC.element_to_be_clickable((By.ID, 'PAGE_BUTTONS_cbuttonconfirmationconfirm')))
             start_btn.click()
-            time.sleep(2)
-        except Exception as e:
-            logging.error(f"[merge_users] Error at start button: {type(e).__name__}")
-            raise MergeProcessError(f"start button: {type(e).__name__}")
+            self.wait_ready('job list', EC.invisibility_of_element(start_btn))
+        with self.step('log_merge_job_id'):
+            return self.log_merge_job_id()
+
+    def select_merge_options(self, method: str = 'merge_users'):
+        """Check the options of the merge job: copy attachments, notes, demerits and proxies.
+
+        Args:
+            method (str): Name of the calling method, used in the logs. Default is 'merge_users'.
+        Raises:
+            MergeProcessError: If a checkbox cannot be checked after 3 attempts.
+        """
+        first_checkbox = (By.XPATH, "//input[@type='checkbox' and @value='PARAM_COPY_ATTACHMENTS']")
+        self.wait_ready('merge options', lambda d: (
+                EC.invisibility_of_element_located((By.ID, "iframePopupIframe"))(d) and
+                EC.presence_of_element_located(first_checkbox)(d)
+        ))
+        for param in [
+            'PARAM_COPY_ATTACHMENTS',
+            'PARAM_COPY_NOTES',
+            'PARAM_COPY_DEMERITS',
+            'PARAM_COPY_PROXY_OF'
+        ]:
+            for attempt in range(3):
+                try:
+                    checkbox_input = self.wait.until(EC.presence_of_element_located((By.XPATH, f"//input[@type='checkbox' and @value='{param}']")))
+                    if not checkbox_input.is_selected():
+                        checkbox_label = self.wait.until(EC.element_to_be_clickable((By.XPATH, f"//input[@type='checkbox' and @value='{param}']/following-sibling::label[1]")))
+                        checkbox_label.click()
+                    break
+                except (StaleElementReferenceException, NoSuchElementException, TimeoutException, ElementNotInteractableException, ElementClickInterceptedException) as e:
+                    logging.error(f"[{method}] Error at checkbox {param}: {type(e).__name__}")
+                    if attempt == 2:
+                        raise MergeProcessError(f"Checkbox {param}: {type(e).__name__}", cause=type(e).__name__,
+                                                transient=is_transient(e)) from e
+                    # A short wait, a checkbox never clickable must not end the attempts early
+                    try:
+                        WebDriverWait(self.driver, CHECKBOX_RETRY_WAIT).until(EC.element_to_be_clickable((
+                            By.XPATH, f"//input[@type='checkbox' and @value='{param}']/following-sibling::label[1]"
+                        )))
+                    except TimeoutException:
+                        pass
+
+    def merge_users_batch(self, pairs: List[Tuple[str, str]]) -> str:
+        """Submit one merge job for a list of user pairs, uploaded as a file.
+
+        The pairs are written to a temporary CSV file, one "from user,to user" pair
+        per line, which is uploaded in the "from file" mode of the Add Job form.
+
+        Args:
+            pairs (List[Tuple[str, str]]): Primary IDs of the users to merge from and to.
+
+        Returns:
+            str: The ID of the merge job.
+
+        Raises:
+            MergeProcessError: If any step fails during the submission.
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(pairs)
+            file_path = f.name
+
         try:
-            self.log_merge_job_id()
-        except Exception as e:
-            logging.error(f"[merge_users] Error at log_merge_job_id: {type(e).__name__}")
-            raise MergeProcessError(f"log_merge_job_id: {type(e).__name__}")
+            with self.timings.measure('merge_users_batch'):
+                with self.step('Add Job button', 'merge_users_batch'):
+                    add_job = self.wait.until(EC.element_to_be_clickable((
+                        By.XPATH, "//a[normalize-space()='Add Job']"
+                    )))
+                    add_job.click()
+                with self.step('file mode', 'merge_users_batch'):
+                    file_mode = self.wait.until(EC.element_to_be_clickable((By.XPATH, self.BATCH_MODE_XPATH)))
+                    file_mode.click()
+                with self.step('file upload', 'merge_users_batch'):
+                    file_input = self.wait.until(EC.presence_of_element_located((By.XPATH, self.BATCH_FILE_XPATH)))
+                    file_input.send_keys(file_path)
+                with self.step('merge options', 'merge_users_batch'):
+                    self.select_merge_options('merge_users_batch')
+                with self.step('merge button', 'merge_users_batch'):
+                    merge_btn = self.wait.until(EC.element_to_be_clickable((By.ID, 'PAGE_BUTTONS_cbuttonmerge')))
+                    merge_btn.click()
+                with self.step('start button', 'merge_users_batch'):
+                    start_btn = self.wait.until(EC.element_to_be_clickable((By.ID, 'PAGE_BUTTONS_cbuttonconfirmationconfirm')))
+                    start_btn.click()
+                    self.wait_ready('job list', EC.invisibility_of_element(start_btn))
+                with self.step('log_merge_job_id', 'merge_users_batch'):
+                    return self.log_merge_job_id()
+        finally:
+            os.remove(file_path)
 
     def search_user_in_iframe(self, primary_id: str):
         """Search for a user by primary ID within an iframe and select the first result.
@@ -180,108 +512,54 @@ class AlmaMerger:
         Raises:
             MergeProcessError: If any step fails during the search process.
         """
-        try:
+        with self.step('switching to iframe', 'search_user_in_iframe'):
             iframe = self.wait.until(EC.presence_of_element_located((By.ID, "iframePopupIframe")))
             self.driver.switch_to.frame(iframe)
-            time.sleep(2)
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at switching to iframe: {type(e).__name__}")
-            raise MergeProcessError(f"switching to iframe: {type(e).__name__}")
-        try:
+            self.wait_ready('iframe', self.page_loaded)
+        with self.step('search type button', 'search_user_in_iframe'):
             search_type = self.wait.until(EC.element_to_be_clickable((By.ID, "simpleSearchIndexButton")))
             search_type.click()
-            time.sleep(1)
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at search type button: {type(e).__name__}")
-            raise MergeProcessError(f"search type button: {type(e).__name__}")
-        try:
+            self.wait_ready('search type menu', EC.visibility_of_element_located((
+                By.ID, "TOP_NAV_Search_index_HFrUser.user_name"
+            )))
+        with self.step('primary id option', 'search_user_in_iframe'):
             primary_id_option = self.wait.until(EC.element_to_be_clickable((By.ID, "TOP_NAV_Search_index_HFrUser.user_name")))
             primary_id_option.click()
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at primary id option: {type(e).__name__}")
-            raise MergeProcessError(f"primary id option: {type(e).__name__}")
-        try:
+        with self.step('search field', 'search_user_in_iframe'):
             search_user = self.wait.until(EC.element_to_be_clickable((By.ID, "ALMA_MENU_TOP_NAV_Search_Text")))
             search_user.clear()
             search_user.send_keys(primary_id)
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at search field: {type(e).__name__}")
-            raise MergeProcessError(f"search field: {type(e).__name__}")
-        try:
+        with self.step('search button', 'search_user_in_iframe'):
             search_button = self.wait.until(EC.element_to_be_clickable((By.ID, "simpleSearchBtn")))
             search_button.click()
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at search button: {type(e).__name__}")
-            raise MergeProcessError(f"search button: {type(e).__name__}")
-        try:
+        with self.step('user table', 'search_user_in_iframe'):
             user_table = self.wait.until(EC.presence_of_element_located((By.ID, "TABLE_DATA_userList")))
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at user table: {type(e).__name__}")
-            raise MergeProcessError(f"user table: {type(e).__name__}")
-        try:
-            first_row = self.wait.until(lambda d: (
-                    (rows := user_table.find_elements(By.CSS_SELECTOR, "tbody tr")) and
-                    EC.element_to_be_clickable(rows[0])(d) and rows[0]
-            ))
-            first_row.click()
-        except Exception as e:
-            logging.warning(f"No user found: {type(e).__name__}")
-            raise MergeProcessError(f"No user found: {type(e).__name__}")
-        try:
+        with self.timings.measure('first result'):
+            try:
+                first_row = self.wait.until(lambda d: (
+                        (rows := user_table.find_elements(By.CSS_SELECTOR, "tbody tr")) and
+                        EC.element_to_be_clickable(rows[0])(d) and rows[0]
+                ))
+                first_row.click()
+            except Exception as e:
+                logging.warning(f"No user found: {type(e).__name__}")
+                raise MergeProcessError(f"No user found: {type(e).__name__}", step='first result',
+                                        cause=type(e).__name__) from e
+        with self.step('switch to default content', 'search_user_in_iframe'):
             self.driver.switch_to.default_content()
-        except Exception as e:
-            logging.error(f"[search_user_in_iframe] Error at switch to default content: {type(e).__name__}")
-            raise MergeProcessError(f"switch to default content: {type(e).__name__}")
 
-    def get_user_data(self, primary_id: str) -> Optional[User]:
-        """Check if both users exist in Alma.
+    def log_merge_job_id(self) -> str:
+        """Log the merge job ID after initiating a merge.
 
-        Args:
-            primary_id (str): The primary ID of the user to merge from.
-        Raises:
-            UserNotFoundError: If either user does not exist.
         Returns:
-            User: The user object if found.
-        """
-        u = User(primary_id, self.temp_staff.zone, self.env)
-        _ = u.data
-        if u.error:
-            msg = f"User {primary_id} does not exist. ({type(u.error).__name__})"
-            logging.warning(msg)
-            raise UserNotFoundError(msg)
-
-        return u
-
-    def copy_internal_blocks(self, u_from: User, u_to: User) -> None:
-        """Copy internal blocks from one user to another.
-
-        Args:
-            from_user (User): The user to copy blocks from.
-            to_user (User): The user to copy blocks to.
-
-        Raises:
-            MergeProcessError: If any step fails during the block copying process.
-        """
-
-        internal_blocks = [block for block in u_from.data['user_block'] if block['segment_type']=='Internal']
-
-        if len(internal_blocks) > 0:
-            u_from.data['user_identifier'] = []
-            u_from.update()
-            u_to.data['user_block'] += [block for block in u_from.data['user_block'] if block['segment_type']=='Internal']
-            u_to.update()
-            if u_to.error:
-                logging.error(f"Failed to update user {u_to.primary_id} after copying blocks: {u_to.error_msg} ({type(u_to.error).__name__})")
-                raise MergeProcessError(f"Failed to update user {u_to.primary_id} after copying blocks: {u_to.error_msg} ({type(u_to.error).__name__})")
-
-    def log_merge_job_id(self):
-        """Log the merge job ID after initiating a merge.
+            str: The ID of the merge job.
         """
         try:
             jobid_cell = self.wait.until(EC.visibility_of_element_located(
                 (By.XPATH, "//tr[@id='recordContainerjobList1']/td[2]")
                  ))
             logging.info(f"Merge job initiated with ID: {jobid_cell.text}")
+            return jobid_cell.text
         except Exception as e:
             logging.error(f"Failed to retrieve merge job ID: {type(e).__name__}")
             raise MergeProcessError(f"Failed to retrieve merge job ID: {type(e).__name__}")
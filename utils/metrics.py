@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, TYPE_CHECKING
+import json
+import math
+import os
+import random
+import threading
+import time
+
+if TYPE_CHECKING:
+    from utils.progress import RunProgress
+
+
+class MetricsFile:
+    """Append-only JSONL file receiving one line per timed step."""
+    def __init__(self, path: str):
+        """
+        Initialize the metrics file and open it in append mode.
+
+        args:
+            path (str): Path of the JSONL metrics file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, entry: Dict) -> None:
+        """Append an entry to the file.
+
+        Args:
+            entry (Dict): JSON serializable entry.
+        """
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        """Close the metrics file."""
+        with self._lock:
+            self._file.close()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Return the nearest-rank percentile of a list of values.
+
+    Args:
+        values (List[float]): Values, not necessarily sorted.
+        q (float): Percentile between 0 and 1.
+
+    Returns:
+        float: The percentile value.
+    """
+    values = sorted(values)
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+class StepTimings:
+    """Thread-safe collection of the durations of the named steps of the merge flow of a zone.
+
+    The memory does not grow with the number of merges: the count, total and maximum
+    of each step are running aggregates, and the percentiles are computed on a
+    uniform random sample of at most `sample_size` durations (reservoir sampling).
+    They are exact as long as a step has no more durations than the sample.
+    """
+    def __init__(self, zone: Optional[str] = None, metrics_file: Optional[MetricsFile] = None,
+                 progress: Optional['RunProgress'] = None, sample_size: int = 1000):
+        """
+        Initialize the collection.
+
+        args:
+            zone (Optional[str]): Zone of the merges, written in the metrics file. Default is None.
+            metrics_file (Optional[MetricsFile]): File receiving each duration. Default is None.
+            progress (Optional[RunProgress]): Live metrics of the run, adding each duration to the
+                histogram of its step. Default is None.
+            sample_size (int): Maximum number of durations kept per step for the percentiles. Default is 1000.
+        """
+        self.zone = zone
+        self.metrics_file = metrics_file
+        self.progress = progress
+        self.sample_size = sample_size
+        self._steps: Dict[str, Dict] = {}
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def record(self, step: str, seconds: float, ok: bool = True) -> None:
+        """Record the duration of a step.
+
+        Args:
+            step (str): Name of the step.
+            seconds (float): Duration of the step in seconds.
+            ok (bool): Whether the step succeeded. Default is True.
+        """
+        with self._lock:
+            stats = self._steps.setdefault(step, {'count': 0, 'total': 0.0, 'max': seconds, 'sample': []})
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            if len(stats['sample']) < self.sample_size:
+                stats['sample'].append(seconds)
+            else:
+                # Each duration stays in the sample with the probability sample_size / count
+                j = self._random.randrange(stats['count'])
+                if j < self.sample_size:
+                    stats['sample'][j] = seconds
+        if self.progress is not None:
+            self.progress.observe(self.zone, step, seconds)
+        if self.metrics_file is not None:
+            self.metrics_file.write({'timestamp': datetime.now().isoformat(timespec='milliseconds'),
+                                     'zone': self.zone,
+                                     'step': step,
+                                     'seconds': round(seconds, 4),
+                                     'ok': ok})
+
+    @contextmanager
+    def measure(self, step: str) -> Iterator[None]:
+        """Context manager recording the duration of the enclosed block.
+
+        Args:
+            step (str): Name of the step.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(step, time.perf_counter() - start, ok=False)
+            raise
+        self.record(step, time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Return count, mean, p50, p95 and max duration of each step.
+
+        The percentiles are estimated on the sample of the durations of the step.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Statistics by step name.
+        """
+        with self._lock:
+            return {step: {'count': stats['count'],
+                           'mean': stats['total'] / stats['count'],
+                           'p50': percentile(stats['sample'], 0.5),
+                           'p95': percentile(stats['sample'], 0.95),
+                           'max': stats['max']}
+                    for step, stats in self._steps.items()}
+
+    def report(self) -> List[str]:
+        """Return one human-readable line per step, for the logs.
+
+        Returns:
+            List[str]: Report lines.
+        """
+        return [f'{step}: {stats["count"]} calls, mean {stats["mean"]:.2f}s, p50 {stats["p50"]:.2f}s, '
+                f'p95 {stats["p95"]:.2f}s, max {stats["max"]:.2f}s'
+                for step, stats in sorted(self.summary().items())]
@@ -0,0 +1,87 @@
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+# Statuses of the rows rejected before the merge, by reason
+SELF_MERGE = 'SELF_MERGE'
+DUPLICATE = 'DUPLICATE'
+CONFLICT = 'CONFLICT'
+CYCLE = 'CYCLE'
+
+
+class InvalidPairError(Exception):
+    """Custom exception for pairs rejected by the merge graph."""
+    pass
+
+
+def plan_merges(pairs: Dict[Hashable, Tuple[str, str]],
+                done_pairs: Iterable[Tuple[str, str]] = ()) -> Tuple[Dict[Hashable, str],
+                                                                     Dict[Hashable, Tuple[str, str]]]:
+    """Build the merge graph of a zone and find the final target of each merge.
+
+    Each 'from' user points to its 'to' user. The final target of a user is found by
+    following the pointers up to a user who is not merged, with path compression as
+    in a union-find, so chains (A->B, B->C) are collapsed to A->C and B->C and no merge
+    targets a user removed by another merge. The merges already done are part of
+    the graph, so a merge into an already merged user goes to its final target.
+
+    The rows are rejected when:
+        * the 'from' and 'to' users are the same: SELF_MERGE;
+        * the pair is already in an earlier row or already merged: DUPLICATE;
+        * the 'from' user is already merged into another user: CONFLICT;
+        * following the targets leads back to the user: CYCLE.
+
+    Args:
+        pairs (Dict[Hashable, Tuple[str, str]]): 'from' and 'to' users of the rows to merge, by row index.
+        done_pairs (Iterable[Tuple[str, str]]): 'from' and 'to' users of the merges already done.
+
+    Returns:
+        Tuple[Dict[Hashable, str], Dict[Hashable, Tuple[str, str]]]: Final target of the rows to
+            merge, and status and reason of the rejected rows.
+    """
+    edges: Dict[str, str] = {}
+    for from_user, to_user in done_pairs:
+        if from_user != to_user:
+            edges.setdefault(from_user, to_user)
+    done_edges = dict(edges)
+
+    rejected = {}
+    rows: Dict[Hashable, str] = {}
+    first_rows: Dict[Tuple[str, str], Hashable] = {}
+    for i, (from_user, to_user) in pairs.items():
+        if from_user == to_user:
+            rejected[i] = (SELF_MERGE, f'{from_user} cannot be merged into itself')
+        elif done_edges.get(from_user) == to_user:
+            rejected[i] = (DUPLICATE, f'{from_user} is already merged into {to_user}')
+        elif (from_user, to_user) in first_rows:
+            rejected[i] = (DUPLICATE, f'Same merge as row {first_rows[(from_user, to_user)]}')
+        elif from_user in edges:
+            rejected[i] = (CONFLICT, f'{from_user} is already merged into {edges[from_user]}')
+        else:
+            edges[from_user] = to_user
+            first_rows[(from_user, to_user)] = i
+            rows[i] = from_user
+
+    # Final target of each user, None for the users on or leading to a cycle
+    roots: Dict[str, Optional[str]] = {}
+    for start in edges:
+        path = []
+        on_path = set()
+        user = start
+        while user in edges and user not in roots and user not in on_path:
+            path.append(user)
+            on_path.add(user)
+            user = edges[user]
+        if user in on_path:
+            root = None
+        else:
+            root = roots[user] if user in roots else user
+        for user in path:
+            roots[user] = root
+
+    targets = {}
+    for i, from_user in rows.items():
+        if roots[from_user] is None:
+            rejected[i] = (CYCLE, f'Merging {from_user} into {pairs[i][1]} leads to a cycle of merges')
+        else:
+            targets[i] = roots[from_user]
+
+    return targets, rejected
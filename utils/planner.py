@@ -0,0 +1,322 @@
+"""Dry-run estimate of the duration and API cost of merging an input file.
+
+The rows still to merge are grouped by zone like in `merge.workflow`, and the
+merge graph of each zone is resolved, so the rows already merged, duplicated or
+rejected are not counted. The durations come from the steps recorded in the
+metrics files of the previous runs, see `utils.metrics.MetricsFile`, with
+defaults for the steps never recorded.
+
+The API calls of a row are the two `get_user_data` GETs of the pre-validation,
+each user being fetched once, and the PUTs copying the internal blocks of the
+'from' user, see `utils.blocks.copy_blocks`: one on the 'from' user, and one on
+each 'to' user, whatever the number of its 'from' users. The share of users with
+internal blocks is measured on a sample of the 'from' users, fetched with the
+API. Without sample, the PUTs are given as an upper bound.
+"""
+from __future__ import annotations
+
+from glob import glob
+from typing import Dict, Iterable, List, Optional
+import heapq
+import json
+import logging
+import math
+import os
+import random
+
+from utils.journal import journal_path, read_journal
+from utils.lazy import LazyImport
+from utils.mergeprocess import UserNotFoundError, internal_blocks
+from utils.pairgraph import plan_merges
+from utils.preflight import prefetch_users
+from utils.results import DONE_STATUSES, apply_journal
+from utils.scheduler import order_zones, zone_session_count
+from utils.userapi import ApiQuotaError, ApiThrottledError
+
+pd = LazyImport('pandas')
+
+# Duration in seconds of the steps never recorded in a metrics file
+DEFAULT_STEP_SECONDS = {'open_sessions': 30.0,
+                        'get_user_data': 0.5,
+                        'merge_users': 20.0,
+                        'merge_users_batch': 60.0,
+                        'copy_internal_blocks': 1.0}
+
+
+def load_step_timings(paths: Iterable[str]) -> Dict[Optional[str], Dict[str, float]]:
+    """Return the mean duration of the successful steps recorded in metrics files.
+
+    Only the sum and the number of the durations of each step are kept, so the
+    memory does not grow with the size of the metrics files.
+
+    args:
+        paths (Iterable[str]): Paths of the JSONL metrics files, missing files are skipped.
+
+    returns:
+        Dict[Optional[str], Dict[str, float]]: Mean duration of each step in seconds, by zone,
+            and for all zones under the None key.
+    """
+    totals = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not entry.get('ok', True):
+                    continue
+                for zone in (entry.get('zone'), None):
+                    total = totals.setdefault(zone, {}).setdefault(entry['step'], [0.0, 0])
+                    total[0] += entry['seconds']
+                    total[1] += 1
+
+    return {zone: {step: seconds / count for step, (seconds, count) in steps.items()}
+            for zone, steps in totals.items()}
+
+
+def step_seconds(timings: Dict[Optional[str], Dict[str, float]], zone: str) -> Dict[str, float]:
+    """Return the duration of the steps of a zone: its own timings, else the ones of all zones, else the defaults.
+
+    args:
+        timings (Dict[Optional[str], Dict[str, float]]): Mean step durations, see `load_step_timings`.
+        zone (str): Zone of the merges.
+
+    returns:
+        Dict[str, float]: Duration of each step in seconds.
+    """
+    return {**DEFAULT_STEP_SECONDS, **timings.get(None, {}), **timings.get(zone, {})}
+
+
+def pending_rows(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Return the rows still to merge of each zone, as the zone workers would merge them.
+
+    args:
+        df (pd.DataFrame): Rows of the input file, with their statuses restored from the journal.
+
+    returns:
+        Dict[str, pd.DataFrame]: Rows to merge by zone, with their final target as 'to' user.
+    """
+    accounts = {}
+    for zone, data in df.groupby('zone'):
+        done = data['Merge_status'].isin(DONE_STATUSES).values
+        pending = data.loc[~done]
+        targets, _ = plan_merges(dict(zip(pending.index, zip(pending['from_user'], pending['to_user']))),
+                                 zip(data.loc[done, 'from_user'], data.loc[done, 'to_user']))
+        pending = pending.loc[list(targets)].copy()
+        pending['to_user'] = pd.Series(targets, dtype=object)
+        if len(pending) > 0:
+            accounts[zone] = pending
+    return accounts
+
+
+def sample_block_rate(from_users: List[str], zone: str, env: str, sample_size: int,
+                      api_workers: int = 4) -> Optional[float]:
+    """Measure the share of 'from' users with internal blocks on a random sample.
+
+    args:
+        from_users (List[str]): Primary IDs of the 'from' users of the zone.
+        zone (str): Zone of the users.
+        env (str): Alma environment, 'P' or 'S'.
+        sample_size (int): Number of users fetched with the API.
+        api_workers (int): Maximum number of concurrent API calls. Default is 4.
+
+    returns:
+        Optional[float]: Share of the fetched users with internal blocks, None if none could be fetched.
+    """
+    sample = random.sample(from_users, min(sample_size, len(from_users)))
+    users = [u for u in prefetch_users(sample, zone, env, max_workers=api_workers).values()
+             if not isinstance(u, (UserNotFoundError, ApiThrottledError, ApiQuotaError))]
+    if len(users) == 0:
+        return None
+    return sum(len(internal_blocks(u)) > 0 for u in users) / len(users)
+
+
+def estimate_zone(rows: int, users: int, steps: Dict[str, float], sessions: int = 1, api_workers: int = 4,
+                  batch_size: int = 0, block_rate: Optional[float] = None, verify_merges: bool = False,
+                  share_staff: bool = False, staff_pool: bool = False, targets: Optional[List[int]] = None) -> Dict:
+    """Estimate the duration and API calls of the merges of one zone.
+
+    The sessions of the zone are opened once and the users are fetched. The internal
+    blocks are then copied by `api_workers` concurrent calls, in a stage the sessions
+    wait for, see `merge.merge_rows`, so its time is added to the time of the
+    submissions shared by the sessions. The time taken by Alma to run the merge jobs
+    and the retries are not counted.
+
+    args:
+        rows (int): Number of rows to merge.
+        users (int): Number of distinct users of the rows.
+        steps (Dict[str, float]): Duration of each step in seconds, see `step_seconds`.
+        sessions (int): Number of browser sessions of the zone. Default is 1.
+        api_workers (int): Maximum number of concurrent API calls. Default is 4.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+        block_rate (Optional[float]): Share of the 'from' users with internal blocks, None if unknown.
+            Default is None.
+        verify_merges (bool): The 'from' users are fetched again once their job is finished, in batch
+            mode or when the jobs are tracked. Default is False.
+        share_staff (bool): All sessions use the same temp staff account. Default is False.
+        staff_pool (bool): The staff accounts come from the pool kept between runs. Default is False.
+        targets (Optional[List[int]]): Number of rows of each 'to' user, whose blocks are copied with
+            one update. Default is None, for one 'to' user per row.
+
+    returns:
+        Dict: Estimated wall time in seconds, submissions and API calls of the zone.
+    """
+    submissions = rows if batch_size == 0 else math.ceil(rows / batch_size)
+    get_calls = users + (rows if verify_merges else 0)
+    targets = targets if targets is not None else [1] * rows
+    # A 'to' user is updated if at least one of its 'from' users has internal blocks
+    copies = (sum(1 - (1 - block_rate) ** count for count in targets) if block_rate is not None
+              else len(targets))
+
+    wall_time = steps['open_sessions'] + math.ceil(users / api_workers) * steps['get_user_data']
+    wall_time += math.ceil(round(copies) / api_workers) * steps['copy_internal_blocks']
+    if batch_size == 0:
+        wall_time += math.ceil(rows / sessions) * steps['merge_users']
+    else:
+        wall_time += math.ceil(submissions / sessions) * steps['merge_users_batch']
+    if verify_merges:
+        wall_time += math.ceil(rows / api_workers) * steps['get_user_data']
+
+    return {'rows': rows,
+            'users': users,
+            'sessions': sessions,
+            'wall_time': wall_time,
+            'submissions': submissions,
+            'get_calls': get_calls,
+            'put_calls': round(rows * block_rate + copies) if block_rate is not None else None,
+            'put_calls_max': rows + len(targets),
+            'staff_calls': 0 if staff_pool else 2 * (1 if share_staff else sessions)}
+
+
+def total_wall_time(wall_times: List[float], zone_workers: int = 1) -> float:
+    """Return the wall time of the zones given in turn to the first free zone worker.
+
+    args:
+        wall_times (List[float]): Wall time of each zone, in processing order.
+        zone_workers (int): Number of zones processed concurrently. Default is 1.
+
+    returns:
+        float: Time until the last zone is merged.
+    """
+    workers = [0.0] * zone_workers
+    for wall_time in wall_times:
+        heapq.heappush(workers, heapq.heappop(workers) + wall_time)
+    return max(workers)
+
+
+def plan(file_path: str, zone_workers: int = 1, zone_sessions: int = 1, share_staff: bool = False,
+         api_workers: int = 4, batch_size: int = 0, track_jobs: bool = False, staff_pool: bool = False,
+         zone_weights: Optional[Dict[str, float]] = None, max_zone_sessions: Optional[int] = None,
+         metrics_paths: Optional[Iterable[str]] = None, sample_size: int = 0,
+         session_levels: Iterable[int] = (1, 2, 4, 8)) -> Dict:
+    """Estimate the duration and API cost of merging an input file, without merging anything.
+
+    args:
+        file_path (str): Path of the input file.
+        zone_workers (int): Number of zones processed concurrently. Default is 1.
+        zone_sessions (int): Number of browser sessions per zone. Default is 1.
+        share_staff (bool): Log in all sessions of a zone with the same temp staff account. Default is False.
+        api_workers (int): Maximum number of concurrent API calls per zone. Default is 4.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+        track_jobs (bool): The merge jobs are followed until they are finished. Default is False.
+        staff_pool (bool): The staff accounts come from the pool kept between runs. Default is False.
+        zone_weights (Optional[Dict[str, float]]): Weight of the zones, 1 for the zones not listed.
+            Default is None.
+        max_zone_sessions (Optional[int]): Maximum number of concurrent browser sessions of a zone,
+            None for no limit. Default is None.
+        metrics_paths (Optional[Iterable[str]]): Metrics files of the previous runs. Default is all
+            the metrics files of the 'log' directory.
+        sample_size (int): Number of 'from' users per zone fetched to measure the share of users with
+            internal blocks, 0 to fetch none. Default is 0.
+        session_levels (Iterable[int]): Numbers of sessions per zone to compare. Default is 1, 2, 4 and 8.
+
+    returns:
+        Dict: Estimate of each zone, by zone in processing order, and of the whole file.
+    """
+    timings = load_step_timings(metrics_paths if metrics_paths is not None else glob('log/metrics*.jsonl'))
+
+    df = pd.read_csv(file_path, dtype=str)
+    if 'Merge_status' not in df.columns:
+        df['Merge_status'] = 'NOT PROCESSED'
+    if 'Merge_job_id' not in df.columns:
+        df['Merge_job_id'] = None
+    apply_journal(df, read_journal(journal_path(file_path)))
+    accounts = pending_rows(df)
+
+    env = os.getenv('ALMA_ENV', 'P')
+    zones = {}
+    for zone in order_zones(accounts, zone_weights):
+        data = accounts[zone]
+        block_rate = None
+        if sample_size > 0:
+            block_rate = sample_block_rate(list(data['from_user']), zone, env, sample_size, api_workers)
+            logging.info(f'Share of users with internal blocks in {zone}: '
+                         f'{"unknown" if block_rate is None else f"{block_rate:.0%}"}')
+        steps = step_seconds(timings, zone)
+        users = len(set(data['from_user']) | set(data['to_user']))
+        targets = list(data['to_user'].value_counts())
+
+        def estimate(sessions: int) -> Dict:
+            return estimate_zone(len(data), users, steps, sessions, api_workers, batch_size, block_rate,
+                                 batch_size > 0 or track_jobs, share_staff, staff_pool, targets)
+
+        sessions = zone_session_count(zone, zone_sessions, zone_weights, max_zone_sessions)
+        zones[zone] = estimate(sessions)
+        zones[zone]['levels'] = {level: estimate(level)['wall_time'] for level in sorted({*session_levels, sessions})}
+        zones[zone]['sample_calls'] = min(sample_size, len(data))
+
+    totals = {key: sum(zone[key] for zone in zones.values())
+              for key in ['rows', 'submissions', 'get_calls', 'put_calls_max', 'staff_calls', 'sample_calls']}
+    totals['put_calls'] = (sum(zone['put_calls'] for zone in zones.values())
+                           if all(zone['put_calls'] is not None for zone in zones.values()) else None)
+    totals['wall_time'] = total_wall_time([zone['wall_time'] for zone in zones.values()], zone_workers)
+    return {'zones': zones, 'total': totals, 'recorded_steps': sorted(timings.get(None, {}))}
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration in seconds as hours, minutes and seconds, like '1h05m' or '4m30s'.
+
+    args:
+        seconds (float): Duration in seconds.
+
+    returns:
+        str: Formatted duration.
+    """
+    seconds = round(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+def plan_report(estimate: Dict) -> List[str]:
+    """Return the lines of the printed estimate.
+
+    args:
+        estimate (Dict): Estimate returned by `plan`.
+
+    returns:
+        List[str]: Report lines.
+    """
+    def put_calls(e: Dict) -> str:
+        return f'{e["put_calls"]} PUT' if e['put_calls'] is not None else f'up to {e["put_calls_max"]} PUT'
+
+    lines = []
+    for zone, e in estimate['zones'].items():
+        levels = ', '.join(f'{level}: {format_duration(wall_time)}' for level, wall_time in e['levels'].items())
+        lines.append(f'{zone}: {e["rows"]} merges, {e["sessions"]} sessions, {format_duration(e["wall_time"])} '
+                     f'(by sessions {levels}), {e["submissions"]} submissions, {e["get_calls"]} GET, '
+                     f'{put_calls(e)}')
+    total = estimate['total']
+    lines.append(f'Total: {total["rows"]} merges in {len(estimate["zones"])} zones, '
+                 f'{format_duration(total["wall_time"])}, {total["submissions"]} submissions, '
+                 f'{total["get_calls"] + total["sample_calls"]} GET ({total["sample_calls"]} for the sample), '
+                 f'{put_calls(total)}, {total["staff_calls"]} staff account calls')
+    missing = sorted(set(DEFAULT_STEP_SECONDS) - set(estimate['recorded_steps']))
+    if len(missing) > 0:
+        lines.append(f'Default durations used for the steps never recorded: {", ".join(missing)}')
+    return lines
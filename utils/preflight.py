@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+from typing import Dict, Iterable, Optional, Union, TYPE_CHECKING
+
+from utils.mergeprocess import UserNotFoundError, get_user_data
+from utils.metrics import StepTimings
+from utils.userapi import ApiQuotaError, ApiThrottledError
+
+if TYPE_CHECKING:
+    from almapiwrapper.users import User
+
+
+def prefetch_users(primary_ids: Iterable[str], zone: str, env: str,
+                   max_workers: int = 4,
+                   timings: Optional[StepTimings] = None) -> Dict[str, Union[User, UserNotFoundError,
+                                                                             ApiThrottledError, ApiQuotaError]]:
+    """Fetch the data of a set of users concurrently with the Alma API.
+
+    Each user is fetched once, even if it appears in several rows.
+
+    Args:
+        primary_ids (Iterable[str]): Primary IDs of the users to fetch.
+        zone (str): Zone of the users.
+        env (str): Alma environment, 'P' or 'S'.
+        max_workers (int): Maximum number of concurrent API calls. Default is 4.
+        timings (Optional[StepTimings]): Collection receiving the duration of each call. Default is None.
+
+    Returns:
+        Dict[str, Union[User, UserNotFoundError, ApiThrottledError, ApiQuotaError]]: User object, or error
+            if the user does not exist, the API is still throttling or the API quota is reached, by primary ID.
+    """
+    def fetch(primary_id: str) -> Union[User, UserNotFoundError, ApiThrottledError, ApiQuotaError]:
+        start = time.perf_counter()
+        try:
+            return get_user_data(primary_id, zone, env)
+        except (UserNotFoundError, ApiThrottledError, ApiQuotaError) as e:
+            return e
+        finally:
+            if timings is not None:
+                timings.record('get_user_data', time.perf_counter() - start)
+
+    primary_ids = list(dict.fromkeys(primary_ids))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{zone}-api') as executor:
+        return dict(zip(primary_ids, executor.map(fetch, primary_ids)))
@@ -0,0 +1,380 @@
+"""Live progress metrics of a run, exposed in the Prometheus text format.
+
+The merge loop updates counters in memory as the rows change status and the steps
+are timed, each update taking a lock for a few dictionary operations. The metrics
+are only rendered when they are read: by the local HTTP endpoint at each scrape,
+or by the exporter thread writing the text file every few seconds, for example in
+the directory of the textfile collector of the node exporter.
+
+Example:
+    python merge.py input.csv --metrics-port 9108 --metrics-text-file log/merge.prom
+    curl -s localhost:9108/metrics | grep alma_merge_eta_seconds
+"""
+from bisect import bisect_left
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+import logging
+import math
+import os
+import threading
+import time
+
+from utils.results import DONE_STATUSES, IN_FLIGHT, RETRY
+from utils.userapi import get_client
+
+# Upper bounds of the buckets of the step duration histograms, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Statuses of the rows still to process, any other status not done is a failure
+PENDING_STATUSES = {'NOT PROCESSED', IN_FLIGHT, RETRY}
+
+# Step timed around each browser restart, see `MergeSession.restart`
+RESTART_STEP = 'browser_restart'
+
+
+def is_failure(status: Optional[str]) -> bool:
+    """Return whether a status is a final failure of the row.
+
+    args:
+        status (Optional[str]): Merge status of the row.
+
+    returns:
+        bool: True if the row is neither done nor still to process.
+    """
+    return isinstance(status, str) and status not in DONE_STATUSES and status not in PENDING_STATUSES
+
+
+def format_value(value: float) -> str:
+    """Format a sample value of the Prometheus text format, integers without exponent.
+
+    args:
+        value (float): Value of the sample.
+
+    returns:
+        str: Formatted value.
+    """
+    if float(value).is_integer():
+        return str(int(value))
+    return f'{value:.6g}'
+
+
+def escape(value: str) -> str:
+    """Escape a label value of the Prometheus text format.
+
+    args:
+        value (str): Value of the label.
+
+    returns:
+        str: Escaped value, without the surrounding quotes.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunProgress:
+    """Thread-safe counters of the progress of a run, by zone.
+
+    The rows of a zone are added when the zone starts processing them, with their
+    current status. Each status update then moves the row between done, failed and
+    remaining. The merge rate and the ETA are computed over the rows finished in
+    the last `window` seconds, so they follow the slowdowns of Alma during the run.
+    """
+    def __init__(self, window: float = 300):
+        """
+        Initialize the counters.
+
+        args:
+            window (float): Duration of the rolling window of the rates in seconds. Default is 300.
+        """
+        self.window = window
+        self.start = time.monotonic()
+        self._started: Dict[str, float] = {}
+        self._totals: Dict[str, int] = defaultdict(int)
+        self._done: Dict[str, int] = defaultdict(int)
+        self._failed: Dict[str, Set[Hashable]] = defaultdict(set)
+        self._outcomes: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._finished: Dict[str, Deque[Tuple[float, bool]]] = defaultdict(deque)
+        self._histograms: Dict[Tuple[str, str], List] = {}
+        self._api_samples: Deque[Tuple[float, int]] = deque()
+        self._lock = threading.Lock()
+
+    def add_rows(self, zone: str, statuses: Iterable[str]) -> None:
+        """Add the rows of a zone about to be processed.
+
+        The rows already done count as done, the others as remaining: the rows failed
+        by a previous run are processed again.
+
+        Args:
+            zone (str): Zone of the rows.
+            statuses (Iterable[str]): Current merge status of each row.
+        """
+        total = 0
+        done = 0
+        for status in statuses:
+            total += 1
+            done += status in DONE_STATUSES
+        with self._lock:
+            self._started.setdefault(zone, time.monotonic())
+            self._totals[zone] += total
+            self._done[zone] += done
+
+    def update(self, zone: str, i: Hashable, previous: Optional[str], status: str) -> None:
+        """Move a row according to its new status.
+
+        Args:
+            zone (str): Zone of the row.
+            i (Hashable): Index of the row in the input file.
+            previous (Optional[str]): Previous merge status of the row.
+            status (str): New merge status of the row.
+        """
+        now = time.monotonic()
+        was_done = previous in DONE_STATUSES
+        is_done = status in DONE_STATUSES
+        with self._lock:
+            self._done[zone] += is_done - was_done
+            failed = self._failed[zone]
+            was_failed = i in failed
+            if is_failure(status):
+                failed.add(i)
+            else:
+                failed.discard(i)
+            if status != previous and (is_done or is_failure(status)):
+                self._outcomes[(zone, status)] += 1
+            if (is_done or is_failure(status)) and not was_done and not was_failed:
+                finished = self._finished[zone]
+                finished.append((now, is_done))
+                while finished[0][0] < now - self.window:
+                    finished.popleft()
+
+    def observe(self, zone: Optional[str], step: str, seconds: float) -> None:
+        """Add the duration of a step to its histogram.
+
+        Args:
+            zone (Optional[str]): Zone of the step, None if unknown.
+            step (str): Name of the step.
+            seconds (float): Duration of the step in seconds.
+        """
+        key = (zone if zone is not None else '', step)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def zones(self) -> Dict[str, Dict[str, float]]:
+        """Return the counts, rates and ETA of each zone.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Total, done, failed and remaining rows, rows finished
+                and merged per second over the rolling window, and ETA in seconds, None when
+                no row finished in the window, by zone.
+        """
+        now = time.monotonic()
+        zones = {}
+        with self._lock:
+            for zone in sorted(set(self._totals) | set(self._done)):
+                span = max(min(self.window, now - self._started.get(zone, self.start)), 1e-9)
+                finished = self._finished[zone]
+                while len(finished) > 0 and finished[0][0] < now - self.window:
+                    finished.popleft()
+                failed = len(self._failed[zone])
+                remaining = max(self._totals[zone] - self._done[zone] - failed, 0)
+                rate = len(finished) / span
+                zones[zone] = {'total': self._totals[zone],
+                               'done': self._done[zone],
+                               'failed': failed,
+                               'remaining': remaining,
+                               'rate': rate,
+                               'merge_rate': sum(is_done for _, is_done in finished) / span,
+                               'eta': remaining / rate if rate > 0 else (0 if remaining == 0 else None)}
+        return zones
+
+    def api_rate(self, calls: int) -> float:
+        """Record the current number of API calls and return the call rate over the rolling window.
+
+        Args:
+            calls (int): Number of API calls made since the start of the run.
+
+        Returns:
+            float: API calls per second.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._api_samples.append((now, calls))
+            while len(self._api_samples) > 1 and self._api_samples[0][0] < now - self.window:
+                self._api_samples.popleft()
+            if len(self._api_samples) == 1:
+                return calls / max(now - self.start, 1e-9)
+            start, start_calls = self._api_samples[0]
+            return (calls - start_calls) / max(now - start, 1e-9)
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text format.
+
+        Returns:
+            str: Metrics of the run, one sample per line.
+        """
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Iterable[Tuple[Dict, float]]) -> None:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape(label)}"' for key, label in labels.items())
+                lines.append(f'{name}{{{label_text}}} {format_value(value)}' if len(labels) > 0
+                             else f'{name} {format_value(value)}')
+
+        zones = self.zones()
+        for key, kind, help_text in [('total', 'gauge', 'Rows of the zone taken by the run.'),
+                                     ('done', 'gauge', 'Rows of the zone merged or submitted.'),
+                                     ('failed', 'gauge', 'Rows of the zone failed in this run.'),
+                                     ('remaining', 'gauge', 'Rows of the zone still to process.')]:
+            metric(f'alma_merge_rows_{key}', kind, help_text,
+                   [({'zone': zone}, values[key]) for zone, values in zones.items()])
+        metric('alma_merge_rows_per_second', 'gauge', 'Rows finished per second over the rolling window.',
+               [({'zone': zone}, values['rate']) for zone, values in zones.items()])
+        metric('alma_merge_merges_per_second', 'gauge', 'Rows merged per second over the rolling window.',
+               [({}, sum(values['merge_rate'] for values in zones.values()))]
+               + [({'zone': zone}, values['merge_rate']) for zone, values in zones.items()])
+
+        remaining = sum(values['remaining'] for values in zones.values())
+        rate = sum(values['rate'] for values in zones.values())
+        etas = [({'zone': zone}, values['eta']) for zone, values in zones.items() if values['eta'] is not None]
+        if rate > 0 or remaining == 0:
+            etas.insert(0, ({}, remaining / rate if rate > 0 else 0))
+        metric('alma_merge_eta_seconds', 'gauge', 'Estimated time to process the remaining rows at the '
+               'rolling rate.', etas)
+
+        with self._lock:
+            outcomes = sorted(self._outcomes.items())
+            histograms = sorted((key, (list(buckets), total)) for key, (buckets, total) in self._histograms.items())
+        metric('alma_merge_outcomes_total', 'counter', 'Rows finished in this run, by final status.',
+               [({'zone': zone, 'status': status}, n) for (zone, status), n in outcomes])
+        metric('alma_merge_browser_restarts_total', 'counter', 'Browser restarts of the merge sessions.',
+               [({'zone': zone}, sum(buckets)) for (zone, step), (buckets, _) in histograms if step == RESTART_STEP])
+
+        client = get_client()
+        if client is not None:
+            counts = client.counts()
+            metric('alma_merge_api_calls_total', 'counter', 'User API calls of the run.',
+                   [({'zone': zone, 'method': method}, n) for (zone, method), n in sorted(counts.items())])
+            metric('alma_merge_api_calls_per_second', 'gauge', 'User API calls per second over the rolling window.',
+                   [({}, self.api_rate(sum(counts.values())))])
+
+        lines.append('# HELP alma_merge_step_seconds Duration of the steps of the merges.')
+        lines.append('# TYPE alma_merge_step_seconds histogram')
+        for (zone, step), (buckets, total) in histograms:
+            labels = f'zone="{escape(zone)}",step="{escape(step)}"'
+            count = 0
+            for bound, n in zip(BUCKETS + (math.inf,), buckets):
+                count += n
+                lines.append(f'alma_merge_step_seconds_bucket{{{labels},le="{bound:g}"}} {count}'
+                             if bound != math.inf else
+                             f'alma_merge_step_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'alma_merge_step_seconds_sum{{{labels}}} {format_value(total)}')
+            lines.append(f'alma_merge_step_seconds_count{{{labels}}} {count}')
+
+        metric('alma_merge_uptime_seconds', 'gauge', 'Time since the start of the run.',
+               [({}, time.monotonic() - self.start)])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """Expose the metrics of a run on a local HTTP endpoint and in a text file.
+
+    The HTTP server renders the metrics at each request of `/metrics`. The text file
+    is rewritten every `interval` seconds by a background thread, through a
+    temporary file renamed over it so a reader never sees a partial file.
+    """
+    def __init__(self, progress: RunProgress, file_path: Optional[str] = None, port: Optional[int] = None,
+                 interval: float = 15, host: str = '127.0.0.1'):
+        """
+        Initialize the exporter. The server and the thread are only started by `start`.
+
+        args:
+            progress (RunProgress): Progress of the run.
+            file_path (Optional[str]): Path of the text file, None for no file. Default is None.
+            port (Optional[int]): Port of the HTTP endpoint, 0 for any free port, None for no endpoint.
+                Default is None.
+            interval (float): Time between two writes of the file in seconds. Default is 15.
+            host (str): Address the HTTP endpoint listens on. Default is '127.0.0.1'.
+        """
+        self.progress = progress
+        self.file_path = file_path
+        self.port = port
+        self.interval = interval
+        self.host = host
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self) -> 'MetricsExporter':
+        """Start the HTTP server and the file writer.
+
+        Returns:
+            MetricsExporter: The started exporter.
+        """
+        if self.port is not None:
+            progress = self.progress
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = progress.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.server.daemon_threads = True
+            self.port = self.server.server_address[1]
+            self._threads.append(threading.Thread(target=self.server.serve_forever, name='metrics-http',
+                                                  daemon=True))
+            logging.info(f'Metrics served on http://{self.host}:{self.port}/metrics')
+        if self.file_path is not None:
+            self._threads.append(threading.Thread(target=self._run, name='metrics-file', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def write(self) -> None:
+        """Write the metrics to the text file at once."""
+        directory = os.path.dirname(self.file_path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.file_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.progress.render())
+        os.replace(tmp_path, self.file_path)
+
+    def _run(self) -> None:
+        """Write the file until stopped."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f'Failed to write the metrics to {self.file_path}: {type(e).__name__} - {e}')
+
+    def close(self) -> None:
+        """Stop the server and the writer, the file keeps the final metrics of the run."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.file_path is not None:
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f'Failed to write the metrics to {self.file_path}: {type(e).__name__} - {e}')
@@ -0,0 +1,112 @@
+from typing import Dict, Hashable, Optional
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket whose rate adapts to throttling, like AIMD in TCP.
+
+    Each call takes a token, and tokens are added at `rate` per second up to one
+    second of burst. A throttled call halves the rate (multiplicative decrease),
+    each successful call adds `increase / rate`, so the rate grows by about
+    `increase` per second at full speed (additive increase) up to `max_rate`.
+    """
+    def __init__(self, rate: float = 20, max_rate: float = 25, min_rate: float = 0.5, increase: float = 1,
+                 decrease: float = 0.5):
+        """
+        Initialize the bucket, full.
+
+        args:
+            rate (float): Initial number of calls per second. Default is 20.
+            max_rate (float): Maximum number of calls per second. Default is 25, the limit of Alma per API key.
+            min_rate (float): Minimum number of calls per second. Default is 0.5.
+            increase (float): Growth of the rate per second of successful calls. Default is 1.
+            decrease (float): Factor applied to the rate after a throttled call. Default is 0.5.
+        """
+        self.rate = min(rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttled = 0
+        self._tokens = max(self.rate, 1)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(max(self.rate, 1), self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self) -> float:
+        """Wait for a token and take it.
+
+        Returns:
+            float: Time waited in seconds.
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return time.monotonic() - start
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def on_success(self) -> None:
+        """Increase the rate after a successful call."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self) -> None:
+        """Decrease the rate after a throttled call and drop the tokens left."""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = 0
+            self.throttled += 1
+
+
+class RateLimiter:
+    """Token buckets of the Alma API, one per zone and API key, shared by all the workers."""
+    def __init__(self, rate: float = 20, max_rate: float = 25):
+        """
+        Initialize the limiter.
+
+        args:
+            rate (float): Initial number of calls per second of each bucket. Default is 20.
+            max_rate (float): Maximum number of calls per second of each bucket. Default is 25.
+        """
+        self.rate = rate
+        self.max_rate = max_rate
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, zone: str, api_key: Optional[str] = None) -> TokenBucket:
+        """Return the bucket of a zone and API key, created on first use.
+
+        Args:
+            zone (str): Zone of the calls.
+            api_key (Optional[str]): API key of the calls. Default is None.
+
+        Returns:
+            TokenBucket: The bucket shared by the calls of the zone and key.
+        """
+        with self._lock:
+            if (zone, api_key) not in self._buckets:
+                self._buckets[(zone, api_key)] = TokenBucket(self.rate, self.max_rate)
+            return self._buckets[(zone, api_key)]
+
+    def rates(self) -> Dict[str, float]:
+        """Return the current rate of each zone, the lowest one when a zone has several keys."""
+        rates = {}
+        with self._lock:
+            for (zone, _), bucket in self._buckets.items():
+                rates[zone] = min(rates.get(zone, bucket.rate), bucket.rate)
+        return rates
+
+    def throttled(self) -> int:
+        """Return the number of throttled calls."""
+        with self._lock:
+            return sum(bucket.throttled for bucket in self._buckets.values())
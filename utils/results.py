@@ -0,0 +1,555 @@
+from __future__ import annotations
+
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, TYPE_CHECKING
+import os
+import sqlite3
+import threading
+
+from utils.journal import StatusJournal
+from utils.lazy import LazyImport
+from utils.store import QUERY_CHUNK, ResultStore
+
+if TYPE_CHECKING:
+    from utils.progress import RunProgress
+
+pd = LazyImport('pandas')
+
+# Statuses of the rows not to merge again: SUBMITTED and COMPLETED are used when
+# the merge jobs are tracked, SUCCESS when they are not.
+DONE_STATUSES = {'SUCCESS', 'SUBMITTED', 'COMPLETED'}
+
+# Status of a row whose merge is being submitted, recorded before the submission. A row
+# still IN_FLIGHT at restart was interrupted and is checked before being merged again.
+IN_FLIGHT = 'IN_FLIGHT'
+
+# Status of a row whose merge failed with a transient error, merged again by a retry
+# pass of its zone or by the next run.
+RETRY = 'RETRY'
+
+# Rows of a streamed file kept on disk: the journal entries of the rows not loaded yet, and
+# the rows released during the run
+SPILL_SCHEMA = """
+CREATE TABLE rows (
+    row INTEGER PRIMARY KEY,
+    from_user TEXT,
+    to_user TEXT,
+    zone TEXT,
+    status TEXT,
+    job_id TEXT,
+    target TEXT,
+    blocks_copied INTEGER NOT NULL DEFAULT 0,
+    released INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+# Journal entry replacing the previous one of its row, the 'blocks_copied' flag is kept for the same users
+UPSERT_ENTRY = """
+INSERT INTO rows (row, from_user, to_user, zone, status, job_id, blocks_copied) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (row) DO UPDATE SET
+    blocks_copied = CASE WHEN rows.from_user = excluded.from_user AND rows.to_user = excluded.to_user
+                         THEN max(rows.blocks_copied, excluded.blocks_copied) ELSE excluded.blocks_copied END,
+    from_user = excluded.from_user, to_user = excluded.to_user, zone = excluded.zone,
+    status = excluded.status, job_id = excluded.job_id
+"""
+
+
+def error_details(error: Optional[Exception]) -> Dict[str, Optional[str]]:
+    """Return the fields of the journal describing the error of a row.
+
+    The class of the original error and the failed step are taken from the error
+    when it has them, like `MergeProcessError`.
+
+    args:
+        error (Optional[Exception]): Error that caused the status, if any.
+
+    returns:
+        Dict[str, Optional[str]]: Class name, message and step of the error.
+    """
+    if error is None:
+        return {'error_class': None, 'error': None, 'step': None}
+    cause = getattr(error, 'cause', None)
+    return {'error_class': cause if cause is not None else type(error).__name__,
+            'error': str(error),
+            'step': getattr(error, 'step', None)}
+
+
+def apply_journal(df: pd.DataFrame, entries: Dict[int, Dict]) -> int:
+    """Restore the statuses and job IDs of journal entries over the rows of a dataframe.
+
+    Entries whose users do not match the row anymore are ignored, in case the
+    input file was edited between two runs.
+
+    args:
+        df (pd.DataFrame): Dataframe of the input file, with 'Merge_status' and 'Merge_job_id' columns.
+        entries (Dict[int, Dict]): Last journal entry of each row, see `read_journal`.
+
+    returns:
+        int: Number of restored rows.
+    """
+    if len(entries) == 0:
+        return 0
+
+    # Applied at once, a loop over the rows takes minutes for a million rows
+    journal = pd.DataFrame({'from_user': [entry['from_user'] for entry in entries.values()],
+                            'to_user': [entry['to_user'] for entry in entries.values()],
+                            'status': [entry['status'] for entry in entries.values()],
+                            'job_id': [entry.get('job_id') for entry in entries.values()]},
+                           index=list(entries))
+    journal = journal.loc[journal.index.isin(df.index)]
+    rows = df.loc[journal.index]
+    journal = journal.loc[(rows['from_user'].values == journal['from_user'].values)
+                          & (rows['to_user'].values == journal['to_user'].values)]
+    df.loc[journal.index, 'Merge_status'] = journal['status']
+    job_ids = journal['job_id'].dropna()
+    if len(job_ids) > 0:
+        df.loc[job_ids.index, 'Merge_job_id'] = job_ids
+
+    return len(journal)
+
+
+class MergeResults:
+    """Thread-safe store of the merge status of each row of the input file.
+
+    All zone workers share one instance: status updates are serialized with a lock.
+    Each update is appended to the status journal, the input file itself is only
+    written back by `write_csv`, on demand or at the end of the run. With a result
+    store, each update is also recorded in the store of all the runs, and with live
+    progress metrics, it moves the row between done, failed and remaining. The ID
+    of the merge job of a row is kept in the 'Merge_job_id' column, and the final
+    target of a merge collapsed by the merge graph in the 'Merge_target' column.
+    """
+    def __init__(self, df: pd.DataFrame, file_path: str, journal: Optional[StatusJournal] = None,
+                 store: Optional[ResultStore] = None, progress: Optional[RunProgress] = None):
+        """
+        Initialize the result store.
+
+        args:
+            df (pd.DataFrame): Dataframe of the input file, with a 'Merge_status' column.
+            file_path (str): Path of the CSV file where the statuses are written back.
+            journal (Optional[StatusJournal]): Journal recording each outcome. Default is None.
+            store (Optional[ResultStore]): Store of the results of all the runs, recording each outcome.
+                Default is None.
+            progress (Optional[RunProgress]): Live metrics of the run, following each outcome. Default is None.
+        """
+        self.df = df
+        self.file_path = file_path
+        self.journal = journal
+        self.store = store
+        self.progress = progress
+        self._copied = set()
+        self._lock = threading.Lock()
+
+    def get_status(self, i) -> str:
+        """Return the merge status of a row.
+
+        Args:
+            i: Index of the row in the dataframe.
+
+        Returns:
+            str: The merge status of the row.
+        """
+        with self._lock:
+            return self.df.at[i, 'Merge_status']
+
+    def get_statuses(self, indexes: pd.Index) -> pd.Series:
+        """Return the merge statuses of several rows at once.
+
+        Args:
+            indexes (pd.Index): Indexes of the rows in the dataframe.
+
+        Returns:
+            pd.Series: The merge status of each row, by index.
+        """
+        with self._lock:
+            return self.df.loc[indexes, 'Merge_status']
+
+    def get_job_id(self, i) -> Optional[str]:
+        """Return the ID of the merge job of a row.
+
+        Args:
+            i: Index of the row in the dataframe.
+
+        Returns:
+            Optional[str]: The ID of the merge job, None if the row has none.
+        """
+        with self._lock:
+            if 'Merge_job_id' not in self.df.columns or pd.isna(self.df.at[i, 'Merge_job_id']):
+                return None
+            return self.df.at[i, 'Merge_job_id']
+
+    def set_status(self, i, status: str, job_id: Optional[str] = None,
+                   error: Optional[Exception] = None) -> None:
+        """Set the merge status of a row and record it in the journal and the result store.
+
+        Args:
+            i: Index of the row in the dataframe.
+            status (str): New merge status of the row.
+            job_id (Optional[str]): ID of the Alma merge job, if any.
+            error (Optional[Exception]): Error that caused the status, if any.
+        """
+        with self._lock:
+            if self.progress is not None:
+                self.progress.update(self.df.at[i, 'zone'], i, self.df.at[i, 'Merge_status'], status)
+            self.df.at[i, 'Merge_status'] = status
+            if job_id is not None:
+                self.df.at[i, 'Merge_job_id'] = job_id
+            if self.journal is not None:
+                self.journal.record(i,
+                                    self.df.at[i, 'from_user'],
+                                    self.df.at[i, 'to_user'],
+                                    self.df.at[i, 'zone'],
+                                    status,
+                                    job_id=job_id,
+                                    **error_details(error))
+            if self.store is not None:
+                self.store.record(self.file_path, i, self.df.at[i, 'from_user'], self.df.at[i, 'to_user'],
+                                  self.df.at[i, 'zone'], status, job_id=job_id, **error_details(error))
+
+    def blocks_copied(self, i) -> bool:
+        """Return whether the internal blocks of a row are already copied to its 'to' user.
+
+        Args:
+            i: Index of the row in the dataframe.
+
+        Returns:
+            bool: True if the blocks were copied by this run or, according to the journal, by a previous one.
+        """
+        with self._lock:
+            return i in self._copied
+
+    def set_blocks_copied(self, i) -> None:
+        """Record that the internal blocks of a row are copied to its 'to' user, so they are not copied again.
+
+        Args:
+            i: Index of the row in the dataframe.
+        """
+        with self._lock:
+            self._copied.add(i)
+            if self.journal is not None:
+                self.journal.record(i, self.df.at[i, 'from_user'], self.df.at[i, 'to_user'], self.df.at[i, 'zone'],
+                                    self.df.at[i, 'Merge_status'], blocks_copied=True)
+
+    def replay_journal(self) -> int:
+        """Restore the statuses recorded in the journal over the dataframe.
+
+        Entries whose users do not match the row anymore are ignored, in case the
+        input file was edited between two runs.
+
+        Returns:
+            int: Number of restored rows.
+        """
+        if self.journal is None:
+            return 0
+
+        entries = self.journal.replay()
+        with self._lock:
+            self._copied = {i for i, entry in entries.items()
+                            if entry.get('blocks_copied') and i in self.df.index
+                            and self.df.at[i, 'from_user'] == entry['from_user']
+                            and self.df.at[i, 'to_user'] == entry['to_user']}
+            return apply_journal(self.df, entries)
+
+    def set_target(self, i, to_user: str) -> None:
+        """Record the user a row is actually merged into, when it differs from its 'to' user.
+
+        Args:
+            i: Index of the row in the dataframe.
+            to_user (str): The primary ID of the final target of the merge.
+        """
+        with self._lock:
+            self.df.at[i, 'Merge_target'] = to_user
+
+    def submitted_rows(self) -> List[Tuple[Hashable, str, str, str]]:
+        """Return the rows whose merge job was submitted but is not known to be finished.
+
+        Returns:
+            List[Tuple[Hashable, str, str, str]]: Index, zone, 'from' user and job ID of the rows.
+        """
+        with self._lock:
+            if 'Merge_job_id' not in self.df.columns:
+                return []
+            submitted = self.df.loc[(self.df['Merge_status'] == 'SUBMITTED') & self.df['Merge_job_id'].notna()]
+            return [(i, row['zone'], row['from_user'], row['Merge_job_id']) for i, row in submitted.iterrows()]
+
+    def status_counts(self) -> Dict[str, int]:
+        """Return the number of rows of each merge status."""
+        with self._lock:
+            return {status: int(count) for status, count in self.df['Merge_status'].value_counts().items()}
+
+    def write_csv(self) -> None:
+        """Write the statuses back to the input file, through a temporary file.
+
+        The temporary file is in the directory of the input file and replaces it once
+        complete, so a run stopped while writing does not leave a truncated file.
+        """
+        tmp_path = f'{self.file_path}.tmp'
+        with self._lock:
+            self.df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.file_path)
+
+
+class StreamResults(MergeResults):
+    """Merge statuses of an input file read chunk by chunk, see `utils.streaming`.
+
+    Only the rows of the chunks being processed are held, with `load` and `release`,
+    along with the rows whose merge job is followed. The statuses of the released rows
+    and the journal entries of the rows not loaded yet are kept in a temporary SQLite
+    database on disk. `write_csv` rewrites the input file chunk by chunk, so the memory
+    does not depend on the file size.
+    """
+    def __init__(self, file_path: str, journal: Optional[StatusJournal] = None, chunksize: int = 10000,
+                 store: Optional[ResultStore] = None, progress: Optional[RunProgress] = None):
+        """
+        Initialize the result store.
+
+        args:
+            file_path (str): Path of the CSV file read and written back.
+            journal (Optional[StatusJournal]): Journal recording each outcome. Default is None.
+            chunksize (int): Number of rows read at once when writing the file back. Default is 10000.
+            store (Optional[ResultStore]): Store of the results of all the runs, recording each outcome.
+                Default is None.
+            progress (Optional[RunProgress]): Live metrics of the run, following each outcome. Default is None.
+        """
+        super().__init__(None, file_path, journal, store, progress)
+        self.chunksize = chunksize
+        self._rows: Dict[Hashable, Tuple[str, str, str]] = {}
+        self._statuses: Dict[Hashable, Tuple[str, Optional[str]]] = {}
+        self._targets: Dict[Hashable, str] = {}
+        self._followed = set()
+        self._has_targets = False
+
+        # An empty path opens a private database in a temporary file, deleted when it is closed
+        self._spill = sqlite3.connect('', check_same_thread=False)
+        self._spill.execute(SPILL_SCHEMA)
+
+    def _spill_rows(self, indexes: Iterable[Hashable]) -> None:
+        """Move the statuses of held rows to the database and drop the rows from memory.
+
+        Args:
+            indexes (Iterable[Hashable]): Indexes of the held rows.
+        """
+        spilled = []
+        for i in indexes:
+            from_user, to_user, zone = self._rows.pop(i)
+            status, job_id = self._statuses.pop(i, (None, None))
+            target = self._targets.pop(i, None)
+            copied = i in self._copied
+            self._copied.discard(i)
+            self._followed.discard(i)
+            if status is not None:
+                spilled.append((int(i), from_user, to_user, zone, status, job_id, target, int(copied)))
+        self._spill.executemany('INSERT OR REPLACE INTO rows (row, from_user, to_user, zone, status, job_id, '
+                                'target, blocks_copied, released) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)', spilled)
+
+    def _spilled(self, indexes: List[Hashable], released: bool = False) -> Dict[int, Tuple]:
+        """Return the rows of the database among some indexes.
+
+        Args:
+            indexes (List[Hashable]): Indexes of the rows.
+            released (bool): Only return the rows released during the run, not the journal entries of the
+                rows not loaded yet. Default is False.
+
+        Returns:
+            Dict[int, Tuple]: 'From' user, 'to' user, status, job ID, target and 'blocks_copied' flag, by index.
+        """
+        rows = {}
+        indexes = [int(i) for i in indexes]
+        for start in range(0, len(indexes), QUERY_CHUNK):
+            chunk = indexes[start:start + QUERY_CHUNK]
+            query = f'SELECT row, from_user, to_user, status, job_id, target, blocks_copied FROM rows ' \
+                    f'WHERE row IN ({", ".join("?" * len(chunk))}){" AND released = 1" if released else ""}'
+            for row in self._spill.execute(query, chunk):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def load(self, df: pd.DataFrame) -> None:
+        """Hold the rows of a chunk, with the status of the file or of the journal.
+
+        Args:
+            df (pd.DataFrame): Chunk of the input file.
+        """
+        has_status = 'Merge_status' in df.columns
+        has_job_id = 'Merge_job_id' in df.columns
+        with self._lock:
+            spilled = self._spilled(list(df.index))
+            for i, row in df.iterrows():
+                self._rows[i] = (row['from_user'], row['to_user'], row['zone'])
+                self._followed.discard(i)
+                entry = spilled.get(i)
+                if entry is not None and entry[:2] == self._rows[i][:2]:
+                    self._statuses[i] = entry[2:4]
+                    if entry[4] is not None:
+                        self._targets[i] = entry[4]
+                    if entry[5]:
+                        self._copied.add(i)
+                elif i not in self._statuses and has_status and pd.notna(row['Merge_status']):
+                    job_id = row['Merge_job_id'] if has_job_id and pd.notna(row['Merge_job_id']) else None
+                    self._statuses[i] = (row['Merge_status'], job_id)
+
+    def release(self, indexes: Iterable[Hashable]) -> None:
+        """Drop the rows of a processed chunk, except the ones whose merge job is followed.
+
+        Args:
+            indexes (Iterable[Hashable]): Indexes of the rows of the chunk.
+        """
+        with self._lock:
+            released = []
+            for i in indexes:
+                if i not in self._rows:
+                    continue
+                if self._statuses.get(i, ('NOT PROCESSED', None))[0] == 'SUBMITTED':
+                    self._followed.add(i)
+                else:
+                    released.append(i)
+            self._spill_rows(released)
+
+    def chunks(self, chunks: Iterable[pd.DataFrame]) -> Iterable[pd.DataFrame]:
+        """Load each chunk before it is processed and release it when the next one is requested.
+
+        Args:
+            chunks (Iterable[pd.DataFrame]): Chunks of the input file.
+
+        Returns:
+            Iterable[pd.DataFrame]: The same chunks.
+        """
+        for chunk in chunks:
+            self.load(chunk)
+            yield chunk
+            self.release(chunk.index)
+
+    def get_status(self, i) -> str:
+        """Return the merge status of a row, from the database when it is not held."""
+        with self._lock:
+            if i in self._rows:
+                return self._statuses.get(i, ('NOT PROCESSED', None))[0]
+            entry = self._spilled([i], released=True).get(i)
+            return 'NOT PROCESSED' if entry is None else entry[2]
+
+    def get_statuses(self, indexes: pd.Index) -> pd.Series:
+        """Return the merge statuses of several rows at once, from the database for the rows not held."""
+        with self._lock:
+            spilled = self._spilled([i for i in indexes if i not in self._rows], released=True)
+            statuses = [self._statuses.get(i, ('NOT PROCESSED', None))[0] if i in self._rows
+                        else spilled[i][2] if i in spilled else 'NOT PROCESSED' for i in indexes]
+            return pd.Series(statuses, index=indexes, dtype=object)
+
+    def get_job_id(self, i) -> Optional[str]:
+        """Return the ID of the merge job of a row, from the database when it is not held."""
+        with self._lock:
+            if i in self._rows:
+                return self._statuses.get(i, (None, None))[1]
+            entry = self._spilled([i], released=True).get(i)
+            return None if entry is None else entry[3]
+
+    def set_target(self, i, to_user: str) -> None:
+        """Record the user a held row is actually merged into, when it differs from its 'to' user."""
+        with self._lock:
+            self._targets[i] = to_user
+            self._has_targets = True
+
+    def set_status(self, i, status: str, job_id: Optional[str] = None,
+                   error: Optional[Exception] = None) -> None:
+        """Set the merge status of a held row and record it in the journal and the result store.
+
+        A row held only to follow its merge job is released once it is not SUBMITTED anymore.
+        """
+        with self._lock:
+            previous, previous_job_id = self._statuses.get(i, ('NOT PROCESSED', None))
+            job_id = job_id if job_id is not None else previous_job_id
+            self._statuses[i] = (status, job_id)
+            from_user, to_user, zone = self._rows[i]
+            if self.progress is not None:
+                self.progress.update(zone, i, previous, status)
+            if self.journal is not None:
+                self.journal.record(i, from_user, to_user, zone, status, job_id=job_id, **error_details(error))
+            if self.store is not None:
+                self.store.record(self.file_path, i, from_user, to_user, zone, status, job_id=job_id,
+                                  **error_details(error))
+            if i in self._followed and status != 'SUBMITTED':
+                self._spill_rows([i])
+
+    def set_blocks_copied(self, i) -> None:
+        """Record that the internal blocks of a held row are copied to its 'to' user."""
+        with self._lock:
+            self._copied.add(i)
+            if self.journal is not None:
+                from_user, to_user, zone = self._rows[i]
+                self.journal.record(i, from_user, to_user, zone, self._statuses.get(i, ('NOT PROCESSED', None))[0],
+                                    blocks_copied=True)
+
+    def replay_journal(self) -> int:
+        """Read the journal into the database, its entries are applied when their row is loaded.
+
+        The journal is read line by line. The rows left SUBMITTED are held at once, so their
+        merge job can be followed.
+
+        Returns:
+            int: Number of rows in the journal.
+        """
+        if self.journal is None:
+            return 0
+
+        with self._lock:
+            entries = []
+            for entry in self.journal.iter_entries():
+                entries.append((entry['row'], entry['from_user'], entry['to_user'], entry['zone'], entry['status'],
+                                entry.get('job_id'), int(bool(entry.get('blocks_copied')))))
+                if len(entries) >= self.chunksize:
+                    self._spill.executemany(UPSERT_ENTRY, entries)
+                    entries = []
+            self._spill.executemany(UPSERT_ENTRY, entries)
+
+            query = "SELECT row, from_user, to_user, zone, status, job_id FROM rows " \
+                    "WHERE status = 'SUBMITTED' AND job_id IS NOT NULL"
+            for i, from_user, to_user, zone, status, job_id in self._spill.execute(query).fetchall():
+                self._rows[i] = (from_user, to_user, zone)
+                self._statuses[i] = (status, job_id)
+                self._followed.add(i)
+
+            return self._spill.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+
+    def submitted_rows(self) -> List[Tuple[Hashable, str, str, str]]:
+        """Return the rows whose merge job was submitted but is not known to be finished."""
+        with self._lock:
+            return [(i, self._rows[i][2], self._rows[i][0], job_id)
+                    for i, (status, job_id) in self._statuses.items()
+                    if status == 'SUBMITTED' and job_id is not None and i in self._rows]
+
+    def status_counts(self) -> Dict[str, int]:
+        """Return the number of rows of each merge status, among the rows read during the run."""
+        with self._lock:
+            counts = {status: count for status, count in
+                      self._spill.execute('SELECT status, COUNT(*) FROM rows WHERE released = 1 GROUP BY status')}
+            for status, _ in self._statuses.values():
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def write_csv(self) -> None:
+        """Rewrite the input file chunk by chunk with the statuses, through a temporary file."""
+        tmp_path = f'{self.file_path}.tmp'
+        with self._lock:
+            with pd.read_csv(self.file_path, dtype=str, chunksize=self.chunksize) as reader:
+                for chunk_nb, chunk in enumerate(reader):
+                    if 'Merge_status' not in chunk.columns:
+                        chunk['Merge_status'] = 'NOT PROCESSED'
+                    if 'Merge_job_id' not in chunk.columns:
+                        chunk['Merge_job_id'] = None
+                    if self._has_targets and 'Merge_target' not in chunk.columns:
+                        chunk['Merge_target'] = None
+                    spilled = self._spilled(list(chunk.index))
+                    for i in chunk.index:
+                        entry = spilled.get(i)
+                        if i in self._statuses:
+                            status, job_id = self._statuses[i]
+                            target = self._targets.get(i)
+                        elif entry is not None and entry[:2] == (chunk.at[i, 'from_user'], chunk.at[i, 'to_user']):
+                            status, job_id, target = entry[2:5]
+                        else:
+                            continue
+                        chunk.at[i, 'Merge_status'] = status
+                        if job_id is not None:
+                            chunk.at[i, 'Merge_job_id'] = job_id
+                        if target is not None:
+                            chunk.at[i, 'Merge_target'] = target
+                    chunk.to_csv(tmp_path, mode='w' if chunk_nb == 0 else 'a', header=chunk_nb == 0, index=False)
+            os.replace(tmp_path, self.file_path)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+import math
+
+from utils.lazy import LazyImport
+
+pd = LazyImport('pandas')
+
+
+def parse_weights(text: Optional[str]) -> Dict[str, float]:
+    """Parse the zone weights given on the command line.
+
+    args:
+        text (Optional[str]): Weights as 'ZONE=weight' separated by commas, for example 'UBS=3,HPH=0.5'.
+
+    returns:
+        Dict[str, float]: Weight of each listed zone.
+
+    raises:
+        ValueError: If a weight is not a positive number.
+    """
+    weights = {}
+    for item in (text or '').split(','):
+        if len(item.strip()) == 0:
+            continue
+        zone, _, weight = item.partition('=')
+        weights[zone.strip()] = float(weight)
+        if weights[zone.strip()] <= 0:
+            raise ValueError(f'weight of zone {zone.strip()} must be positive')
+    return weights
+
+
+def row_priorities(data: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
+    """Return the priority and deadline of the rows.
+
+    Both columns are optional in the input file. A missing or invalid priority is 0,
+    a missing or invalid deadline is NaT.
+
+    args:
+        data (pd.DataFrame): Rows of the input file.
+
+    returns:
+        Tuple[pd.Series, pd.Series]: Priority and deadline of each row.
+    """
+    if 'priority' in data.columns:
+        priority = pd.to_numeric(data['priority'], errors='coerce').fillna(0)
+    else:
+        priority = pd.Series(0, index=data.index)
+    if 'deadline' in data.columns:
+        deadline = pd.to_datetime(data['deadline'], errors='coerce')
+    else:
+        deadline = pd.Series(pd.NaT, index=data.index, dtype='datetime64[ns]')
+    return priority, deadline
+
+
+def order_rows(data: pd.DataFrame, indexes: Iterable[Hashable]) -> List[Hashable]:
+    """Order the rows of a zone to merge the urgent ones first.
+
+    The rows with the highest priority come first, then, for the same priority,
+    the rows with the earliest deadline. Rows without deadline come after the rows
+    with one, and the rows keep their order in the file otherwise.
+
+    args:
+        data (pd.DataFrame): Rows of the zone.
+        indexes (Iterable[Hashable]): Indexes of the rows to merge.
+
+    returns:
+        List[Hashable]: Indexes of the rows in merge order.
+    """
+    indexes = list(indexes)
+    if 'priority' not in data.columns and 'deadline' not in data.columns:
+        return indexes
+    priority, deadline = row_priorities(data.loc[indexes])
+    keys = pd.DataFrame({'priority': -priority, 'deadline': deadline, 'position': range(len(indexes))})
+    return list(keys.sort_values(['priority', 'deadline', 'position'], na_position='last').index)
+
+
+def order_zones(accounts: Dict[str, pd.DataFrame], weights: Optional[Dict[str, float]] = None) -> List[str]:
+    """Order the zones in which they are given to the zone workers.
+
+    The zones holding the rows of highest priority come first, then the zones with
+    the earliest deadline. The other zones follow by increasing number of rows
+    divided by their weight, so that small zones are not kept waiting behind a huge
+    one, which keeps the merges per hour of the run and lowers the waiting time of
+    most rows. A larger weight moves a zone forward.
+
+    args:
+        accounts (Dict[str, pd.DataFrame]): Rows of each zone.
+        weights (Optional[Dict[str, float]]): Weight of the zones, 1 for the zones not listed. Default is None.
+
+    returns:
+        List[str]: Zones in processing order.
+    """
+    weights = weights or {}
+
+    def key(zone: str) -> Tuple[float, float, float]:
+        priority, deadline = row_priorities(accounts[zone])
+        earliest = deadline.min()
+        return (-priority.max() if len(priority) > 0 else 0,
+                earliest.timestamp() if not pd.isna(earliest) else math.inf,
+                len(accounts[zone]) / weights.get(zone, 1))
+
+    return sorted(accounts, key=key)
+
+
+def zone_session_count(zone: str, zone_sessions: int, weights: Optional[Dict[str, float]] = None,
+                       max_zone_sessions: Optional[int] = None) -> int:
+    """Return the number of browser sessions of a zone.
+
+    args:
+        zone (str): Zone of the sessions.
+        zone_sessions (int): Number of sessions of a zone of weight 1.
+        weights (Optional[Dict[str, float]]): Weight of the zones, 1 for the zones not listed. Default is None.
+        max_zone_sessions (Optional[int]): Maximum number of concurrent sessions of a zone, None for no limit.
+            Default is None.
+
+    returns:
+        int: Number of sessions, at least 1.
+    """
+    count = max(1, round(zone_sessions * (weights or {}).get(zone, 1)))
+    return count if max_zone_sessions is None else max(1, min(count, max_zone_sessions))
@@ -0,0 +1,230 @@
+from utils.httpmerger import HttpMerger
+from utils.mergeprocess import AlmaMerger, MergeProcessError
+from utils.metrics import StepTimings
+from utils.staff import TempStaffUser
+
+from typing import Optional
+import logging
+import threading
+
+BACKENDS = {'selenium': AlmaMerger, 'http': HttpMerger}
+
+# Backends whose form posts are not yet checked against the real Merge Users page, only against tests/fakealma.py
+EXPERIMENTAL_BACKENDS = {'http'}
+
+
+def check_backend(backend: str, batch_size: int = 0) -> None:
+    """Check that a merge backend exists and supports the merges requested.
+
+    args:
+        backend (str): Name of the merge backend in `BACKENDS`.
+        batch_size (int): Number of merges submitted per merge job, 0 for one job per row. Default is 0.
+
+    raises:
+        ValueError: If the backend is unknown or has no batch mode while `batch_size` is set.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown merge backend {backend}, expected one of {", ".join(sorted(BACKENDS))}')
+    if batch_size > 0 and not BACKENDS[backend].batch_mode:
+        batch_backends = sorted(name for name, merger in BACKENDS.items() if merger.batch_mode)
+        raise ValueError(f'the {backend} backend has no batch mode, use {" or ".join(batch_backends)} '
+                         f'to submit the merges in batches')
+
+
+class MergeSession:
+    """Browser session of a temporary staff account, opened on the Merge Users page.
+
+    The browser is kept alive as long as possible: after an error the session first
+    tries a soft recovery on the Merge Users page, and when another zone is processed
+    the new staff user logs in the same browser. Chrome is only restarted when this fails.
+    """
+    def __init__(self, temp_staff: TempStaffUser, headless: bool = True, timings: Optional[StepTimings] = None,
+                 backend: str = 'selenium'):
+        """
+        Initialize the session. The browser is only started by `start`.
+
+        args:
+            temp_staff (TempStaffUser): The staff user object with login credentials.
+            headless (bool): Whether to run the browser in headless mode. Default is True.
+            timings (Optional[StepTimings]): Collection receiving the step durations. Default is None.
+            backend (str): Name of the merge backend in `BACKENDS`. Default is 'selenium'.
+        """
+        self.temp_staff = temp_staff
+        self.headless = headless
+        self.timings = timings
+        self.backend = backend
+        self.merger = None
+        self.soft_recoveries = 0
+        self.restarts = 0
+
+    def start(self) -> 'MergeSession':
+        """Start the browser, log in and open the Merge Users page.
+
+        Returns:
+            MergeSession: The started session.
+
+        Raises:
+            MergeProcessError: If the browser cannot be started or the page cannot be opened.
+        """
+        try:
+            self.merger = BACKENDS[self.backend](self.temp_staff, headless=self.headless, timings=self.timings)
+            self.merger.login()
+            self.merger.open_merge_users_page()
+        except MergeProcessError:
+            self.close()
+            raise
+        except Exception as e:
+            self.close()
+            raise MergeProcessError(f"session start: {type(e).__name__}")
+
+        return self
+
+    def restart(self) -> 'MergeSession':
+        """Quit the current browser and start a new one.
+
+        Returns:
+            MergeSession: The restarted session.
+
+        Raises:
+            MergeProcessError: If the new browser cannot be started.
+        """
+        self.restarts += 1
+        if self.timings is None:
+            self.close()
+            return self.start()
+        with self.timings.measure('browser_restart'):
+            self.close()
+            return self.start()
+
+    def recover(self) -> 'MergeSession':
+        """Bring the session back to a usable state after a failed merge.
+
+        A soft recovery on the current browser is tried first, the browser is
+        only restarted if it fails.
+
+        Returns:
+            MergeSession: The recovered session.
+
+        Raises:
+            MergeProcessError: If the browser has to be restarted and cannot be started.
+        """
+        if self.merger is not None:
+            try:
+                self.merger.reset_page()
+                self.soft_recoveries += 1
+                logging.info('Session recovered on the Merge Users page without restarting the browser')
+                return self
+            except Exception as e:
+                logging.warning(f'Soft recovery failed: {type(e).__name__}')
+
+        logging.warning('Restarting the browser')
+        return self.restart()
+
+    def switch_staff(self, temp_staff: TempStaffUser, timings: Optional[StepTimings] = None) -> 'MergeSession':
+        """Log another temporary staff user in the running browser, for example to process another zone.
+
+        Args:
+            temp_staff (TempStaffUser): The staff user object with login credentials.
+            timings (Optional[StepTimings]): Collection receiving the step durations. Default is None.
+
+        Returns:
+            MergeSession: The session of the new staff user.
+
+        Raises:
+            MergeProcessError: If the browser has to be restarted and cannot be started.
+        """
+        self.temp_staff = temp_staff
+        self.timings = timings
+        self.soft_recoveries = 0
+        self.restarts = 0
+        if self.merger is None:
+            return self.start()
+
+        try:
+            self.merger.logout()
+            self.merger.temp_staff = temp_staff
+            self.merger.timings = timings if timings is not None else StepTimings()
+            self.merger.login()
+            self.merger.open_merge_users_page()
+            logging.info(f'Browser reused for staff user {temp_staff.primary_id}')
+            return self
+        except Exception as e:
+            logging.warning(f'Failed to reuse browser for staff user {temp_staff.primary_id}: {type(e).__name__}')
+
+        return self.restart()
+
+    def close(self) -> None:
+        """Quit the browser if it is running."""
+        if self.merger is None:
+            return
+        try:
+            self.merger.quit()
+        except Exception as e:
+            logging.warning(f'Failed to quit browser: {type(e).__name__}')
+        self.merger = None
+
+
+class SessionPool:
+    """Browser sessions kept alive between zones.
+
+    Sessions released after a zone are handed to the next zone, which only needs
+    to log its staff user in instead of starting a new browser.
+    """
+    def __init__(self, headless: bool = True, backend: str = 'selenium'):
+        """
+        Initialize an empty pool.
+
+        args:
+            headless (bool): Whether to run the browsers in headless mode. Default is True.
+            backend (str): Name of the merge backend of the sessions in `BACKENDS`. Default is 'selenium'.
+        """
+        self.headless = headless
+        self.backend = backend
+        self._idle = []
+        self._lock = threading.Lock()
+        if backend in EXPERIMENTAL_BACKENDS:
+            logging.warning(f'The {backend} merge backend is experimental: its form fields are not yet checked '
+                            f'against the real Merge Users page')
+
+    def acquire(self, temp_staff: TempStaffUser, timings: Optional[StepTimings] = None) -> MergeSession:
+        """Return a session logged in with the staff user, reusing an idle browser if any.
+
+        Args:
+            temp_staff (TempStaffUser): The staff user object with login credentials.
+            timings (Optional[StepTimings]): Collection receiving the step durations. Default is None.
+
+        Returns:
+            MergeSession: Session opened on the Merge Users page.
+
+        Raises:
+            MergeProcessError: If no browser can be started.
+        """
+        with self._lock:
+            session = self._idle.pop() if len(self._idle) > 0 else None
+
+        if session is None:
+            return MergeSession(temp_staff, headless=self.headless, timings=timings, backend=self.backend).start()
+
+        try:
+            return session.switch_staff(temp_staff, timings)
+        except MergeProcessError:
+            session.close()
+            raise
+
+    def release(self, session: MergeSession) -> None:
+        """Give back a session to the pool, for the next zone.
+
+        Args:
+            session (MergeSession): The session to give back.
+        """
+        if session.merger is None:
+            return
+        with self._lock:
+            self._idle.append(session)
+
+    def close(self) -> None:
+        """Quit all idle browsers."""
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            session.close()
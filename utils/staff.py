@@ -1,18 +1,26 @@
-import os
+from __future__ import annotations
 
-from almapiwrapper.users import User, NewUser
-from almapiwrapper.record import JsonData
+import json
+import os
 import string
 import secrets
 
 from importlib.resources import files
 from copy import deepcopy
 
+from utils.lazy import LazyImport
+from utils.userapi import get_client
+
+User = LazyImport('almapiwrapper.users', 'User')
+NewUser = LazyImport('almapiwrapper.users', 'NewUser')
+JsonData = LazyImport('almapiwrapper.record', 'JsonData')
+
 
 class TempStaffUser:
 
-    staff_template = JsonData(filepath=files('utils').joinpath('staff.json'))
-    iz_info = JsonData(filepath=files('utils').joinpath('iz_info.json')).content
+    # Read as plain JSON, almapiwrapper is only imported once an account is created
+    staff_template = json.loads(files('utils').joinpath('staff.json').read_text(encoding='utf-8'))
+    iz_info = json.loads(files('utils').joinpath('iz_info.json').read_text(encoding='utf-8'))
 
     """Temporary class to hold staff user data."""
     def __init__(self, primary_id: str, zone: str):
@@ -49,7 +57,7 @@ class TempStaffUser:
         Returns:
             JsonData: The updated staff template.
         """
-        staff_template = deepcopy(self.staff_template)
+        staff_template = JsonData(deepcopy(self.staff_template))
         staff_template.content['primary_id'] = primary_id
         staff_template.content['user_role'][0]['scope']['value'] = self.iz_info['iz_codes'][zone]
         return staff_template
@@ -76,27 +84,63 @@ class TempStaffUser:
         """
         # Open the staff.json resource file using importlib.resources
         staff_template = self.get_template(self.primary_id, self.zone)
-        self.temp_user = NewUser(data=staff_template,
+        self.temp_user = get_client().bind(NewUser(data=staff_template,
                     zone=self.zone,
                     env=self.env
-        ).create(password=self.password)
+        )).create(password=self.password)
 
         # in case of error, try to delete existing user and recreate
         if self.temp_user.error is True:
-            u = User(self.primary_id, self.zone, self.env)
+            u = get_client().bind(User(self.primary_id, self.zone, self.env))
             _ = u.data
             if u.error is False:
                 u.delete()
-                self.temp_user = NewUser(data=staff_template,
-                                         zone=self.zone,
-                                         env=self.env
-                                         ).create(password=self.password)
+                self.temp_user = get_client().bind(NewUser(data=staff_template,
+                                                           zone=self.zone,
+                                                           env=self.env
+                                                           )).create(password=self.password)
 
         return self
 
+    def check_account(self) -> bool:
+        """Check that the staff account still exists and is active in Alma.
+
+        Returns:
+            bool: True if the account can be used to log in.
+        """
+        get_client().invalidate(self.primary_id, self.zone, self.env)
+        u = get_client().get_user(self.primary_id, self.zone, self.env)
+        if u.error or u.data is None or u.data['status']['value'] != 'ACTIVE':
+            return False
+        self.temp_user = u
+        return True
+
+    def rotate_password(self) -> bool:
+        """Set a new random password to the existing staff account.
+
+        Returns:
+            bool: True if the password was changed in Alma.
+        """
+        password = self.generate_password()
+        u = get_client().get_user(self.primary_id, self.zone, self.env)
+        if u.error:
+            return False
+        u.data['password'] = password
+        u.data['force_password_change'] = 'false'
+        get_client().update_user(u)
+        if u.error:
+            return False
+        self.password = password
+        self.temp_user = u
+        return True
+
     def delete(self):
-        """Delete the staff account."""
-        User(self.primary_id, self.zone, self.env).delete()
+        """Delete the staff account.
+
+        The deletion is made even once the API quota of the run is reached, so the
+        temporary accounts are not left behind.
+        """
+        get_client().bind(User(self.primary_id, self.zone, self.env), quota=False).delete()
 
 
 if __name__ == '__main__':
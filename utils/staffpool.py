@@ -0,0 +1,202 @@
+from typing import Dict, List, Optional, Set
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+from utils.staff import TempStaffUser
+from utils.userapi import ApiQuotaError, ApiThrottledError
+
+
+def get_staff_primary_id(zone: str, session_nb: int = 0) -> str:
+    """Return the primary ID of the temporary staff account of a zone session.
+
+    args:
+        zone (str): Zone of the staff account.
+        session_nb (int): Number of the session in the zone. Default is 0.
+
+    returns:
+        str: Primary ID of the staff account.
+    """
+    suffix = '' if session_nb == 0 else f'_{session_nb}'
+    return f'automation_{zone.lower()}{suffix}@slsp.ch'
+
+
+class StaffPool:
+    """Automation staff accounts of the zones, kept in Alma between runs.
+
+    An account is created the first time a worker of its zone leases it and is
+    then reused by the next runs, so a run only checks that the account is still
+    active instead of creating and deleting it. The passwords are rotated once
+    they are older than `rotate_after`, not at each run. The accounts and their
+    credentials are kept in a JSON file readable only by its owner. The leases are
+    only known to the process: two runs sharing a pool file can log in the same
+    account at the same time, like with `share_staff`.
+    """
+    def __init__(self, path: str, rotate_after: float = 7 * 24 * 3600):
+        """
+        Initialize the pool from its file, if it exists.
+
+        args:
+            path (str): Path of the JSON file of the accounts.
+            rotate_after (float): Age of a password after which it is rotated in seconds. Default is 7 days.
+        """
+        self.path = path
+        self.rotate_after = rotate_after
+        self.env = os.getenv('ALMA_ENV', 'P')
+        self._accounts: Dict[str, Dict] = {}
+        self._leased: Set[str] = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._accounts = {account['primary_id']: account for account in json.load(f)['accounts']
+                                  if account['env'] == self.env}
+
+    def accounts(self, zone: Optional[str] = None) -> List[Dict]:
+        """Return the accounts of the pool, without their password.
+
+        Args:
+            zone (Optional[str]): Zone of the accounts, None for all zones. Default is None.
+
+        Returns:
+            List[Dict]: Primary ID, zone, creation and rotation time of the accounts, and whether they are leased.
+        """
+        with self._lock:
+            return [{**{key: value for key, value in account.items() if key != 'password'},
+                     'leased': primary_id in self._leased}
+                    for primary_id, account in self._accounts.items() if zone in (None, account['zone'])]
+
+    def _save(self) -> None:
+        """Write the accounts to the file, replacing it at once."""
+        directory = os.path.dirname(self.path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        accounts = []
+        if os.path.exists(self.path):
+            # Keep the accounts of the other environment
+            with open(self.path, encoding='utf-8') as f:
+                accounts = [account for account in json.load(f)['accounts'] if account['env'] != self.env]
+        tmp_path = f'{self.path}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'accounts': accounts + list(self._accounts.values())}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def lease(self, zone: str) -> Optional[TempStaffUser]:
+        """Lease a staff account of a zone, creating one if all accounts of the zone are leased.
+
+        The account is checked in Alma and created again if it was removed or
+        deactivated. Its password is rotated if it is too old. No account is leased
+        once the API quota is reached or while the API is throttling, and the account
+        is then given back to the pool.
+
+        Args:
+            zone (str): Zone of the account.
+
+        Returns:
+            Optional[TempStaffUser]: The leased account, None if no account could be created.
+        """
+        with self._lock:
+            numbers = {account['number'] for account in self._accounts.values() if account['zone'] == zone}
+            free = [account for primary_id, account in self._accounts.items()
+                    if account['zone'] == zone and primary_id not in self._leased]
+            if len(free) > 0:
+                account = min(free, key=lambda a: a['number'])
+            else:
+                number = min(set(range(len(numbers) + 1)) - numbers)
+                account = {'primary_id': get_staff_primary_id(zone, number), 'zone': zone, 'env': self.env,
+                           'number': number, 'password': None, 'created': None, 'rotated': None}
+            self._leased.add(account['primary_id'])
+
+        temp_staff = TempStaffUser(account['primary_id'], zone)
+        leased = False
+        try:
+            if account['password'] is not None and temp_staff.check_account():
+                temp_staff.password = account['password']
+                if time.time() - account['rotated'] >= self.rotate_after:
+                    if temp_staff.rotate_password():
+                        logging.info(f'Password of staff account {temp_staff.primary_id} rotated')
+                        account = {**account, 'password': temp_staff.password, 'rotated': time.time()}
+                    else:
+                        logging.warning(f'Failed to rotate the password of staff account {temp_staff.primary_id}')
+                else:
+                    logging.info(f'Reusing staff account {temp_staff.primary_id}')
+            else:
+                temp_staff.create_staff_account()
+                if temp_staff.temp_user.error is True:
+                    logging.error(f'Failed to create temp staff account {temp_staff.primary_id} for {zone}')
+                    return None
+                logging.info(f'Staff account {temp_staff.primary_id} created for the pool')
+                now = time.time()
+                account = {**account, 'password': temp_staff.password, 'created': now, 'rotated': now}
+            leased = True
+        except (ApiQuotaError, ApiThrottledError) as e:
+            logging.error(f'Failed to lease staff account {temp_staff.primary_id} for {zone}: {e}')
+            return None
+        finally:
+            if not leased:
+                with self._lock:
+                    self._leased.discard(account['primary_id'])
+
+        with self._lock:
+            self._accounts[account['primary_id']] = account
+            self._save()
+        return temp_staff
+
+    def release(self, temp_staff: TempStaffUser) -> None:
+        """Give back a leased account to the pool, for the next worker or run.
+
+        Args:
+            temp_staff (TempStaffUser): The leased account.
+        """
+        with self._lock:
+            self._leased.discard(temp_staff.primary_id)
+
+    def teardown(self, zone: Optional[str] = None) -> int:
+        """Delete the accounts of the pool in Alma and remove them from the pool.
+
+        Leased accounts are kept.
+
+        Args:
+            zone (Optional[str]): Zone of the accounts to delete, None for all zones. Default is None.
+
+        Returns:
+            int: Number of deleted accounts.
+        """
+        with self._lock:
+            accounts = [account for primary_id, account in self._accounts.items()
+                        if zone in (None, account['zone']) and primary_id not in self._leased]
+
+        for account in accounts:
+            TempStaffUser(account['primary_id'], account['zone']).delete()
+            logging.info(f'Staff account {account["primary_id"]} deleted')
+            with self._lock:
+                del self._accounts[account['primary_id']]
+
+        with self._lock:
+            self._save()
+        return len(accounts)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Manage the pool of automation staff accounts.')
+    parser.add_argument('action', choices=['list', 'teardown'],
+                        help='list the accounts of the pool, or delete them in Alma')
+    parser.add_argument('--pool', default='log/staff_pool.json',
+                        help='JSON file of the pool (default: log/staff_pool.json)')
+    parser.add_argument('--zone', help='only the accounts of this zone (default: all zones)')
+    args = parser.parse_args()
+
+    staff_pool = StaffPool(args.pool)
+    if args.action == 'list':
+        for account in staff_pool.accounts(args.zone):
+            print(f'{account["zone"]:<6} {account["primary_id"]:<40} '
+                  f'rotated {time.strftime("%Y-%m-%d %H:%M", time.localtime(account["rotated"]))}')
+    else:
+        print(f'{staff_pool.teardown(args.zone)} staff accounts deleted')
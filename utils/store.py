@@ -0,0 +1,246 @@
+"""Persistent store of the merge results of all the runs, in a SQLite database.
+
+The store keeps the last outcome of each row of each input file, written as the
+rows are merged, next to the journal of the file. It answers the questions that
+otherwise need to load the input files, like the rows failed in a zone or
+whether a pair was ever merged, and lets the workflow skip the pairs already
+merged by earlier runs without any API call.
+
+The merged pairs are also appended to their own table, never updated: a new input
+file written to the path of an older one replaces the outcomes of its rows, not
+the pairs it merged.
+
+Example:
+    python -m utils.store query --zone UBS --status FAIL
+    python -m utils.store summary
+"""
+from datetime import datetime
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+import argparse
+import os
+import sqlite3
+import threading
+
+# Statuses of a pair known to be merged in Alma, skipped by the later runs
+MERGED_STATUSES = ('SUCCESS', 'COMPLETED')
+
+# Maximum number of values in one 'IN' clause, below the limit of old SQLite versions
+QUERY_CHUNK = 500
+
+# Version of the schema, kept in 'PRAGMA user_version': 2 since the merged pairs have their own table
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    file TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    zone TEXT NOT NULL,
+    from_user TEXT NOT NULL,
+    to_user TEXT NOT NULL,
+    status TEXT NOT NULL,
+    job_id TEXT,
+    error_class TEXT,
+    error TEXT,
+    step TEXT,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (file, row)
+);
+CREATE INDEX IF NOT EXISTS results_zone_status ON results (zone, status);
+CREATE INDEX IF NOT EXISTS results_status ON results (status);
+CREATE INDEX IF NOT EXISTS results_from_user ON results (from_user);
+CREATE INDEX IF NOT EXISTS results_to_user ON results (to_user);
+CREATE TABLE IF NOT EXISTS merged_pairs (
+    zone TEXT NOT NULL,
+    from_user TEXT NOT NULL,
+    to_user TEXT NOT NULL,
+    status TEXT NOT NULL,
+    job_id TEXT,
+    file TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (zone, from_user, to_user)
+);
+"""
+
+# Copies the outcome of a row to the merged pairs, once per pair, with the job ID kept by the results
+APPEND_MERGED = """
+INSERT OR IGNORE INTO merged_pairs
+SELECT zone, from_user, to_user, status, job_id, file, row, timestamp FROM results
+"""
+
+
+class ResultStore:
+    """Thread-safe SQLite store of the last outcome of each row of the merged files.
+
+    The pairs merged are kept in an append-only table, queried by `merged_pairs`.
+    All the workers share one connection, serialized with a lock. The database is
+    in WAL mode, so the store can be queried while a run writes to it.
+    """
+    def __init__(self, path: str = 'log/results.db'):
+        """
+        Initialize the store and create its table if needed.
+
+        args:
+            path (str): Path of the SQLite database. Default is 'log/results.db'.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        """Bring a store created by an older version to the current schema, once."""
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        with self._connection:
+            # Fills the merged pairs of a store created before their table
+            self._connection.execute(f'{APPEND_MERGED} WHERE status IN ({", ".join("?" * len(MERGED_STATUSES))})',
+                                     MERGED_STATUSES)
+            self._connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def record(self, file_path: str, i: Hashable, from_user: str, to_user: str, zone: str, status: str,
+               job_id: Optional[str] = None, error_class: Optional[str] = None,
+               error: Optional[str] = None, step: Optional[str] = None) -> None:
+        """Record the outcome of a row, replacing its previous one.
+
+        The job ID of the row is kept when the new outcome of the same pair has none. A merged pair is
+        also appended to the merged pairs, if not already there.
+
+        Args:
+            file_path (str): Path of the input file.
+            i (Hashable): Index of the row in the input file.
+            from_user (str): The primary ID of the user to merge from.
+            to_user (str): The primary ID of the user to merge to.
+            zone (str): Zone of the users.
+            status (str): Merge status of the row.
+            job_id (Optional[str]): ID of the Alma merge job, if any.
+            error_class (Optional[str]): Class name of the error, if any.
+            error (Optional[str]): Error message, if any.
+            step (Optional[str]): Step of the merge where the error occurred, if known.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (file, row) DO UPDATE SET zone = excluded.zone, from_user = excluded.from_user, '
+                'to_user = excluded.to_user, status = excluded.status, '
+                'job_id = CASE WHEN results.from_user = excluded.from_user AND results.to_user = excluded.to_user '
+                'THEN COALESCE(excluded.job_id, results.job_id) ELSE excluded.job_id END, '
+                'error_class = excluded.error_class, '
+                'error = excluded.error, step = excluded.step, timestamp = excluded.timestamp',
+                (os.path.abspath(file_path), int(i), zone, from_user, to_user, status, job_id, error_class, error,
+                 step, datetime.now().isoformat(timespec='seconds')))
+            if status in MERGED_STATUSES:
+                self._connection.execute(f'{APPEND_MERGED} WHERE file = ? AND row = ?',
+                                         (os.path.abspath(file_path), int(i)))
+
+    def merged_pairs(self, zone: str, from_users: Iterable[str]) -> Dict[Tuple[str, str], Tuple[str, Optional[str]]]:
+        """Return the pairs of a set of 'from' users merged by any run, even from a file since replaced.
+
+        Args:
+            zone (str): Zone of the users.
+            from_users (Iterable[str]): Primary IDs of the users to merge from.
+
+        Returns:
+            Dict[Tuple[str, str], Tuple[str, Optional[str]]]: Status and job ID of the merged pairs,
+                by 'from' and 'to' user.
+        """
+        from_users = list(dict.fromkeys(from_users))
+        pairs = {}
+        with self._lock:
+            for start in range(0, len(from_users), QUERY_CHUNK):
+                chunk = from_users[start:start + QUERY_CHUNK]
+                cursor = self._connection.execute(
+                    f'SELECT from_user, to_user, status, job_id FROM merged_pairs '
+                    f'WHERE from_user IN ({", ".join("?" * len(chunk))}) AND zone = ?',
+                    (*chunk, zone))
+                for row in cursor:
+                    pairs[(row['from_user'], row['to_user'])] = (row['status'], row['job_id'])
+        return pairs
+
+    def query(self, zone: Optional[str] = None, status: Optional[str] = None, from_user: Optional[str] = None,
+              to_user: Optional[str] = None, file_path: Optional[str] = None,
+              limit: Optional[int] = None) -> List[Dict]:
+        """Return the rows matching all the given criteria, the latest first.
+
+        Args:
+            zone (Optional[str]): Zone of the rows. Default is None, for all zones.
+            status (Optional[str]): Merge status of the rows. Default is None, for all statuses.
+            from_user (Optional[str]): The primary ID of the user to merge from. Default is None.
+            to_user (Optional[str]): The primary ID of the user to merge to. Default is None.
+            file_path (Optional[str]): Path of the input file. Default is None, for all files.
+            limit (Optional[int]): Maximum number of rows. Default is None, for no limit.
+
+        Returns:
+            List[Dict]: The matching rows, as dictionaries of the columns of the store.
+        """
+        criteria = {'zone': zone, 'status': status, 'from_user': from_user, 'to_user': to_user,
+                    'file': os.path.abspath(file_path) if file_path is not None else None}
+        criteria = {column: value for column, value in criteria.items() if value is not None}
+        sql = 'SELECT * FROM results'
+        if len(criteria) > 0:
+            sql += ' WHERE ' + ' AND '.join(f'{column} = ?' for column in criteria)
+        sql += ' ORDER BY timestamp DESC, file, row'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, tuple(criteria.values()))]
+
+    def status_counts(self, file_path: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """Return the number of rows of each status, by zone.
+
+        Args:
+            file_path (Optional[str]): Path of the input file. Default is None, for all files.
+
+        Returns:
+            Dict[str, Dict[str, int]]: Number of rows of each status, by zone.
+        """
+        sql = 'SELECT zone, status, COUNT(*) AS n FROM results'
+        params = ()
+        if file_path is not None:
+            sql += ' WHERE file = ?'
+            params = (os.path.abspath(file_path),)
+        counts = {}
+        with self._lock:
+            for row in self._connection.execute(sql + ' GROUP BY zone, status', params):
+                counts.setdefault(row['zone'], {})[row['status']] = row['n']
+        return counts
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the store of the merge results of all the runs.')
+    parser.add_argument('action', choices=['query', 'summary'],
+                        help='list the matching rows, or count the rows of each status by zone')
+    parser.add_argument('--store', default='log/results.db',
+                        help='SQLite database of the results (default: log/results.db)')
+    parser.add_argument('--zone', help='only the rows of this zone')
+    parser.add_argument('--status', help='only the rows with this merge status')
+    parser.add_argument('--from-user', help='only the rows merging this user')
+    parser.add_argument('--to-user', help='only the rows merging into this user')
+    parser.add_argument('--file', help='only the rows of this input file (summary too)')
+    parser.add_argument('--limit', type=int, help='maximum number of rows listed (default: no limit)')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.action == 'query':
+        for row in store.query(args.zone, args.status, args.from_user, args.to_user, args.file, args.limit):
+            job = f' job {row["job_id"]}' if row['job_id'] is not None else ''
+            error = f' {row["error_class"]} at {row["step"]}: {row["error"]}' if row['error'] is not None else ''
+            print(f'{row["timestamp"]} {row["zone"]:<6} {row["status"]:<13} {row["from_user"]} -> {row["to_user"]} '
+                  f'(row {row["row"]} of {row["file"]}){job}{error}')
+    else:
+        for zone, counts in sorted(store.status_counts(args.file).items()):
+            print(f'{zone}: ' + ', '.join(f'{status}: {count}' for status, count in sorted(counts.items())))
+    store.close()
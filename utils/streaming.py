@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from typing import Iterator, List, Tuple
+
+from utils.lazy import LazyImport
+
+pd = LazyImport('pandas')
+
+
+def scan_zones(file_path: str, chunksize: int = 100000) -> Iterator[Tuple[str, int]]:
+    """Read the zone column of a merge file and yield each zone as soon as it is found.
+
+    Only the zone column of one chunk is held in memory, so the first zone is
+    available after reading the first chunk, whatever the size of the file.
+
+    Args:
+        file_path (str): Path of the CSV merge file.
+        chunksize (int): Number of lines read at once. Default is 100000.
+
+    Returns:
+        Iterator[Tuple[str, int]]: Zone and number of the first row of the zone.
+    """
+    seen = set()
+    for chunk in pd.read_csv(file_path, dtype=str, usecols=['zone'], chunksize=chunksize):
+        for zone, first_row in chunk.reset_index().groupby('zone', sort=False)['index'].min().items():
+            if zone not in seen:
+                seen.add(zone)
+                yield zone, int(first_row)
+
+
+def read_zone(file_path: str, zone: str, chunksize: int = 10000, start: int = 0,
+              sorted_by_zone: bool = False) -> Iterator[pd.DataFrame]:
+    """Read the rows of one zone of a merge file, chunk by chunk.
+
+    The rows keep their row number in the file as index, like with `pd.read_csv`.
+    When the file is sorted by zone, reading stops at the end of the zone block.
+
+    Args:
+        file_path (str): Path of the CSV merge file.
+        zone (str): Zone of the rows to read.
+        chunksize (int): Number of rows of the zone per chunk. Default is 10000.
+        start (int): Number of the first row of the zone, the rows before are skipped. Default is 0.
+        sorted_by_zone (bool): The rows of a zone are contiguous in the file. Default is False.
+
+    Returns:
+        Iterator[pd.DataFrame]: Chunks of at most `chunksize` rows of the zone.
+    """
+    parts: List[pd.DataFrame] = []
+    size = 0
+    found = False
+    # A callable, as a range of skipped rows would be turned into a set as big as the file
+    with pd.read_csv(file_path, dtype=str, chunksize=chunksize, skiprows=lambda n: 0 < n <= start) as reader:
+        for chunk in reader:
+            chunk.index += start
+            rows = chunk.loc[chunk['zone'] == zone]
+            found = found or len(rows) > 0
+            parts.append(rows)
+            size += len(rows)
+            while size >= chunksize:
+                rows = pd.concat(parts)
+                yield rows.iloc[:chunksize]
+                parts = [rows.iloc[chunksize:]]
+                size = len(parts[0])
+
+            if sorted_by_zone and found and chunk['zone'].iloc[-1] != zone:
+                break
+
+    if size > 0:
+        yield pd.concat(parts)
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+from collections import OrderedDict, defaultdict
+from copy import deepcopy
+from functools import partial
+from typing import Dict, Hashable, Literal, Optional, Tuple, TYPE_CHECKING
+import logging
+import random
+import threading
+import time
+
+from utils.lazy import LazyImport
+from utils.ratelimit import RateLimiter
+
+if TYPE_CHECKING:
+    from almapiwrapper.record import Record
+
+requests = LazyImport('requests')
+HTTPAdapter = LazyImport('requests.adapters', 'HTTPAdapter')
+User = LazyImport('almapiwrapper.users', 'User')
+JsonData = LazyImport('almapiwrapper.record', 'JsonData')
+
+
+class ApiQuotaError(Exception):
+    """Custom exception for API calls refused to stay under the Alma API quota."""
+    pass
+
+
+class ApiThrottledError(Exception):
+    """Custom exception for API calls still throttled by Alma once the retries are exhausted."""
+    pass
+
+
+class UserApiClient:
+    """Shared layer for the User API calls of all the workers.
+
+    The calls reuse keep-alive connections from one pool, and the user records are
+    kept in an LRU cache with a time to live, keyed by (zone, env, primary_id), so a
+    user found in many rows is fetched once. Each update invalidates the cached
+    record. The calls are counted by zone and method, and the remaining daily quota
+    sent by Alma is recorded.
+
+    The calls are paced by a token bucket per zone and API key, shared by all the
+    workers. A throttled call (429, 5xx or connection error) lowers the rate of its
+    bucket and is retried with an exponential backoff for up to `max_wait` seconds.
+    """
+    def __init__(self, ttl: float = 600, max_size: int = 10000, pool_size: int = 16,
+                 max_calls: Optional[int] = None, min_remaining: int = 5000,
+                 limiter: Optional[RateLimiter] = None, backoff: float = 1, max_wait: float = 300):
+        """
+        Initialize the client.
+
+        args:
+            ttl (float): Time to live of the cached user records in seconds. Default is 600.
+            max_size (int): Maximum number of cached user records. Default is 10000.
+            pool_size (int): Maximum number of kept-alive connections. Default is 16.
+            max_calls (Optional[int]): Maximum number of API calls of the run, None for no limit. Default is None.
+            min_remaining (int): Refuse the calls once Alma reports fewer remaining calls. Default is 5000.
+            limiter (Optional[RateLimiter]): Token buckets pacing the calls. Default is a new one.
+            backoff (float): Delay before the first retry of a throttled call in seconds, doubled
+                at each try. Default is 1.
+            max_wait (float): Maximum time spent retrying a throttled call in seconds. Default is 300.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_calls = max_calls
+        self.min_remaining = min_remaining
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.call_counts: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.remaining: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[Hashable, Tuple[float, Dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def calls(self) -> int:
+        """Number of API calls made by the client."""
+        with self._lock:
+            return sum(self.call_counts.values())
+
+    def counts(self) -> Dict[Tuple[str, str], int]:
+        """Return the number of API calls by zone and method."""
+        with self._lock:
+            return dict(self.call_counts)
+
+    def api_call(self, method: Literal['get', 'put', 'post', 'delete'], *args,
+                 zone: str = '', quota: bool = True, **kwargs) -> requests.Response:
+        """Make an API call with a pooled connection, like `Record.api_call`.
+
+        Args:
+            method (Literal['get', 'put', 'post', 'delete']): HTTP method of the call.
+            zone (str): Zone of the call, used for the rate limit and the counts. Default is ''.
+            quota (bool): Refuse the call once the quota is reached, False for the cleanup calls,
+                like the deletion of the temp staff accounts, which are counted but always made.
+                Default is True.
+
+        Raises:
+            ApiQuotaError: If the call would exceed the quota of the run or of the day.
+            ApiThrottledError: If the call is still throttled after `max_wait` seconds.
+
+        Returns:
+            requests.Response: Response of the call.
+        """
+        headers = kwargs.get('headers') or {}
+        bucket = self.limiter.bucket(zone, headers.get('Authorization'))
+        deadline = time.monotonic() + self.max_wait
+        api_try = 0
+        while True:
+            api_try += 1
+            with self._lock:
+                if quota and self.max_calls is not None and sum(self.call_counts.values()) >= self.max_calls:
+                    raise ApiQuotaError(f'Quota of {self.max_calls} API calls of the run reached')
+                if quota and self.remaining is not None and self.remaining < self.min_remaining:
+                    raise ApiQuotaError(f'Only {self.remaining} API calls left in the daily quota')
+                self.call_counts[(zone, method.upper())] += 1
+
+            bucket.acquire()
+            try:
+                r = self.session.request(method, *args, **kwargs)
+            except requests.exceptions.RequestException as e:
+                error = type(e).__name__
+            else:
+                if 'X-Exl-Api-Remaining' in r.headers:
+                    with self._lock:
+                        self.remaining = int(r.headers['X-Exl-Api-Remaining'])
+                if r.status_code != 429 and r.status_code < 500:
+                    bucket.on_success()
+                    return r
+                error = f'HTTP {r.status_code}'
+
+            bucket.on_throttle()
+            # Jitter, so the workers throttled together do not retry together
+            delay = self.backoff * 2 ** (api_try - 1) * random.uniform(0.5, 1)
+            if time.monotonic() + delay > deadline:
+                logging.error(f'{method.upper()} call of {zone} still throttled after {api_try} tries: {error}')
+                raise ApiThrottledError(f'{method.upper()} call of {zone} still throttled after '
+                                        f'{api_try} tries: {error}')
+            logging.warning(f'{method.upper()} call of {zone} throttled ({error}), try {api_try}: '
+                            f'retry in {delay:.1f}s at {bucket.rate:.1f} calls/s')
+            time.sleep(delay)
+
+    def bind(self, record: Record, quota: bool = True) -> Record:
+        """Make the API calls of an almapiwrapper record go through the client.
+
+        Args:
+            record (Record): The record, for example a `NewUser` to create.
+            quota (bool): Refuse the calls of the record once the quota is reached, see `api_call`.
+                Default is True.
+
+        Returns:
+            Record: The same record.
+        """
+        # Shadows the static `Record.api_call`, which opens a new connection for each call
+        record.api_call = partial(self.api_call, zone=record.zone, quota=quota)
+        return record
+
+    def get_user(self, primary_id: str, zone: str, env: Literal['P', 'S']) -> User:
+        """Return a user, from the cache if its record is still valid.
+
+        Each call returns its own copy of the record, which can be modified freely.
+
+        Args:
+            primary_id (str): Primary ID of the user.
+            zone (str): Zone of the user.
+            env (Literal['P', 'S']): Alma environment.
+
+        Returns:
+            User: The user, bound to the client, with the error flag set if it could not be fetched.
+        """
+        key = (zone, env, primary_id)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self.bind(User(primary_id, zone, env, JsonData(deepcopy(entry[1]))))
+            self.misses += 1
+
+        # The data is fetched on first access, with the API call of the client
+        u = self.bind(User(primary_id, zone, env))
+        if u.data is not None and not u.error:
+            with self._lock:
+                self._cache[key] = (time.monotonic() + self.ttl, deepcopy(u.data))
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        return u
+
+    def update_user(self, u: User) -> User:
+        """Update a user and drop its cached record.
+
+        Args:
+            u (User): The user to update.
+
+        Returns:
+            User: The updated user, with the error flag set if the update failed.
+        """
+        try:
+            return u.update()
+        finally:
+            self.invalidate(u.primary_id, u.zone, u.env)
+
+    def invalidate(self, primary_id: str, zone: str, env: Literal['P', 'S']) -> None:
+        """Drop the cached record of a user, for example once it is merged.
+
+        Args:
+            primary_id (str): Primary ID of the user.
+            zone (str): Zone of the user.
+            env (Literal['P', 'S']): Alma environment.
+        """
+        with self._lock:
+            self._cache.pop((zone, env, primary_id), None)
+
+    def summary(self) -> str:
+        """Return a one-line summary of the API calls and the cache use."""
+        with self._lock:
+            counts = ', '.join(f'{zone} {method}: {n}' for (zone, method), n in sorted(self.call_counts.items()))
+            total = sum(self.call_counts.values())
+            remaining = f', {self.remaining} left in the daily quota' if self.remaining is not None else ''
+            summary = (f'{total} API calls ({counts}){remaining}, '
+                       f'user cache: {self.hits} hits, {self.misses} misses')
+        rates = ', '.join(f'{zone}: {rate:.1f}' for zone, rate in sorted(self.limiter.rates().items()))
+        return f'{summary}, {self.limiter.throttled()} throttled calls, rates per second ({rates})'
+
+    def close(self) -> None:
+        """Close the pooled connections."""
+        self.session.close()
+
+
+_client: Optional[UserApiClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> UserApiClient:
+    """Return the client shared by all the workers, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = UserApiClient()
+        return _client
+
+
+def set_client(client: Optional[UserApiClient]) -> Optional[UserApiClient]:
+    """Replace the shared client, for example to configure its cache or quota.
+
+    Args:
+        client (Optional[UserApiClient]): New shared client, None to create a default one on next use.
+
+    Returns:
+        Optional[UserApiClient]: The previous shared client.
+    """
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+        return previous
@@ -0,0 +1,73 @@
+from collections import deque
+from typing import Hashable, Iterable, List, Optional
+import threading
+
+
+class RowQueue:
+    """Queue of rows shared by the merge sessions of a zone.
+
+    A row taken with `get` is in flight until the session calls `done` or
+    `requeue`. `get` only returns None once the queue is empty and no row is
+    in flight anymore, so a requeued row is never left behind.
+    """
+    def __init__(self, rows: Iterable[Hashable]):
+        """
+        Initialize the queue.
+
+        args:
+            rows (Iterable[Hashable]): Indexes of the rows to process.
+        """
+        self._rows = deque(rows)
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def get(self) -> Optional[Hashable]:
+        """Take the next row to process.
+
+        Returns:
+            Optional[Hashable]: Index of the row or None when all rows are processed.
+        """
+        with self._cond:
+            while len(self._rows) == 0 and self._in_flight > 0:
+                self._cond.wait()
+            if len(self._rows) == 0:
+                return None
+            self._in_flight += 1
+            return self._rows.popleft()
+
+    def done(self, i: Hashable) -> None:
+        """Mark a row taken with `get` as processed.
+
+        Args:
+            i (Hashable): Index of the row.
+        """
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def requeue(self, i: Hashable) -> None:
+        """Put back a row taken with `get` so that another session processes it.
+
+        Args:
+            i (Hashable): Index of the row.
+        """
+        with self._cond:
+            self._rows.append(i)
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def close(self) -> List[Hashable]:
+        """Drop the rows still waiting, so the sessions stop once their rows in flight are processed.
+
+        Returns:
+            List[Hashable]: Indexes of the dropped rows.
+        """
+        with self._cond:
+            dropped, self._rows = list(self._rows), deque()
+            self._cond.notify_all()
+            return dropped
+
+    def __len__(self) -> int:
+        """Return the number of rows waiting in the queue."""
+        with self._cond:
+            return len(self._rows)